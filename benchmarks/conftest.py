@@ -0,0 +1,52 @@
+import numpy as np
+import obspy
+import pytest
+
+from noisepy.seis.io.datatypes import ChannelData, ConfigParameters
+
+# realistic sampling rates and the default 1800 s correlation windows. The time chunks are shorter than a day to
+# keep a run of the whole suite under a few minutes, the cost of the kernels is linear in the number of windows.
+SAMPLING_RATES = [20.0, 100.0]
+INC_HOURS = 6
+CC_LEN = 1800
+STEP = 450.0
+
+
+def synthetic_noise(samp_freq: float, seconds: float, seed: int = 0) -> np.ndarray:
+    """
+    Band-limited random noise with a slow trend, as a stand-in for a continuous seismic record
+    """
+    rng = np.random.default_rng(seed)
+    npts = int(samp_freq * seconds)
+    data = rng.standard_normal(npts).astype(np.float32)
+    # smooth it a bit so it is not white and add a trend for detrend to remove
+    data = np.convolve(data, np.ones(5, dtype=np.float32) / 5, mode="same")
+    return data + np.linspace(0, 1, npts, dtype=np.float32)
+
+
+@pytest.fixture(params=SAMPLING_RATES, ids=lambda f: f"{int(f)}Hz")
+def config(request) -> ConfigParameters:
+    return ConfigParameters(
+        samp_freq=request.param,
+        inc_hours=INC_HOURS,
+        cc_len=CC_LEN,
+        step=STEP,
+        substack_len=CC_LEN,
+    )
+
+
+@pytest.fixture
+def ch_data(config: ConfigParameters) -> ChannelData:
+    data = synthetic_noise(config.samp_freq, config.inc_hours * 3600)
+    tr = obspy.Trace(data, header={"sampling_rate": config.samp_freq, "starttime": obspy.UTCDateTime(2021, 1, 1)})
+    return ChannelData(obspy.Stream([tr]))
+
+
+@pytest.fixture
+def segments(config: ConfigParameters) -> np.ndarray:
+    """
+    The 2D matrix of windows cut from a time chunk, as returned by cut_trace_make_stat
+    """
+    nseg = int(np.floor((config.inc_hours * 3600 - config.cc_len) / config.step))
+    data = synthetic_noise(config.samp_freq, config.cc_len * nseg, seed=1)
+    return data.reshape(nseg, int(config.cc_len * config.samp_freq))
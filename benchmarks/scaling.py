@@ -0,0 +1,254 @@
+"""
+End-to-end scaling benchmark of cross_correlate and stack_cross_correlations on synthetic data.
+
+Each measurement runs in a fresh process, pinned to ``threads`` CPUs, with the in-memory stores of
+``synthetic.py``. Strong scaling keeps the problem fixed and adds CPUs, weak scaling grows the number of
+station pairs with the number of CPUs. The measured times are fitted to a cost model (per channel for the
+read/pre-processing/FFT and per station pair for the correlation and stacking) to extrapolate to larger
+station counts. E.g.:
+
+    python benchmarks/scaling.py --stations 10 20 40 --threads 1 2 4 --predict 200 2000 --report scaling
+
+With ``--scheduler mpi`` run it with e.g. ``mpirun -n 4 python benchmarks/scaling.py ...``: the ranks share the
+work of each measurement through on-disk numpy stores in ``--work-dir`` (a directory seen by all the ranks).
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from datetime import timedelta
+from typing import List, Optional
+
+import numpy as np
+import psutil
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synthetic import (  # noqa: E402
+    START,
+    InMemoryCCStore,
+    InMemoryStackStore,
+    SyntheticRawDataStore,
+)
+
+from noisepy.seis import cross_correlate, stack_cross_correlations  # noqa: E402
+from noisepy.seis.datatypes import ConfigParameters  # noqa: E402
+from noisepy.seis.io.datatypes import RmResp  # noqa: E402
+from noisepy.seis.scheduler import MPIScheduler, SingleNodeScheduler  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Measurement:
+    mode: str
+    stations: int
+    inc_hours: int
+    threads: int
+    scheduler: str
+    channels: int = 0
+    pairs: int = 0
+    timespans: int = 0
+    cc_seconds: float = 0.0
+    stack_seconds: float = 0.0
+    pairs_per_second: float = 0.0
+    peak_rss_bytes: int = 0
+
+
+def make_config(args, inc_hours: int) -> ConfigParameters:
+    return ConfigParameters(
+        samp_freq=args.samp_freq,
+        inc_hours=inc_hours,
+        cc_len=args.cc_len,
+        step=args.cc_len / 4,
+        maxlag=args.maxlag,
+        rm_resp=RmResp.NO,
+        start_date=START,
+        end_date=START + timedelta(days=args.days),
+        stations=["*"],
+        net_list=["*"],
+    )
+
+
+def measure(args, m: Measurement, work_dir: str) -> Measurement:
+    """
+    Runs the cross-correlation and stacking of one configuration and fills in the timings
+    """
+    config = make_config(args, m.inc_hours)
+    raw_store = SyntheticRawDataStore(m.stations, args.samp_freq, m.inc_hours, args.days)
+    if m.scheduler == "mpi":
+        from noisepy.seis.io.numpystore import NumpyCCStore, NumpyStackStore
+
+        scheduler = MPIScheduler(0)
+        cc_store = NumpyCCStore(os.path.join(work_dir, "ccf"), mode="a")
+        stack_store = NumpyStackStore(os.path.join(work_dir, "stack"), mode="a")
+    else:
+        scheduler = SingleNodeScheduler()
+        # the stacking runs in worker processes that need to see the same stores
+        manager = multiprocessing.get_context("spawn").Manager()
+        cc_store = InMemoryCCStore(manager.dict(), manager.dict())
+        stack_store = InMemoryStackStore(manager.dict())
+
+    t0 = time.time()
+    cross_correlate(raw_store, config, cc_store, scheduler)
+    m.cc_seconds = time.time() - t0
+    t0 = time.time()
+    stack_cross_correlations(cc_store, stack_store, config, scheduler)
+    m.stack_seconds = time.time() - t0
+
+    m.channels = len(raw_store.get_channels(raw_store.timespans[0]))
+    m.pairs = m.stations * (m.stations + 1) // 2
+    m.timespans = len(raw_store.timespans)
+    m.pairs_per_second = m.pairs * m.timespans / m.cc_seconds if m.cc_seconds > 0 else 0.0
+    m.peak_rss_bytes = _peak_rss()
+    return m
+
+
+def _peak_rss() -> int:
+    # of this process only, not of the stacking workers
+    try:
+        import resource
+
+        # kilobytes on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except ImportError:
+        return psutil.Process().memory_info().rss
+
+
+def _run_pinned(args, m: Measurement, queue):
+    if hasattr(os, "sched_setaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+        os.sched_setaffinity(0, cpus[: m.threads])
+    else:
+        logger.warning("Can't pin the benchmark to a number of CPUs on this platform, using all of them")
+    os.environ["OMP_NUM_THREADS"] = str(m.threads)
+    work_dir = tempfile.mkdtemp(prefix="noisepy_scaling_")
+    try:
+        queue.put(asdict(measure(args, m, work_dir)))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def run_single(args, m: Measurement) -> Measurement:
+    # a fresh process for each measurement: no caches or memory left over from the previous one
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    p = ctx.Process(target=_run_pinned, args=(args, m, queue))
+    p.start()
+    result = queue.get()
+    p.join()
+    return Measurement(**result)
+
+
+def run_mpi(args, m: Measurement) -> Optional[Measurement]:
+    from mpi4py import MPI
+
+    comm = MPI.COMM_WORLD
+    work_dir = os.path.join(args.work_dir, f"noisepy_scaling_{m.mode}_{m.stations}_{m.inc_hours}")
+    if comm.Get_rank() == 0:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    comm.Barrier()
+    m = measure(args, m, work_dir)
+    return m if comm.Get_rank() == 0 else None
+
+
+def plan(args) -> List[Measurement]:
+    runs = []
+    base = min(args.stations)
+    for inc_hours in args.inc_hours:
+        # strong scaling: the same problem with more CPUs
+        for nsta in args.stations:
+            for threads in args.threads:
+                runs.append(Measurement("strong", nsta, inc_hours, threads, args.scheduler))
+        # weak scaling: the number of station pairs per CPU stays the same
+        for threads in args.threads:
+            nsta = int(round(base * np.sqrt(threads)))
+            runs.append(Measurement("weak", nsta, inc_hours, threads, args.scheduler))
+    return runs
+
+
+def fit_model(results: List[Measurement], inc_hours: int, threads: int) -> Optional[np.ndarray]:
+    """
+    Least squares fit of ``time = a * channels + b * pairs + c`` for the cross-correlation plus stacking time
+    """
+    rows = [r for r in results if r.inc_hours == inc_hours and r.threads == threads]
+    if len({r.stations for r in rows}) < 3:
+        return None
+    X = np.array([[r.channels * r.timespans, r.pairs * r.timespans, 1.0] for r in rows])
+    y = np.array([r.cc_seconds + r.stack_seconds for r in rows])
+    coeffs, *_ = np.linalg.lstsq(X, y, rcond=None)
+    return coeffs
+
+
+def write_report(args, results: List[Measurement]):
+    with open(args.report + ".json", "w") as f:
+        json.dump([asdict(r) for r in results], f, indent=2)
+    lines = [
+        "# NoisePy scaling benchmark",
+        "",
+        f"{args.samp_freq} Hz, {args.cc_len} s windows, {args.days} day(s) of data, scheduler: {args.scheduler}",
+        "",
+        "| mode | stations | inc_hours | threads | pairs | CC (s) | stack (s) | pairs/s | peak RSS (GB) |",
+        "|---|---|---|---|---|---|---|---|---|",
+    ]
+    for r in results:
+        lines.append(
+            f"| {r.mode} | {r.stations} | {r.inc_hours} | {r.threads} | {r.pairs} | {r.cc_seconds:.1f} | "
+            f"{r.stack_seconds:.1f} | {r.pairs_per_second:.1f} | {r.peak_rss_bytes / 1024**3:.2f} |"
+        )
+    if args.predict:
+        lines += ["", "## Predictions", ""]
+        lines += ["| inc_hours | threads | stations | predicted time (s) |", "|---|---|---|---|"]
+        for inc_hours in args.inc_hours:
+            for threads in args.threads:
+                coeffs = fit_model([r for r in results if r.mode == "strong"], inc_hours, threads)
+                if coeffs is None:
+                    continue
+                ntimespans = max(1, int(args.days * 24 / inc_hours))
+                for nsta in args.predict:
+                    pairs = nsta * (nsta + 1) // 2
+                    t = coeffs @ np.array([3 * nsta * ntimespans, pairs * ntimespans, 1.0])
+                    lines.append(f"| {inc_hours} | {threads} | {nsta} | {t:.0f} |")
+    with open(args.report + ".md", "w") as f:
+        f.write("\n".join(lines) + "\n")
+    print("\n".join(lines))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--stations", type=int, nargs="+", default=[10, 20, 40])
+    parser.add_argument("--inc-hours", type=int, nargs="+", default=[24])
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, os.cpu_count()])
+    parser.add_argument("--scheduler", choices=["single", "mpi"], default="single")
+    parser.add_argument("--days", type=int, default=1, help="days of synthetic data")
+    parser.add_argument("--samp-freq", type=float, default=20.0)
+    parser.add_argument("--cc-len", type=int, default=1800)
+    parser.add_argument("--maxlag", type=int, default=200)
+    parser.add_argument("--predict", type=int, nargs="*", default=[], help="station counts to extrapolate to")
+    parser.add_argument("--report", default="scaling", help="prefix of the .json and .md report files")
+    parser.add_argument("--work-dir", default=tempfile.gettempdir(), help="shared directory for --scheduler mpi")
+    args = parser.parse_args(argv)
+    if args.scheduler == "mpi":
+        from mpi4py import MPI
+
+        # the ranks are the unit of parallelism
+        args.threads = [MPI.COMM_WORLD.Get_size()]
+
+    results = []
+    for m in plan(args):
+        logger.info(f"Running {m}")
+        result = run_mpi(args, m) if args.scheduler == "mpi" else run_single(args, m)
+        if result is not None:
+            results.append(result)
+    if results:
+        write_report(args, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""
+In-memory stores with synthetic data, to run the whole pipeline without any network or disk access
+"""
+import threading
+import zlib
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, MutableMapping, Optional, Tuple
+
+import numpy as np
+import obspy
+from datetimerange import DateTimeRange
+
+from noisepy.seis.io.datatypes import (
+    Channel,
+    ChannelData,
+    ChannelType,
+    CrossCorrelation,
+    Stack,
+    Station,
+)
+from noisepy.seis.io.stores import (
+    CrossCorrelationDataStore,
+    RawDataStore,
+    StackStore,
+    timespan_str,
+)
+
+START = datetime(2021, 1, 1, tzinfo=timezone.utc)
+CHANNELS = ["BHE", "BHN", "BHZ"]
+# apparent velocity (km/s) of the coherent noise between the stations
+VELOCITY = 3.0
+KM_PER_DEGREE = 111.19
+
+
+def synthetic_stations(nsta: int, seed: int = 0, network: str = "XX") -> List[Station]:
+    """
+    Stations spread at random over a ~5x5 degree region, like a regional network
+    """
+    rng = np.random.default_rng(seed)
+    stations = []
+    for i in range(nsta):
+        sta = Station(network, f"S{i:04d}")
+        sta.lat = float(rng.uniform(32.0, 37.0))
+        sta.lon = float(rng.uniform(-121.0, -116.0))
+        sta.elevation = float(rng.uniform(0.0, 2000.0))
+        stations.append(sta)
+    return stations
+
+
+class SyntheticRawDataStore(RawDataStore):
+    """
+    Raw data of ``nsta`` stations with 3 channels each, for ``ndays`` of data split in ``inc_hours`` timespans.
+    The records are the same noise wavefield seen by all the stations with a delay that grows with their
+    distance to a reference point, plus some local noise, so that the correlations have a coherent signal.
+    The data is generated when read and is the same every time.
+    """
+
+    def __init__(self, nsta: int, samp_freq: float = 20.0, inc_hours: int = 24, ndays: int = 1, seed: int = 0) -> None:
+        super().__init__()
+        self.samp_freq = samp_freq
+        self.inc_hours = inc_hours
+        self.seed = seed
+        self.stations = synthetic_stations(nsta, seed)
+        nspans = max(1, int(ndays * 24 / inc_hours))
+        self.timespans = [
+            DateTimeRange(START + timedelta(hours=inc_hours * i), START + timedelta(hours=inc_hours * (i + 1)))
+            for i in range(nspans)
+        ]
+        self.lock = threading.Lock()
+        self.wavefields: Dict[str, np.ndarray] = {}
+
+    def get_timespans(self) -> List[DateTimeRange]:
+        return list(self.timespans)
+
+    def get_channels(self, timespan: DateTimeRange) -> List[Channel]:
+        return [Channel(ChannelType(name), sta) for sta in self.stations for name in CHANNELS]
+
+    def get_inventory(self, timespan: DateTimeRange, station: Station) -> obspy.Inventory:
+        return obspy.Inventory()
+
+    def read_data(self, timespan: DateTimeRange, chan: Channel) -> ChannelData:
+        npts = int(self.inc_hours * 3600 * self.samp_freq)
+        wavefield = self._wavefield(timespan, npts)
+        # delay proportional to the distance to the south-west corner of the region
+        dist = KM_PER_DEGREE * np.hypot(chan.station.lat - 32.0, chan.station.lon + 121.0)
+        shift = int(dist / VELOCITY * self.samp_freq)
+        rng = np.random.default_rng(zlib.crc32(f"{self.seed}/{timespan_str(timespan)}/{chan}".encode()))
+        data = np.roll(wavefield, shift) + 0.5 * rng.standard_normal(npts, dtype=np.float32)
+        header = {
+            "network": chan.station.network,
+            "station": chan.station.name,
+            "channel": chan.type.name,
+            "sampling_rate": self.samp_freq,
+            "starttime": obspy.UTCDateTime(timespan.start_datetime),
+        }
+        return ChannelData(obspy.Stream([obspy.Trace(data.astype(np.float32), header=header)]))
+
+    def _wavefield(self, timespan: DateTimeRange, npts: int) -> np.ndarray:
+        key = timespan_str(timespan)
+        with self.lock:
+            if key not in self.wavefields:
+                # only keep the wavefield of the timespan being read
+                self.wavefields.clear()
+                rng = np.random.default_rng(zlib.crc32(f"{self.seed}/{key}".encode()))
+                self.wavefields[key] = rng.standard_normal(npts, dtype=np.float32)
+            return self.wavefields[key]
+
+
+class InMemoryCCStore(CrossCorrelationDataStore):
+    """
+    Cross-correlations kept in memory. Pass ``multiprocessing.Manager().dict()`` objects as the backing
+    mappings to share the store with worker processes, e.g. for the stacking step.
+    """
+
+    def __init__(
+        self,
+        data: Optional[MutableMapping] = None,
+        pairs: Optional[MutableMapping] = None,
+    ) -> None:
+        super().__init__()
+        # (src, rec, timespan) -> (timespan, cross-correlations)
+        self.data = data if data is not None else {}
+        # (src, rec) -> (src station, rec station)
+        self.pairs = pairs if pairs is not None else {}
+
+    def contains(self, src: Station, rec: Station, timespan: DateTimeRange) -> bool:
+        return (str(src), str(rec), timespan_str(timespan)) in self.data
+
+    def append(self, timespan: DateTimeRange, src: Station, rec: Station, ccs: List[CrossCorrelation]):
+        self.data[(str(src), str(rec), timespan_str(timespan))] = (timespan, ccs)
+        self.pairs[(str(src), str(rec))] = (src, rec)
+
+    def get_timespans(self, src: Station, rec: Station) -> List[DateTimeRange]:
+        keys = [k for k in self.data.keys() if k[0] == str(src) and k[1] == str(rec)]
+        return [self.data[k][0] for k in sorted(keys)]
+
+    def get_station_pairs(self) -> List[Tuple[Station, Station]]:
+        return list(self.pairs.values())
+
+    def read(self, timespan: DateTimeRange, src: Station, rec: Station) -> List[CrossCorrelation]:
+        item = self.data.get((str(src), str(rec), timespan_str(timespan)))
+        return item[1] if item is not None else []
+
+
+class InMemoryStackStore(StackStore):
+    """
+    Stacks kept in memory, see ``InMemoryCCStore`` for sharing it with worker processes
+    """
+
+    def __init__(self, data: Optional[MutableMapping] = None) -> None:
+        super().__init__()
+        # (src, rec, timespan) -> (src station, rec station, timespan, stacks)
+        self.data = data if data is not None else {}
+
+    def contains(self, src: Station, rec: Station, timespan: DateTimeRange) -> bool:
+        return (str(src), str(rec), timespan_str(timespan)) in self.data
+
+    def append(self, timespan: DateTimeRange, src: Station, rec: Station, stacks: List[Stack]):
+        self.data[(str(src), str(rec), timespan_str(timespan))] = (src, rec, timespan, stacks)
+
+    def get_station_pairs(self) -> List[Tuple[Station, Station]]:
+        return list({(v[0], v[1]) for v in self.data.values()})
+
+    def get_timespans(self, src: Station, rec: Station) -> List[DateTimeRange]:
+        return [v[2] for k, v in self.data.items() if k[0] == str(src) and k[1] == str(rec)]
+
+    def read(self, timespan: DateTimeRange, src: Station, rec: Station) -> List[Stack]:
+        item = self.data.get((str(src), str(rec), timespan_str(timespan)))
+        return item[3] if item is not None else []
@@ -0,0 +1,107 @@
+"""
+Benchmarks of the noise_module kernels on synthetic data, see benchmarks/README.md
+"""
+import numpy as np
+import pytest
+from scipy.fftpack import next_fast_len
+
+from noisepy.seis.io.datatypes import (
+    CCMethod,
+    ChannelData,
+    ConfigParameters,
+    FreqNorm,
+    StackMethod,
+    TimeNorm,
+)
+from noisepy.seis.noise_module import (
+    correlate,
+    cut_trace_make_stat,
+    demean,
+    demean_detrend_taper,
+    detrend,
+    noise_processing,
+    rotation,
+    smooth_source_spect,
+    stacking,
+    taper,
+    whiten,
+)
+
+# number of daily correlations stacked together, e.g. a month
+NUM_STACKED = 30
+
+
+def test_cut_trace_make_stat(benchmark, config: ConfigParameters, ch_data: ChannelData):
+    trace_stdS, dataS_t, dataS = benchmark(cut_trace_make_stat, config, ch_data)
+    assert dataS.shape[1] == int(config.cc_len * config.samp_freq)
+
+
+def test_demean_detrend_taper(benchmark, segments: np.ndarray):
+    out = benchmark(demean_detrend_taper, segments)
+    assert out.shape == segments.shape
+
+
+def test_demean_detrend_taper_reference(benchmark, segments: np.ndarray):
+    # the separate functions, modifying a copy of the segments
+    out = benchmark(lambda: taper(detrend(demean(segments.copy()))))
+    assert out.shape == segments.shape
+
+
+@pytest.mark.parametrize("time_norm", [TimeNorm.NO, TimeNorm.ONE_BIT, TimeNorm.RMA])
+@pytest.mark.parametrize("freq_norm", [FreqNorm.NO, FreqNorm.RMA, FreqNorm.PHASE_ONLY])
+def test_noise_processing(
+    benchmark, config: ConfigParameters, segments: np.ndarray, time_norm: TimeNorm, freq_norm: FreqNorm
+):
+    config = config.model_copy(update={"time_norm": time_norm, "freq_norm": freq_norm})
+    spectra = benchmark(noise_processing, config, segments)
+    assert spectra.shape[0] == segments.shape[0]
+
+
+@pytest.mark.parametrize("freq_norm", [FreqNorm.RMA, FreqNorm.PHASE_ONLY])
+def test_whiten(benchmark, config: ConfigParameters, segments: np.ndarray, freq_norm: FreqNorm):
+    config = config.model_copy(update={"freq_norm": freq_norm})
+    spectra = benchmark(whiten, segments, config)
+    assert spectra.shape[0] == segments.shape[0]
+
+
+def _spectra(config: ConfigParameters, segments: np.ndarray):
+    config = config.model_copy(update={"freq_norm": FreqNorm.RMA, "time_norm": TimeNorm.NO})
+    Nfft = int(next_fast_len(segments.shape[1]))
+    spectra = noise_processing(config, segments)[:, : Nfft // 2].astype(np.complex64)
+    return spectra, Nfft
+
+
+@pytest.mark.parametrize("cc_method", [CCMethod.XCORR, CCMethod.COHERENCY, CCMethod.DECONV])
+@pytest.mark.parametrize("substack", ["none", "windows", "2windows"])
+def test_correlate(benchmark, config: ConfigParameters, segments: np.ndarray, cc_method: CCMethod, substack: str):
+    # no sub-stacks, one per window or one per two windows
+    substack_len = 2 * config.cc_len if substack == "2windows" else config.cc_len
+    config = config.model_copy(
+        update={"cc_method": cc_method, "substack": substack != "none", "substack_len": substack_len}
+    )
+    fft1, Nfft = _spectra(config, segments)
+    fft2 = np.roll(fft1, 1, axis=0)
+    sfft1 = smooth_source_spect(config, fft1)
+    dataS_t = config.step * np.arange(segments.shape[0])
+    corr, tcorr, ncorr = benchmark(correlate, sfft1, fft2, config, Nfft, dataS_t)
+    assert corr.shape[-1] == 2 * int(config.maxlag * config.samp_freq) + 1
+
+
+@pytest.mark.parametrize("stack_method", list(StackMethod))
+def test_stacking(benchmark, config: ConfigParameters, stack_method: StackMethod):
+    config = config.model_copy(update={"stack_method": stack_method})
+    npts = 2 * int(config.maxlag * config.samp_freq) + 1
+    rng = np.random.default_rng(2)
+    cc_array = rng.standard_normal((NUM_STACKED, npts)).astype(np.float32) + np.hanning(npts).astype(np.float32)
+    cc_time = np.arange(NUM_STACKED, dtype=np.float32) * 86400
+    cc_ngood = np.ones(NUM_STACKED, dtype=np.int16)
+    results = benchmark(stacking, cc_array, cc_time, cc_ngood, config)
+    assert results[-1] > 0
+
+
+def test_rotation(benchmark, config: ConfigParameters):
+    npts = 2 * int(config.maxlag * config.samp_freq) + 1
+    bigstack = np.random.default_rng(3).standard_normal((9, npts)).astype(np.float32)
+    parameters = {"azi": 30.0, "baz": 210.0, "station_source": "CI.BAK", "station_receiver": "CI.SVD"}
+    rotated = benchmark(rotation, bigstack, parameters, [])
+    assert rotated.shape == bigstack.shape
@@ -0,0 +1,64 @@
+"""
+Small end-to-end benchmark on the synthetic stores, see scaling.py for the scaling runs
+"""
+import multiprocessing
+from datetime import timedelta
+
+import pytest
+from synthetic import START, InMemoryCCStore, InMemoryStackStore, SyntheticRawDataStore
+
+from noisepy.seis import cross_correlate, stack_cross_correlations
+from noisepy.seis.datatypes import ConfigParameters
+from noisepy.seis.io.datatypes import RmResp
+
+NSTA = 4
+
+
+@pytest.fixture(scope="module")
+def manager():
+    with multiprocessing.get_context("spawn").Manager() as manager:
+        yield manager
+
+
+def _config() -> ConfigParameters:
+    return ConfigParameters(
+        samp_freq=5.0,
+        inc_hours=6,
+        cc_len=1800,
+        step=450.0,
+        maxlag=100,
+        rm_resp=RmResp.NO,
+        start_date=START,
+        end_date=START + timedelta(days=1),
+        stations=["*"],
+        net_list=["*"],
+    )
+
+
+def test_cross_correlate(benchmark, manager):
+    config = _config()
+    raw_store = SyntheticRawDataStore(NSTA, config.samp_freq, config.inc_hours)
+
+    def run():
+        cc_store = InMemoryCCStore(manager.dict(), manager.dict())
+        cross_correlate(raw_store, config, cc_store)
+        return cc_store
+
+    cc_store = benchmark.pedantic(run, rounds=1)
+    assert len(cc_store.get_station_pairs()) == NSTA * (NSTA + 1) // 2
+    assert len(cc_store.get_timespans(*cc_store.get_station_pairs()[0])) == 4
+
+
+def test_stack_cross_correlations(benchmark, manager):
+    config = _config()
+    raw_store = SyntheticRawDataStore(NSTA, config.samp_freq, config.inc_hours)
+    cc_store = InMemoryCCStore(manager.dict(), manager.dict())
+    cross_correlate(raw_store, config, cc_store)
+
+    def run():
+        stack_store = InMemoryStackStore(manager.dict())
+        stack_cross_correlations(cc_store, stack_store, config)
+        return stack_store
+
+    stack_store = benchmark.pedantic(run, rounds=1)
+    assert len(stack_store.get_station_pairs()) >= NSTA * (NSTA - 1) // 2
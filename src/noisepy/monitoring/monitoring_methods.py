@@ -6,6 +6,8 @@ import scipy
 from obspy.signal.invsim import cosine_taper
 from obspy.signal.regression import linear_regression
 
+from noisepy.seis import fftbackend
+
 logger = logging.getLogger(__name__)
 
 """
@@ -368,8 +370,8 @@ def mwcs_dvv(ref, cur, moving_window_length, slide_step, para, smoothing_half_wi
         maxind += int(slide_step / dt)
 
         # do fft
-        fcur = scipy.fftpack.fft(cci, n=padd)[: padd // 2]
-        fref = scipy.fftpack.fft(cri, n=padd)[: padd // 2]
+        fcur = fftbackend.fft(cci, padd)[: padd // 2]
+        fref = fftbackend.fft(cri, padd)[: padd // 2]
 
         fcur2 = np.real(fcur) ** 2 + np.imag(fcur) ** 2
         fref2 = np.real(fref) ** 2 + np.imag(fref) ** 2
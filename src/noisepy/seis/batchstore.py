@@ -0,0 +1,143 @@
+import logging
+import threading
+from typing import Any, Callable, Dict, Hashable, List
+
+import obspy
+from datetimerange import DateTimeRange
+
+from noisepy.seis.io.datatypes import Channel, ChannelData, Station
+from noisepy.seis.io.stores import RawDataStore, timespan_str
+
+logger = logging.getLogger(__name__)
+
+
+def timespan_batches(timespans: List[DateTimeRange], batch_size: int) -> List[List[DateTimeRange]]:
+    """
+    Groups the timespans in batches of at most ``batch_size`` consecutive ones, i.e. each one starting where
+    the previous one ends. The order of the timespans is kept.
+    """
+    batches: List[List[DateTimeRange]] = []
+    for ts in timespans:
+        if len(batches) > 0 and len(batches[-1]) < batch_size and batches[-1][-1].end_datetime == ts.start_datetime:
+            batches[-1].append(ts)
+        else:
+            batches.append([ts])
+    return batches
+
+
+class BatchedRawDataStore(RawDataStore):
+    """
+    Shares the raw data read for the timespans of each batch: the wrapped store is asked for each timespan, but
+    when what it returned for an earlier timespan of the batch already covers the current one, that data is
+    sliced instead of being read again. With e.g. ``inc_hours: 1`` and a store that returns the daily miniSEED
+    file of the hour, a day of hourly timespans decodes each file once instead of 24 times. The channels and
+    inventories are always those the wrapped store lists for the timespan, so a store that only serves its own
+    timespans (e.g. whole days) is read as without batching.
+
+    What was read for a batch is kept until ``done`` has been called for all of its timespans. The timespans
+    that are not in a batch of at least two are passed through to the wrapped store.
+    """
+
+    def __init__(self, store: RawDataStore, batches: List[List[DateTimeRange]]) -> None:
+        super().__init__()
+        self.store = store
+        # batch range by timespan
+        self.spans: Dict[str, DateTimeRange] = {}
+        # timespans of each batch that are not done yet
+        self.remaining: Dict[str, int] = {}
+        for batch in batches:
+            if len(batch) < 2:
+                continue
+            span = DateTimeRange(batch[0].start_datetime, batch[-1].end_datetime)
+            for ts in batch:
+                self.spans[timespan_str(ts)] = span
+            self.remaining[timespan_str(span)] = len(batch)
+        self.lock = threading.Lock()
+        # values read for each batch, by batch range and key
+        self.values: Dict[str, Dict[Hashable, Any]] = {}
+        self.key_locks: Dict[str, Dict[Hashable, threading.Lock]] = {}
+
+    def shared(self, ts: DateTimeRange, key: Hashable, compute: Callable[[], Any]) -> Any:
+        """
+        The value of ``key`` for the batch of ``ts``, computed by the first timespan of the batch that asks for
+        it. Concurrent requests for the same key wait for that computation, other keys are computed in parallel.
+        """
+        span = self.spans.get(timespan_str(ts))
+        if span is None:
+            return compute()
+        span_key = timespan_str(span)
+        with self.lock:
+            if self.remaining[span_key] <= 0:
+                # read again after the batch was released
+                return compute()
+            values = self.values.setdefault(span_key, {})
+            if key in values:
+                return values[key]
+            key_lock = self.key_locks.setdefault(span_key, {}).setdefault(key, threading.Lock())
+        with key_lock:
+            with self.lock:
+                if key in values:
+                    return values[key]
+            value = compute()
+            with self.lock:
+                # not kept if the batch was done in the meantime
+                if span_key in self.values:
+                    values[key] = value
+            return value
+
+    def done(self, ts: DateTimeRange):
+        """
+        Records that ``ts`` is processed, the data of its batch is released after its last timespan
+        """
+        span = self.spans.get(timespan_str(ts))
+        if span is None:
+            return
+        span_key = timespan_str(span)
+        with self.lock:
+            self.remaining[span_key] -= 1
+            if self.remaining[span_key] <= 0:
+                self.values.pop(span_key, None)
+                self.key_locks.pop(span_key, None)
+
+    def get_timespans(self) -> List[DateTimeRange]:
+        return self.store.get_timespans()
+
+    def get_channels(self, timespan: DateTimeRange) -> List[Channel]:
+        return self.store.get_channels(timespan)
+
+    def get_inventory(self, timespan: DateTimeRange, station: Station) -> obspy.Inventory:
+        return self.store.get_inventory(timespan, station)
+
+    def read_data(self, timespan: DateTimeRange, chan: Channel) -> ChannelData:
+        if timespan_str(timespan) not in self.spans:
+            return self.store.read_data(timespan, chan)
+        # what was read for the channel in the batch, and a lock so the timespans of the batch don't read it twice
+        reads, lock = self.shared(timespan, ("data", str(chan)), lambda: ([], threading.Lock()))
+        with lock:
+            ch_data = next((cd for cd in reads if _covers(cd.stream, timespan)), None)
+            if ch_data is None:
+                ch_data = self.store.read_data(timespan, chan)
+                if ch_data.data.size == 0:
+                    return ch_data
+                reads.append(ch_data)
+        # the traces of the slice are views of the batch data, the pre-processing works on a copy. The end of the
+        # timespan is the start of the next one, its sample is left to that one
+        end = obspy.UTCDateTime(timespan.end_datetime) - ch_data.stream[0].stats.delta
+        stream = ch_data.stream.slice(obspy.UTCDateTime(timespan.start_datetime), end)
+        if len(stream) == 0:
+            return ChannelData.empty()
+        return ChannelData(stream)
+
+
+def _covers(stream: obspy.Stream, timespan: DateTimeRange) -> bool:
+    """
+    Whether the stream starts before the timespan and ends at its last sample or after
+    """
+    if len(stream) == 0:
+        return False
+    start = min(tr.stats.starttime for tr in stream)
+    end = max(tr.stats.endtime for tr in stream)
+    delta = stream[0].stats.delta
+    return start <= obspy.UTCDateTime(timespan.start_datetime) and end >= (
+        obspy.UTCDateTime(timespan.end_datetime) - delta
+    )
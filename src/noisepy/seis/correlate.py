@@ -2,9 +2,22 @@ import gc
 import logging
 import os
 import sys
+import tempfile
+import threading
+import time
 from collections import OrderedDict, defaultdict
-from concurrent.futures import Executor, Future, ThreadPoolExecutor
-from typing import Callable, Dict, List, Optional, Tuple
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from dataclasses import dataclass
+from multiprocessing import get_context
+from typing import Callable, Collection, Dict, Hashable, List, Optional, Tuple
 
 import numpy as np
 import obspy
@@ -15,16 +28,31 @@ from noisepy.seis.io.datatypes import (
     CCMethod,
     Channel,
     ChannelData,
-    ConfigParameters,
     CrossCorrelation,
+    FreqNorm,
     NoiseFFT,
     Station,
 )
 from noisepy.seis.io.stores import CrossCorrelationDataStore, RawDataStore
 from noisepy.seis.io.utils import TimeLogger, get_results
 
-from . import noise_module
+from . import fftbackend, noise_module, sharedmem
+from .batchstore import BatchedRawDataStore, timespan_batches
 from .constants import NO_DATA_MSG
+from .datatypes import (
+    CCEngine,
+    CCExecutor,
+    ConfigParameters,
+    PreprocessEngine,
+    SpectralNorms,
+    band_offset,
+    make_noise_fft,
+)
+from .fftstore import NumpyFFTStore
+from .geometry import StationGeometry
+from .ledger import STEP_CC, CompletionLedger, selection_key
+from .metrics import Metrics, create_metrics
+from .response import shared_response_cache
 from .scheduler import Scheduler, SingleNodeScheduler
 
 logger = logging.getLogger(__name__)
@@ -87,6 +115,10 @@ def cross_correlate(
     tlog = TimeLogger(logger, logging.INFO, prefix="CC Main")
     t_s1_total = tlog.reset()
     logger.info(f"Starting Cross-Correlation with {os.cpu_count()} cores")
+    run_metrics = create_metrics(fft_params)
+    fftbackend.configure(fft_params)
+    # one record per timespan, written to the same sink as the one for the whole run
+    metrics = Metrics(run_metrics.sink)
 
     def init() -> List:
         # set variables to broadcast
@@ -96,14 +128,70 @@ def cross_correlate(
         return [timespans]
 
     [timespans] = scheduler.initialize(init, 1)
+    # the worker processes are started once and reused for all the timespans
+    process_executor = _process_executor(fft_params)
+    fft_store = None
+    if fft_params.fft_store_path:
+        fft_store = NumpyFFTStore(fft_params.fft_store_path, fft_params, fft_params.storage_options)
+    # distances and azimuths of the station pairs, shared by all the timespans
+    geometry = StationGeometry()
+    # whole batches of consecutive timespans are given to each node
+    batches = timespan_batches(timespans, fft_params.timespan_batch)
+    node_timespans = [ts for ib in scheduler.get_indices(batches) for ts in batches[ib]]
+    ledger = None
+    if fft_params.ledger_path:
+        # the timespans already done for the same channels and pairs are skipped once their channels are listed
+        ledger = CompletionLedger(fft_params.ledger_path)
+    batched_store = None
+    executor = None
+    if fft_params.timespan_batch > 1:
+        batched_store = BatchedRawDataStore(raw_store, timespan_batches(node_timespans, fft_params.timespan_batch))
+        raw_store = batched_store
+        # the threads are reused by all the timespans
+        executor = ThreadPoolExecutor()
+    prefetcher = None
+    if fft_params.prefetch_depth > 0:
+        prefetcher = TimespanPrefetcher(
+            raw_store, fft_params, cc_store, node_timespans, pair_filter, fft_store, geometry, ledger
+        )
     failed = []
-    for its in scheduler.get_indices(timespans):
-        ts = timespans[its]
-        failed_pairs = cc_timespan(raw_store, fft_params, cc_store, ts, pair_filter)
+    for its, ts in enumerate(node_timespans):
+        work = prefetcher.get(its) if prefetcher else None
+        failed_pairs = cc_timespan(
+            raw_store,
+            fft_params,
+            cc_store,
+            ts,
+            pair_filter,
+            process_executor,
+            fft_store,
+            work,
+            geometry,
+            ledger,
+            metrics,
+            executor,
+        )
+        if batched_store is not None:
+            batched_store.done(ts)
         if len(failed_pairs) > 0:
             failed.extend((ts, failed_pairs))
-
+        metrics.count("failed_pairs", len(failed_pairs))
+        cc_time = metrics.timers.get("correlate", 0.0) + metrics.timers.get("save", 0.0)
+        if cc_time > 0:
+            metrics.gauge("pairs_per_second", metrics.counters.get("correlated_pairs", 0) / cc_time)
+        run_metrics.count("timespans")
+        run_metrics.count("failed_pairs", len(failed_pairs))
+        metrics.emit("cross_correlate_timespan", timespan=str(ts))
+    if prefetcher is not None:
+        prefetcher.shutdown()
+    if executor is not None:
+        executor.shutdown()
+    if process_executor is not None:
+        process_executor.shutdown()
+
+    fftbackend.get_backend().save_wisdom()
     tlog.log(f"Step 1 in total with {os.cpu_count()} cores", t_s1_total)
+    run_metrics.emit("cross_correlate")
     if len(failed):
         failed_str = "\n".join(map(str, failed))
         logger.error(
@@ -112,21 +200,187 @@ def cross_correlate(
         )
 
 
+@dataclass
+class TimespanWork:
+    """
+    What is left to do for a timespan: the station pairs that are not in the store yet and the channels
+    they need. ``ch_data`` holds the raw data of the channels when it was read ahead of time. ``pair_count``
+    is the number of station pairs of the timespan, done or not, and ``selection`` the ledger key of its
+    channels and pairs.
+    """
+
+    missing_pairs: List[Tuple[Station, Station]]
+    channels: List[Channel]
+    ch_data: Optional[List[Tuple[Channel, ChannelData]]] = None
+    pair_count: int = 0
+    selection: str = ""
+
+
 def cc_timespan(
     raw_store: RawDataStore,
     fft_params: ConfigParameters,
     cc_store: CrossCorrelationDataStore,
     ts: DateTimeRange,
     pair_filter: Callable[[Channel, Channel], bool] = lambda src, rec: True,
+    process_executor: Optional[Executor] = None,
+    fft_store: Optional[NumpyFFTStore] = None,
+    work: Optional[TimespanWork] = None,
+    geometry: Optional[StationGeometry] = None,
+    ledger: Optional[CompletionLedger] = None,
+    metrics: Optional[Metrics] = None,
+    executor: Optional[Executor] = None,
+) -> List[Tuple[Station, Station]]:
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor()
+    try:
+        return _cc_timespan(
+            raw_store,
+            fft_params,
+            cc_store,
+            ts,
+            pair_filter,
+            process_executor,
+            fft_store,
+            work,
+            geometry,
+            ledger,
+            metrics,
+            executor,
+        )
+    finally:
+        # on every path, e.g. a timespan without data
+        if own_executor:
+            executor.shutdown()
+
+
+def _cc_timespan(
+    raw_store: RawDataStore,
+    fft_params: ConfigParameters,
+    cc_store: CrossCorrelationDataStore,
+    ts: DateTimeRange,
+    pair_filter: Callable[[Channel, Channel], bool],
+    process_executor: Optional[Executor],
+    fft_store: Optional[NumpyFFTStore],
+    work: Optional[TimespanWork],
+    geometry: Optional[StationGeometry],
+    ledger: Optional[CompletionLedger],
+    metrics: Optional[Metrics],
+    executor: Executor,
 ) -> List[Tuple[Station, Station]]:
-    executor = ThreadPoolExecutor()
+    if geometry is None:
+        geometry = StationGeometry()
+    if metrics is None:
+        metrics = Metrics()
     tlog = TimeLogger(logger, logging.INFO, prefix="CC Main")
     """
     LOADING NOISE DATA AND DO FFT
     """
-    nnfft = int(next_fast_len(int(fft_params.cc_len * fft_params.samp_freq)))  # samp_freq should be sampling_rate
 
     t_chunk = tlog.reset()  # for tracking overall chunk processing time
+    if work is None:
+        with metrics.timer("check_done"):
+            work = timespan_work(raw_store, fft_params, cc_store, ts, pair_filter, executor, geometry, ledger)
+    missing_pairs = work.missing_pairs
+    missing_channels = work.channels
+    metrics.count("missing_pairs", len(missing_pairs))
+    metrics.count("channels", len(missing_channels))
+    if len(missing_channels) == 0:
+        if work.pair_count > 0:
+            logger.warning(f"{ts} already completed")
+            _mark_done(ledger, ts, work, [])
+        else:
+            # e.g. its data is not available yet
+            logger.warning(f"No station pairs for {ts}")
+        return []
+
+    memory_size = estimate_memory(fft_params, len(missing_channels))
+    logger.info(f"Require {memory_size:5.2f}gb memory for cross correlations")
+    if memory_size > fft_params.memory_budget:
+        failed_pairs = cc_timespan_tiled(
+            raw_store,
+            fft_params,
+            cc_store,
+            ts,
+            missing_channels,
+            pair_filter,
+            executor,
+            process_executor,
+            fft_store,
+            geometry,
+            ledger,
+            metrics,
+        )
+        tlog.log(f"Process the chunk of {ts}", t_chunk)
+        _mark_done(ledger, ts, work, failed_pairs)
+        return failed_pairs
+
+    loaded = compute_ffts(executor, raw_store, fft_params, ts, missing_channels, fft_store, work.ch_data, metrics)
+    work.ch_data = None
+    if loaded is None:
+        return missing_pairs
+    channels, ffts = loaded
+    Nfft = max(map(lambda d: d.length, ffts.values()), default=0)
+    if Nfft == 0:
+        logger.error(f"No FFT data available for any channel in {ts}, skipping")
+        return missing_pairs
+
+    with metrics.timer("norms"):
+        norms = compute_norms(executor, fft_params, ffts)
+    tlog.log(f"Compute spectral normalizations: {len(norms)} channels")
+
+    station_pairs = create_pairs(pair_filter, channels, fft_params, ffts, geometry)
+    work_items = list(station_pairs.items())
+    work_items = sorted(work_items, key=lambda t: t[0][0].name + t[0][1].name)
+    geometry.compute(station_pairs.keys())
+    tlog.log(f"Compute the geometry of {len(station_pairs)} station pairs")
+    failed_pairs = correlate_station_pairs(
+        ts,
+        fft_params,
+        work_items,
+        channels,
+        ffts,
+        norms,
+        Nfft,
+        cc_store,
+        executor,
+        process_executor,
+        geometry,
+        ledger,
+        metrics,
+    )
+
+    ffts.clear()
+    norms.clear()
+    gc.collect()
+
+    tlog.log(f"Process the chunk of {ts}", t_chunk)
+    _mark_done(ledger, ts, work, failed_pairs)
+    return failed_pairs
+
+
+def _mark_done(
+    ledger: Optional[CompletionLedger],
+    ts: DateTimeRange,
+    work: TimespanWork,
+    failed_pairs: List[Tuple[Station, Station]],
+):
+    # only when there were pairs to do and they are all done, a timespan without data may get some later
+    if ledger is not None and work.pair_count > 0 and len(failed_pairs) == 0:
+        ledger.mark_timespan(STEP_CC, ts, work.selection)
+
+
+def timespan_work(
+    raw_store: RawDataStore,
+    fft_params: ConfigParameters,
+    cc_store: CrossCorrelationDataStore,
+    ts: DateTimeRange,
+    pair_filter: Callable[[Channel, Channel], bool],
+    executor: Executor,
+    geometry: Optional[StationGeometry] = None,
+    ledger: Optional[CompletionLedger] = None,
+) -> TimespanWork:
+    tlog = TimeLogger(logger, logging.INFO, prefix="CC Main")
     all_channels = raw_store.get_channels(ts)
     all_channel_count = len(all_channels)
     tlog.log(f"get {all_channel_count} channels")
@@ -138,16 +392,34 @@ def cc_timespan(
             f"Using {len(all_channels)}/{all_channel_count}"
         )
     tlog.reset()
-    station_pairs = list(create_pairs(pair_filter, all_channels, fft_params.acorr_only).keys())
+    # the timespans of a batch with the same channels have the same pairs
+    station_pairs = _batch_shared(
+        raw_store,
+        ts,
+        ("station_pairs", tuple(sorted(map(str, all_channels)))),
+        lambda: list(create_pairs(pair_filter, all_channels, fft_params, geometry=geometry).keys()),
+    )
+    selection = selection_key(all_channels, station_pairs)
+    if ledger is not None and len(station_pairs) > 0 and ledger.timespan_done(STEP_CC, ts, selection):
+        logger.info(f"{ts} already done for its {len(station_pairs)} pairs")
+        return TimespanWork([], [], pair_count=len(station_pairs), selection=selection)
+    # Only the pairs not recorded in the ledger need to be looked up in the store
+    unknown_pairs = station_pairs
+    if ledger is not None:
+        recorded, unknown_pairs = ledger.filter_done(STEP_CC, ts, station_pairs)
+        tlog.log(f"check the ledger: {len(recorded)}/{len(station_pairs)} pairs already done")
     # Check for stations that are already done, do this in parallel
-    logger.info(f"Checking for stations already done: {len(station_pairs)} pairs")
+    logger.info(f"Checking for stations already done: {len(unknown_pairs)} pairs")
 
-    stations = set([station for pair in station_pairs for station in pair])
+    stations = set([station for pair in unknown_pairs for station in pair])
     _ = list(executor.map(lambda s: cc_store.contains(s, s, ts), stations))
     tlog.log(f"check for {len(stations)} stations already done (warm up cache)")
-    station_pair_dones = list(executor.map(lambda p: cc_store.contains(p[0], p[1], ts), station_pairs))
+    station_pair_dones = list(executor.map(lambda p: cc_store.contains(p[0], p[1], ts), unknown_pairs))
+    if ledger is not None:
+        # record the pairs found in the store so the next run doesn't check them again
+        ledger.mark_pairs(STEP_CC, ts, [pair for pair, done in zip(unknown_pairs, station_pair_dones) if done])
 
-    missing_pairs = [pair for pair, done in zip(station_pairs, station_pair_dones) if not done]
+    missing_pairs = [pair for pair, done in zip(unknown_pairs, station_pair_dones) if not done]
     # get a set of unique stations from the list of pairs
     missing_stations = set([station for pair in missing_pairs for station in pair])
     # Filter the channels to only the missing stations
@@ -160,129 +432,568 @@ def cc_timespan(
         f"{len(missing_pairs)}/{len(station_pairs)} pairs "
         f"for {ts}"
     )
-    if len(missing_channels) == 0:
-        logger.warning(f"{ts} already completed")
-        return []
+    return TimespanWork(missing_pairs, missing_channels, pair_count=len(station_pairs), selection=selection)
 
-    ch_data_tuples = _read_channels(
-        executor, ts, raw_store, missing_channels, fft_params.samp_freq, fft_params.single_freq
-    )
+
+def _batch_shared(raw_store: RawDataStore, ts: DateTimeRange, key: Hashable, compute: Callable[[], List]) -> List:
+    if isinstance(raw_store, BatchedRawDataStore):
+        return raw_store.shared(ts, key, compute)
+    return compute()
+
+
+class TimespanPrefetcher:
+    """
+    Gets the work of the next timespans ready in the background while the current one is being processed:
+    lists the channels still to do and reads their raw data. At most ``prefetch_depth`` timespans are read
+    ahead, and only while the size of the raw data read ahead stays under ``prefetch_memory``.
+    """
+
+    def __init__(
+        self,
+        raw_store: RawDataStore,
+        fft_params: ConfigParameters,
+        cc_store: CrossCorrelationDataStore,
+        timespans: List[DateTimeRange],
+        pair_filter: Callable[[Channel, Channel], bool],
+        fft_store: Optional[NumpyFFTStore] = None,
+        geometry: Optional[StationGeometry] = None,
+        ledger: Optional[CompletionLedger] = None,
+    ):
+        self.raw_store = raw_store
+        self.fft_params = fft_params
+        self.cc_store = cc_store
+        self.timespans = timespans
+        self.pair_filter = pair_filter
+        self.fft_store = fft_store
+        self.geometry = geometry
+        self.ledger = ledger
+        # one timespan at a time, the reads of a timespan are parallelized
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.futures: Dict[int, Future] = {}
+        # size (GB) of the raw data read ahead, by timespan index
+        self.sizes: Dict[int, float] = {}
+        self.lock = threading.Lock()
+
+    def get(self, its: int) -> Optional[TimespanWork]:
+        """
+        Returns the work of the its-th timespan if it was prefetched, and starts prefetching the next ones
+        """
+        future = self.futures.pop(its, None)
+        work = None
+        if future is not None:
+            try:
+                work = future.result()
+            except Exception as e:
+                logger.error(f"Error prefetching {self.timespans[its]}: {e}")
+        with self.lock:
+            self.sizes.pop(its, None)
+        for inext in range(its + 1, min(its + 1 + self.fft_params.prefetch_depth, len(self.timespans))):
+            if inext not in self.futures:
+                self.futures[inext] = self.executor.submit(self._prefetch, inext)
+        return work
+
+    def shutdown(self):
+        for future in self.futures.values():
+            future.cancel()
+        self.futures.clear()
+        self.executor.shutdown()
+
+    def _prefetch(self, its: int) -> TimespanWork:
+        ts = self.timespans[its]
+        executor = ThreadPoolExecutor()
+        try:
+            work = timespan_work(
+                self.raw_store,
+                self.fft_params,
+                self.cc_store,
+                ts,
+                self.pair_filter,
+                executor,
+                self.geometry,
+                self.ledger,
+            )
+            fft_size = estimate_memory(self.fft_params, len(work.channels))
+            if len(work.channels) == 0 or fft_size > self.fft_params.memory_budget:
+                # nothing to do or it will be processed in tiles, one block at a time
+                return work
+            with self.lock:
+                if sum(self.sizes.values()) >= self.fft_params.prefetch_memory:
+                    logger.info(f"Not reading {ts} ahead, {self.fft_params.prefetch_memory}gb are already read ahead")
+                    return work
+            channels = work.channels
+            if self.fft_store is not None:
+                channels = [ch for ch in channels if not self.fft_store.contains(ts, ch)]
+            ch_data = _read_channels(
+                executor, ts, self.raw_store, channels, self.fft_params.samp_freq, self.fft_params.single_freq
+            )
+            # the raw data can be much larger than its FFTs, e.g. when recorded at a higher rate than samp_freq
+            size = sum(tr.data.nbytes for _, cd in ch_data for tr in cd.stream) / 1024**3
+            with self.lock:
+                if sum(self.sizes.values()) + size > self.fft_params.prefetch_memory:
+                    logger.info(
+                        f"Not keeping {ts} ahead, its {size:.2f}gb of raw data would exceed "
+                        f"{self.fft_params.prefetch_memory}gb"
+                    )
+                    return work
+                self.sizes[its] = size
+            work.ch_data = ch_data
+            logger.info(f"Read {len(work.ch_data)} channels ({size:.2f}gb) ahead for {ts}")
+            return work
+        finally:
+            executor.shutdown()
+
+
+def compute_ffts(
+    executor: Executor,
+    raw_store: RawDataStore,
+    fft_params: ConfigParameters,
+    ts: DateTimeRange,
+    channels: List[Channel],
+    fft_store: Optional[NumpyFFTStore] = None,
+    ch_data: Optional[List[Tuple[Channel, ChannelData]]] = None,
+    metrics: Optional[Metrics] = None,
+) -> Optional[Tuple[List[Channel], Dict[int, NoiseFFT]]]:
+    """
+    Reads, pre-processes and computes the FFTs of the channels' data. When an ``fft_store`` is given, the FFTs
+    found in it are used as is and the ones computed are added to it. ``ch_data`` is the raw data of the
+    channels if it was already read.
+
+    Returns:
+        The channels left after pre-processing and the FFTs, keyed by index in that list (only for
+        the channels with FFT data). None if there is no data left.
+    """
+    tlog = TimeLogger(logger, logging.INFO, prefix="CC Main")
+    if metrics is None:
+        metrics = Metrics()
+    # FFTs keyed by position in channels
+    fft_datas: Dict[int, NoiseFFT] = {}
+    if fft_store is not None:
+        with metrics.timer("fft_store_read"):
+            cached_refs = [executor.submit(fft_store.read, ts, ch) for ch in channels]
+            cached = get_results(cached_refs, "Read stored FFTs")
+        fft_datas = {i: fft for i, fft in enumerate(cached) if fft is not None}
+        metrics.count("fft_store_hits", len(fft_datas))
+        tlog.log(f"Read {len(fft_datas)}/{len(channels)} FFTs from the store")
+    missing = [ch for i, ch in enumerate(channels) if i not in fft_datas]
+    if len(missing) > 0:
+        computed = _compute_channel_ffts(executor, raw_store, fft_params, ts, missing, ch_data, metrics)
+        positions = {id(ch): i for i, ch in enumerate(channels)}
+        for ch, fft in computed:
+            fft_datas[positions[id(ch)]] = fft
+        if fft_store is not None:
+            with metrics.timer("fft_store_write"):
+                save_refs = [executor.submit(fft_store.append, ts, ch, fft) for ch, fft in computed]
+                _ = get_results(save_refs, "Save FFTs")
+            tlog.log(f"Saved {len(computed)} FFTs to the store")
+    if len(fft_datas) == 0:
+        return None
+
+    # keep the channels in their original order
+    kept = sorted(fft_datas.keys())
+    # Dictionary to store all the FFTs, keyed by channel index
+    ffts: Dict[int, NoiseFFT] = OrderedDict()
+    for ix_ch, i in enumerate(kept):
+        if fft_datas[i].fft.size > 0:
+            ffts[ix_ch] = fft_datas[i]
+        else:
+            logger.warning(f"No data available for channel '{channels[i]}', skipped")
+
+    if len(ffts) != len(kept):
+        logger.warning("it seems some stations miss data in download step, but it is OKAY!")
+    return [channels[i] for i in kept], ffts
+
+
+def _compute_channel_ffts(
+    executor: Executor,
+    raw_store: RawDataStore,
+    fft_params: ConfigParameters,
+    ts: DateTimeRange,
+    channels: List[Channel],
+    ch_data: Optional[List[Tuple[Channel, ChannelData]]] = None,
+    metrics: Optional[Metrics] = None,
+) -> List[Tuple[Channel, NoiseFFT]]:
+    tlog = TimeLogger(logger, logging.INFO, prefix="CC Main")
+    if metrics is None:
+        metrics = Metrics()
+    if ch_data is None and fft_params.channels_in_flight > 0:
+        with metrics.timer("stream"):
+            computed = _stream_channel_ffts(executor, raw_store, fft_params, ts, channels, metrics)
+        tlog.log(f"Read, pre-processed and computed the FFTs of {len(computed)} channels")
+        return computed
+    if ch_data is None:
+        with metrics.timer("read"):
+            ch_data_tuples = _read_channels(
+                executor, ts, raw_store, channels, fft_params.samp_freq, fft_params.single_freq
+            )
+    else:
+        ids = set(id(ch) for ch in channels)
+        ch_data_tuples = [t for t in ch_data if id(t[0]) in ids]
     # only the channels we are using
 
     if len(ch_data_tuples) == 0:
         logger.warning(f"No data available for {ts}")
-        return missing_pairs
+        return []
 
+    metrics.count("channels_read", len(ch_data_tuples))
+    metrics.count("read_bytes", sum(chd.data.nbytes for _, chd in ch_data_tuples))
     tlog.log(f"Read channel data: {len(ch_data_tuples)} channels")
-    ch_data_tuples_pre = preprocess_all(executor, ch_data_tuples, raw_store, fft_params, ts)
+    with metrics.timer("preprocess"):
+        ch_data_tuples_pre = preprocess_all(executor, ch_data_tuples, raw_store, fft_params, ts)
     del ch_data_tuples
     tlog.log(f"Preprocess: {len(ch_data_tuples_pre)} channels")
     if len(ch_data_tuples_pre) == 0:
         logger.warning(f"No data available for {ts} after preprocessing")
-        return missing_pairs
-
-    nchannels = len(ch_data_tuples_pre)
-    nseg_chunk = check_memory(fft_params, nchannels)
-    # Dictionary to store all the FFTs, keyed by channel index
-    ffts: Dict[int, NoiseFFT] = OrderedDict()
+        return []
 
-    logger.debug(f"nseg_chunk: {nseg_chunk}, nnfft: {nnfft}")
     # loop through all channels
     tlog.reset()
 
-    fft_refs = [executor.submit(compute_fft, fft_params, chd[1]) for chd in ch_data_tuples_pre]
-    # Important: get the list of channels at this point and not before because some
-    # tuples could have been removed during pre-processing
-    channels = list(zip(*ch_data_tuples_pre))[0]
-    # Done with the raw data, clear it out
-    ch_data_tuples_pre.clear()
-    del ch_data_tuples_pre
-    gc.collect()
-    fft_datas = get_results(fft_refs, "Compute ffts")
-    for ix_ch, fft_data in enumerate(fft_datas):
-        if fft_data.fft.size > 0:
-            ffts[ix_ch] = fft_data
-        else:
-            logger.warning(f"No data available for channel '{channels[ix_ch]}', skipped")
-    tlog.log(f"Compute FFTs: {len(ffts)} channels")
-    Nfft = max(map(lambda d: d.length, fft_datas))
-    if Nfft == 0:
-        logger.error(f"No FFT data available for any channel in {ts}, skipping")
-        return missing_pairs
-
-    if len(ffts) != nchannels:
-        logger.warning("it seems some stations miss data in download step, but it is OKAY!")
+    with metrics.timer("fft"):
+        fft_refs = [executor.submit(compute_fft, fft_params, chd[1]) for chd in ch_data_tuples_pre]
+        # Important: get the list of channels at this point and not before because some
+        # tuples could have been removed during pre-processing
+        channels = list(zip(*ch_data_tuples_pre))[0]
+        # Done with the raw data, clear it out
+        ch_data_tuples_pre.clear()
+        del ch_data_tuples_pre
+        gc.collect()
+        fft_datas = get_results(fft_refs, "Compute ffts")
+    tlog.log(f"Compute FFTs: {len(fft_datas)} channels")
+    return list(zip(channels, fft_datas))
+
+
+def correlate_station_pairs(
+    ts: DateTimeRange,
+    fft_params: ConfigParameters,
+    work_items: List[Tuple[Tuple[Station, Station], List[Tuple[int, int]]]],
+    channels: List[Channel],
+    ffts: Dict[int, NoiseFFT],
+    norms: Dict[int, SpectralNorms],
+    Nfft: int,
+    cc_store: CrossCorrelationDataStore,
+    executor: Executor,
+    process_executor: Optional[Executor] = None,
+    geometry: Optional[StationGeometry] = None,
+    ledger: Optional[CompletionLedger] = None,
+    metrics: Optional[Metrics] = None,
+) -> List[Tuple[Station, Station]]:
+    """
+    Cross-correlates the channel pairs of each station pair and saves them to the store
 
+    Returns:
+        The station pairs that failed
+    """
+    tlog = TimeLogger(logger, logging.INFO, prefix="CC Main")
+    if metrics is None:
+        metrics = Metrics()
+    t_cc = time.time()
     tasks = []
-
-    station_pairs = create_pairs(pair_filter, channels, fft_params.acorr_only, ffts)
-    tlog.reset()
-
     save_exec = ThreadPoolExecutor()
-    work_items = list(station_pairs.items())
-    work_items = sorted(work_items, key=lambda t: t[0][0].name + t[0][1].name)
     logger.info(f"Starting CC with {len(work_items)} station pairs")
-    for station_pair, ch_pairs in work_items:
-        t = executor.submit(
-            stations_cross_correlation,
+    spectra = None
+    stacked = False
+    if fft_params.cc_engine == CCEngine.BATCHED:
+        # the windows are matched by position in the stacked spectra
+        stacked = stackable(ffts, fft_params.reject_windows_early)
+        if not stacked:
+            logger.warning("FFTs of all channels don't have the same windows, falling back to pairwise correlation")
+        elif fft_params.cc_executor != CCExecutor.PROCESS:
+            # for the worker processes, they are stacked directly in shared memory
+            spectra = stack_spectra(ffts)
+    if fft_params.cc_executor == CCExecutor.PROCESS:
+        own_executor = process_executor is None
+        if own_executor:
+            process_executor = _process_executor(fft_params)
+        compute_results = correlate_shared(
             ts,
             fft_params,
-            station_pair[0],
-            station_pair[1],
+            work_items,
             channels,
-            ch_pairs,
             ffts,
+            norms,
+            stacked,
             Nfft,
             cc_store,
+            executor,
+            process_executor,
             save_exec,
+            geometry,
         )
-        tasks.append(t)
-    compute_results = get_results(tasks, "Cross correlation")
+        if own_executor:
+            process_executor.shutdown()
+    elif spectra is not None:
+        blocks = _batch_work_items(work_items, fft_params.cc_batch_size)
+        logger.info(f"Correlating in {len(blocks)} batches of ~{fft_params.cc_batch_size} channel pairs")
+        for block in blocks:
+            t = executor.submit(
+                stations_cross_correlation_batch,
+                ts,
+                fft_params,
+                block,
+                channels,
+                spectra,
+                ffts,
+                norms,
+                Nfft,
+                cc_store,
+                save_exec,
+                geometry,
+            )
+            tasks.append(t)
+        compute_results = [r for results in get_results(tasks, "Cross correlation") for r in results]
+        del spectra
+    else:
+        for station_pair, ch_pairs in work_items:
+            t = executor.submit(
+                stations_cross_correlation,
+                ts,
+                fft_params,
+                station_pair[0],
+                station_pair[1],
+                channels,
+                ch_pairs,
+                ffts,
+                norms,
+                Nfft,
+                cc_store,
+                save_exec,
+                geometry,
+            )
+            tasks.append(t)
+        compute_results = get_results(tasks, "Cross correlation")
+    metrics.add_time("correlate", time.time() - t_cc)
+    if len(compute_results) == 0:
+        save_exec.shutdown()
+        return []
+    t_save = time.time()
     _, save_tasks = zip(*compute_results)
     save_tasks = [t for t in save_tasks if t]
     _ = get_results(save_tasks, "Save correlations")
+    metrics.add_time("save", time.time() - t_save)
     failed_pairs = [
         pair[0]
         for pair, (comp_res, save_task) in zip(work_items, compute_results)
         if not (comp_res and (save_task is None or save_task.result()))
     ]
+    metrics.count("correlated_pairs", len(work_items) - len(failed_pairs))
+    if ledger is not None:
+        failed_set = set(failed_pairs)
+        ledger.mark_pairs(STEP_CC, ts, [pair for pair, _ in work_items if pair not in failed_set])
 
     save_exec.shutdown()
     tlog.log("Correlate and write to store")
+    return failed_pairs
 
-    ffts.clear()
-    gc.collect()
 
-    tlog.log(f"Process the chunk of {ts}", t_chunk)
-    executor.shutdown()
+def cc_timespan_tiled(
+    raw_store: RawDataStore,
+    fft_params: ConfigParameters,
+    cc_store: CrossCorrelationDataStore,
+    ts: DateTimeRange,
+    channels: List[Channel],
+    pair_filter: Callable[[Channel, Channel], bool],
+    executor: Executor,
+    process_executor: Optional[Executor] = None,
+    fft_store: Optional[NumpyFFTStore] = None,
+    geometry: Optional[StationGeometry] = None,
+    ledger: Optional[CompletionLedger] = None,
+    metrics: Optional[Metrics] = None,
+) -> List[Tuple[Station, Station]]:
+    """
+    Out-of-core version of ``cc_timespan`` for when the FFTs of all channels don't fit in ``memory_budget``.
+    The channels are split in blocks of whole stations whose FFTs are computed and spilled to disk one
+    block at a time. The station pairs are then correlated tile by tile (block i x block j), with only
+    the FFTs of the two blocks of the tile in memory.
+
+    Returns:
+        The station pairs that failed
+    """
+    tlog = TimeLogger(logger, logging.INFO, prefix="CC Main")
+    if geometry is None:
+        geometry = StationGeometry()
+    if metrics is None:
+        metrics = Metrics()
+    per_channel = estimate_memory(fft_params, 1)
+    # two blocks are in memory while correlating a tile
+    block_size = max(1, int(fft_params.memory_budget / (2 * per_channel))) if per_channel > 0 else len(channels)
+    ch_blocks = channel_blocks(channels, block_size)
+    logger.info(
+        f"FFTs of {len(channels)} channels don't fit in {fft_params.memory_budget}gb, correlating "
+        f"{len(ch_blocks)} blocks of up to {block_size} channels in tiles"
+    )
+
+    with tempfile.TemporaryDirectory(prefix="noisepy_tiles_", dir=fft_params.spill_dir or None) as spill_dir:
+        # compute the FFTs one block at a time and spill them to disk
+        all_channels: List[Channel] = []
+        block_index: Dict[int, int] = {}  # channel index -> block
+        available = set()
+        Nfft = 0
+        for ib, block in enumerate(ch_blocks):
+            loaded = compute_ffts(executor, raw_store, fft_params, ts, block, fft_store, metrics=metrics)
+            if loaded is None:
+                continue
+            block_channels, ffts = loaded
+            offset = len(all_channels)
+            all_channels.extend(block_channels)
+            block_index.update({offset + i: ib for i in range(len(block_channels))})
+            available.update(offset + i for i in ffts.keys())
+            Nfft = max([Nfft] + [f.length for f in ffts.values()])
+            with metrics.timer("spill"):
+                spill_ffts(spill_dir, ib, {offset + i: f for i, f in ffts.items()})
+            del ffts
+            gc.collect()
+        tlog.log(f"Computed and spilled the FFTs of {len(available)} channels")
+        if Nfft == 0:
+            logger.error(f"No FFT data available for any channel in {ts}, skipping")
+            return list(create_pairs(pair_filter, channels, fft_params, geometry=geometry).keys())
+
+        # all the channels of a station are in the same block, so a station pair belongs to a single tile
+        station_pairs = create_pairs(pair_filter, all_channels, fft_params, available, geometry)
+        geometry.compute(station_pairs.keys())
+        tiles = defaultdict(list)
+        for item in sorted(station_pairs.items(), key=lambda t: t[0][0].name + t[0][1].name):
+            iiS, iiR = item[1][0]
+            tiles[tuple(sorted((block_index[iiS], block_index[iiR])))].append(item)
+
+        failed_pairs = []
+        for ib in range(len(ch_blocks)):
+            if not any(tile[0] == ib for tile in tiles):
+                continue
+            ffts_i = load_ffts(spill_dir, ib)
+            norms_i = compute_norms(executor, fft_params, ffts_i)
+            for jb in range(ib, len(ch_blocks)):
+                if (ib, jb) not in tiles:
+                    continue
+                ffts = dict(ffts_i)
+                norms = dict(norms_i)
+                if jb != ib:
+                    ffts_j = load_ffts(spill_dir, jb)
+                    ffts.update(ffts_j)
+                    norms.update(compute_norms(executor, fft_params, ffts_j))
+                    del ffts_j
+                logger.info(f"Correlating tile ({ib}, {jb}): {len(tiles[(ib, jb)])} station pairs")
+                metrics.count("tiles")
+                failed_pairs.extend(
+                    correlate_station_pairs(
+                        ts,
+                        fft_params,
+                        tiles[(ib, jb)],
+                        all_channels,
+                        ffts,
+                        norms,
+                        Nfft,
+                        cc_store,
+                        executor,
+                        process_executor,
+                        geometry,
+                        ledger,
+                        metrics,
+                    )
+                )
+                del ffts, norms
+                gc.collect()
+            del ffts_i, norms_i
+            gc.collect()
     return failed_pairs
 
 
+def channel_blocks(channels: List[Channel], block_size: int) -> List[List[Channel]]:
+    # split the channels in blocks of about block_size channels, keeping the channels of a station together
+    by_station: Dict[Station, List[Channel]] = OrderedDict()
+    for ch in channels:
+        by_station.setdefault(ch.station, []).append(ch)
+    blocks = []
+    block = []
+    for sta_channels in by_station.values():
+        if len(block) > 0 and len(block) + len(sta_channels) > block_size:
+            blocks.append(block)
+            block = []
+        block.extend(sta_channels)
+    if len(block):
+        blocks.append(block)
+    return blocks
+
+
+def spill_ffts(spill_dir: str, block: int, ffts: Dict[int, NoiseFFT]):
+    block_dir = os.path.join(spill_dir, str(block))
+    os.makedirs(block_dir)
+    for ich, fft in ffts.items():
+        np.savez(
+            os.path.join(block_dir, f"{ich}.npz"),
+            fft=fft.fft,
+            std=fft.std,
+            fft_time=fft.fft_time,
+            shape=np.array([fft.window_count, fft.length]),
+            offset=-1 if band_offset(fft) is None else band_offset(fft),
+        )
+
+
+def load_ffts(spill_dir: str, block: int) -> Dict[int, NoiseFFT]:
+    block_dir = os.path.join(spill_dir, str(block))
+    ffts = OrderedDict()
+    if not os.path.isdir(block_dir):
+        return ffts
+    for ich in sorted(int(os.path.splitext(f)[0]) for f in os.listdir(block_dir)):
+        with np.load(os.path.join(block_dir, f"{ich}.npz")) as data:
+            window_count, length = data["shape"]
+            offset = int(data["offset"])
+            ffts[ich] = make_noise_fft(
+                data["fft"],
+                data["std"],
+                data["fft_time"],
+                int(window_count),
+                int(length),
+                offset if offset >= 0 else None,
+            )
+    return ffts
+
+
 def create_pairs(
     pair_filter: Callable[[Channel, Channel], bool],
     channels: List[Channel],
-    acorr_only: bool,
-    ffts: Optional[Dict[int, NoiseFFT]] = None,
+    fft_params: ConfigParameters,
+    ffts: Optional[Collection[int]] = None,
+    geometry: Optional[StationGeometry] = None,
 ) -> Dict[Tuple[Station, Station], List[Tuple[int, int]]]:
-    station_pairs = defaultdict(list)
-    nchannels = len(channels)
-    for iiS in range(nchannels):
-        for iiR in range(iiS, nchannels):
-            src_chan = channels[iiS]
-            rec_chan = channels[iiR]
-            if not pair_filter(src_chan, rec_chan):
-                continue
-            if acorr_only:
-                if src_chan.station != rec_chan.station:
-                    continue
-            if ffts and iiS not in ffts:
-                logger.warning(f"No FFT data available for src channel '{src_chan}', skipped")
-                continue
-            if ffts and iiR not in ffts:
-                logger.warning(f"No FFT data available for rec channel '{rec_chan}', skipped")
-                continue
+    """
+    Groups the channel pairs to correlate by station pair. Only the stations between ``min_distance``
+    and ``max_distance`` of each other are paired, as selected by the spatial index of ``geometry``.
+    """
+    station_channels: Dict[Station, List[int]] = OrderedDict()
+    for ich, ch in enumerate(channels):
+        station_channels.setdefault(ch.station, []).append(ich)
+    stations = list(station_channels.keys())
+    if fft_params.acorr_only:
+        sta_pairs = [(i, i) for i in range(len(stations))]
+    else:
+        if geometry is None:
+            geometry = StationGeometry()
+        sta_pairs = geometry.station_pairs(stations, fft_params.min_distance, fft_params.max_distance)
+    channel_pairs = []
+    for ista, jsta in sta_pairs:
+        for iiS in station_channels[stations[ista]]:
+            for iiR in station_channels[stations[jsta]]:
+                if iiS <= iiR:
+                    channel_pairs.append((iiS, iiR))
+                elif ista != jsta:
+                    channel_pairs.append((iiR, iiS))
+    # same order as going over all the channel pairs
+    channel_pairs.sort()
 
-            station_pairs[(src_chan.station, rec_chan.station)].append((iiS, iiR))
+    station_pairs = defaultdict(list)
+    for iiS, iiR in channel_pairs:
+        src_chan = channels[iiS]
+        rec_chan = channels[iiR]
+        if not pair_filter(src_chan, rec_chan):
+            continue
+        if ffts and iiS not in ffts:
+            logger.warning(f"No FFT data available for src channel '{src_chan}', skipped")
+            continue
+        if ffts and iiR not in ffts:
+            logger.warning(f"No FFT data available for rec channel '{rec_chan}', skipped")
+            continue
+
+        station_pairs[(src_chan.station, rec_chan.station)].append((iiS, iiR))
     return station_pairs
 
 
@@ -294,9 +1005,11 @@ def stations_cross_correlation(
     channels: List[Channel],
     channel_pairs: List[Tuple[int, int]],
     ffts: Dict[int, NoiseFFT],
+    norms: Dict[int, SpectralNorms],
     Nfft: int,
     cc_store: CrossCorrelationDataStore,
     executor: Executor,
+    geometry: Optional[StationGeometry] = None,
 ) -> Tuple[bool, Future]:
     tlog = TimeLogger(logger, logging.DEBUG)
     datas = []
@@ -310,7 +1023,7 @@ def stations_cross_correlation(
         for src_chan, rec_chan in channel_pairs:
             assert channels[src_chan].station == src
             assert channels[rec_chan].station == rec
-            result = cross_correlation(fft_params, src_chan, rec_chan, channels, ffts, Nfft)
+            result = cross_correlation(fft_params, src_chan, rec_chan, channels, ffts, Nfft, norms, geometry)
             if result is not None:
                 data = CrossCorrelation(result[0].type, result[1].type, result[2], result[3])
                 datas.append(data)
@@ -322,6 +1035,180 @@ def stations_cross_correlation(
         return False, None
 
 
+def stations_cross_correlation_batch(
+    ts: DateTimeRange,
+    fft_params: ConfigParameters,
+    work_items: List[Tuple[Tuple[Station, Station], List[Tuple[int, int]]]],
+    channels: List[Channel],
+    spectra: Tuple[np.ndarray, Dict[int, int]],
+    ffts: Dict[int, NoiseFFT],
+    norms: Dict[int, SpectralNorms],
+    Nfft: int,
+    cc_store: CrossCorrelationDataStore,
+    executor: Executor,
+    geometry: Optional[StationGeometry] = None,
+) -> List[Tuple[bool, Future]]:
+    """
+    Batched counterpart of ``stations_cross_correlation``: correlates all the channel pairs of several
+    station pairs together and returns the ``(success, save future)`` tuple of each station pair.
+    """
+    tlog = TimeLogger(logger, logging.DEBUG)
+    results: List[Tuple[bool, Future]] = [(True, None)] * len(work_items)
+    try:
+        todo = []
+        for i, ((src, rec), _) in enumerate(work_items):
+            if cc_store.contains(src, rec, ts):
+                logger.info(f"Skipping {src}_{rec} for {ts} since it's already done")
+            else:
+                todo.append(i)
+        ch_pairs = [(i, src_chan, rec_chan) for i in todo for src_chan, rec_chan in work_items[i][1]]
+        ccs = cross_correlation_batch(
+            fft_params, [p[1:] for p in ch_pairs], channels, spectra, ffts, norms, Nfft, geometry
+        )
+    except Exception as e:
+        logger.error(f"Error processing a batch of {len(work_items)} station pairs for {ts}: {e}")
+        return [(False, None)] * len(work_items)
+
+    datas = defaultdict(list)
+    for (i, _, _), result in zip(ch_pairs, ccs):
+        if result is not None:
+            datas[i].append(CrossCorrelation(result[0].type, result[1].type, result[2], result[3]))
+    for i in todo:
+        (src, rec), _ = work_items[i]
+        results[i] = (True, executor.submit(save, cc_store, ts, src, rec, datas[i]))
+    tlog.log(f"Cross-correlated {len(ch_pairs)} channel pairs of {len(todo)} station pairs for {ts}")
+    return results
+
+
+def correlate_shared(
+    ts: DateTimeRange,
+    fft_params: ConfigParameters,
+    work_items: List[Tuple[Tuple[Station, Station], List[Tuple[int, int]]]],
+    channels: List[Channel],
+    ffts: Dict[int, NoiseFFT],
+    norms: Dict[int, SpectralNorms],
+    stacked: bool,
+    Nfft: int,
+    cc_store: CrossCorrelationDataStore,
+    executor: Executor,
+    process_executor: Executor,
+    save_executor: Executor,
+    geometry: Optional[StationGeometry] = None,
+) -> List[Tuple[bool, Future]]:
+    """
+    Correlates the station pairs in worker processes reading the FFTs from shared memory, and saves the
+    results from this process. The FFTs and spectral normalizations are moved to shared memory (stacked for
+    the batched engine when ``stacked``), so ``ffts`` and ``norms`` are emptied once the pairs are correlated.
+    Returns the ``(success, save future)`` tuple of each station pair.
+    """
+    tlog = TimeLogger(logger, logging.DEBUG)
+    results: List[Tuple[bool, Future]] = [(True, None)] * len(work_items)
+    dones = list(executor.map(lambda item: cc_store.contains(item[0][0], item[0][1], ts), work_items))
+    todo = []
+    for i, ((src, rec), _) in enumerate(work_items):
+        if dones[i]:
+            logger.info(f"Skipping {src}_{rec} for {ts} since it's already done")
+        else:
+            todo.append(i)
+    if len(todo) == 0:
+        return results
+
+    block, shared = sharedmem.share_ffts(ffts, norms, stacked)
+    tlog.log(f"Moved {block.nbytes / 1024**2:.1f} MB of FFTs to shared memory")
+    try:
+        tasks = {}
+        start = 0
+        for items in _batch_work_items([work_items[i] for i in todo], fft_params.cc_batch_size):
+            indices = todo[start : start + len(items)]
+            start += len(items)
+            ch_pairs = [pairs for _, pairs in items]
+            # only send the channels and geometry this task needs
+            task_channels = {ich: channels[ich] for pairs in ch_pairs for pair in pairs for ich in pair}
+            task_geometry = geometry.subset(pair for pair, _ in items) if geometry is not None else None
+            t = process_executor.submit(
+                cross_correlation_shared, shared, fft_params, ch_pairs, task_channels, Nfft, task_geometry
+            )
+            tasks[t] = indices
+        for t in as_completed(tasks):
+            indices = tasks[t]
+            try:
+                datas = t.result()
+            except Exception as e:
+                logger.error(f"Error processing a batch of {len(indices)} station pairs for {ts}: {e}")
+                for i in indices:
+                    results[i] = (False, None)
+                continue
+            for i, data in zip(indices, datas):
+                if data is None:
+                    results[i] = (False, None)
+                    continue
+                src, rec = work_items[i][0]
+                results[i] = (True, save_executor.submit(save, cc_store, ts, src, rec, data))
+    finally:
+        # the views of the block are the only copy of the FFTs left, release them with it
+        ffts.clear()
+        norms.clear()
+        block.close()
+    tlog.log(f"Cross-correlated {len(todo)} station pairs in worker processes for {ts}")
+    return results
+
+
+def cross_correlation_shared(
+    shared: sharedmem.SharedFFTs,
+    fft_params: ConfigParameters,
+    work_items: List[List[Tuple[int, int]]],
+    channels: Dict[int, Channel],
+    Nfft: int,
+    geometry: Optional[StationGeometry] = None,
+) -> List[Optional[List[CrossCorrelation]]]:
+    """
+    Runs in a worker process: correlates the channel pairs of several station pairs using the FFTs in
+    shared memory. Returns the correlations of each station pair, None for the ones that failed.
+    """
+    fftbackend.configure(fft_params)
+    ffts, norms, spectra = sharedmem.attach_ffts(shared)
+
+    def correlate_items(items: List[List[Tuple[int, int]]]) -> List[List[CrossCorrelation]]:
+        ch_pairs = [(i, src_chan, rec_chan) for i, pairs in enumerate(items) for src_chan, rec_chan in pairs]
+        if fft_params.cc_engine == CCEngine.BATCHED and spectra is not None:
+            ccs = cross_correlation_batch(
+                fft_params, [p[1:] for p in ch_pairs], channels, spectra, ffts, norms, Nfft, geometry
+            )
+        else:
+            ccs = [
+                cross_correlation(fft_params, iiS, iiR, channels, ffts, Nfft, norms, geometry)
+                for _, iiS, iiR in ch_pairs
+            ]
+        datas = [[] for _ in items]
+        for (i, _, _), result in zip(ch_pairs, ccs):
+            if result is not None:
+                datas[i].append(CrossCorrelation(result[0].type, result[1].type, result[2], result[3]))
+        return datas
+
+    try:
+        return correlate_items(work_items)
+    except Exception as e:
+        if len(work_items) == 1:
+            logger.error(f"Error correlating the channel pairs {work_items[0]}: {e}")
+            return [None]
+    # a single station pair failing doesn't fail the others of the task
+    results = []
+    for pairs in work_items:
+        try:
+            results.extend(correlate_items([pairs]))
+        except Exception as e:
+            logger.error(f"Error correlating the channel pairs {pairs}: {e}")
+            results.append(None)
+    return results
+
+
+def _process_executor(fft_params: ConfigParameters) -> Optional[Executor]:
+    if fft_params.cc_executor != CCExecutor.PROCESS:
+        return None
+    # Use 'spawn' to avoid issues with multiprocessing on linux and 'fork'
+    return ProcessPoolExecutor(mp_context=get_context("spawn"))
+
+
 def save(
     store: CrossCorrelationDataStore, ts: DateTimeRange, src: Station, rec: Station, datas: List[CrossCorrelation]
 ) -> bool:
@@ -340,27 +1227,234 @@ def cross_correlation(
     channels: List[Channel],
     ffts: Dict[int, NoiseFFT],
     Nfft: int,
+    norms: Dict[int, SpectralNorms] = {},
+    geometry: Optional[StationGeometry] = None,
 ) -> Tuple[Channel, Channel, dict, np.ndarray]:
     src_chan = channels[iiS]  # this is the name of the source channel
     rec_chan = channels[iiR]
     src_fft = ffts[iiS]
-    src_std = src_fft.std
+    src_norms = norms.get(iiS)
+    rec_norms = norms.get(iiR)
     # this finds the windows of "good" noise
-    sou_ind = np.where((src_std < fft_params.max_over_std) & (src_std > 0) & (np.isnan(src_std) == 0))[0]
-    if len(sou_ind) == 0:
+    src_good = window_mask(fft_params, src_fft, src_norms)
+    if not src_good.any():
         logger.warning(f"no good data for source: {src_chan}")
         return None
 
+    rec_fft = ffts[iiR]
+    # ---------- check the existence of earthquakes or spikes ----------
+    src_rows, rec_rows = pair_windows(
+        fft_params, src_fft, src_good, rec_fft, window_mask(fft_params, rec_fft, rec_norms)
+    )
+    if len(src_rows) == 0:
+        return None
+    if spectrum_band(src_fft) != spectrum_band(rec_fft):
+        # e.g. band-limited FFTs read from a store mixed with full ones: correlate the full spectra
+        src_fft, rec_fft = full_spectrum(src_fft), full_spectrum(rec_fft)
+        src_norms = rec_norms = None
+    sfft1 = source_spectrum(fft_params, src_fft, src_norms)
+    rec_smoothed = rec_norms.receiver if rec_norms else None
+    result = cross_corr(
+        fft_params, src_chan, rec_chan, sfft1, src_rows, rec_fft, rec_rows, Nfft, rec_smoothed, geometry
+    )
+    return result
+
+
+def cross_correlation_batch(
+    fft_params: ConfigParameters,
+    channel_pairs: List[Tuple[int, int]],
+    channels: List[Channel],
+    spectra: Tuple[np.ndarray, Dict[int, int]],
+    ffts: Dict[int, NoiseFFT],
+    norms: Dict[int, SpectralNorms],
+    Nfft: int,
+    geometry: Optional[StationGeometry] = None,
+) -> List[Tuple[Channel, Channel, dict, np.ndarray]]:
+    """
+    Cross-correlates the channel pairs in blocks of ``fft_params.cc_batch_size``. Returns the same
+    results as calling ``cross_correlation`` for each pair (None for the pairs without good data).
+    """
+    data, index = spectra
+    goods = {ch: window_mask(fft_params, ffts[ch], norms.get(ch)) for pair in channel_pairs for ch in pair}
+    sources = set(iiS for iiS, _ in channel_pairs)
+    for iiS in sources:
+        if not goods[iiS].any():
+            logger.warning(f"no good data for source: {channels[iiS]}")
+    sfft1s = {iiS: source_spectrum(fft_params, ffts[iiS], norms.get(iiS)) for iiS in sources if goods[iiS].any()}
+    pairs = [(iiS, iiR) for iiS, iiR in channel_pairs if iiS in sfft1s]
+
+    cc_results = {}
+    batch_size = max(1, fft_params.cc_batch_size)
+    for ib in range(0, len(pairs), batch_size):
+        batch = pairs[ib : ib + batch_size]
+        sfft1 = np.stack([sfft1s[iiS] for iiS, _ in batch])
+        sfft2 = data[[index[iiR] for _, iiR in batch]]
+        good = np.stack([goods[iiS] & goods[iiR] for iiS, iiR in batch])
+        fft_time = np.stack([ffts[iiR].fft_time for _, iiR in batch])
+        smoothed = None
+        if fft_params.cc_method == CCMethod.COHERENCY and all(iiR in norms for _, iiR in batch):
+            smoothed = np.stack([norms[iiR].receiver for _, iiR in batch])
+        # ----------- GAME TIME: cross correlation step ---------------
+        corrs = noise_module.correlate_batch(
+            sfft1, sfft2, good, fft_params, Nfft, fft_time, smoothed, band_offset(ffts[batch[0][1]])
+        )
+        del sfft1, sfft2, smoothed
+        for (iiS, iiR), corr in zip(batch, corrs):
+            if corr is not None:
+                src_chan, rec_chan = channels[iiS], channels[iiR]
+                metadata = cc_metadata(fft_params, src_chan, rec_chan, *corr, geometry)
+                cc_results[(iiS, iiR)] = (src_chan, rec_chan) + metadata
+    return [cc_results.get(pair) for pair in channel_pairs]
+
+
+def good_windows(fft_params: ConfigParameters, std: np.ndarray) -> np.ndarray:
+    """
+    Boolean mask of the windows without earthquakes or spikes (according to ``max_over_std``)
+    """
+    return (std < fft_params.max_over_std) & (std > 0) & (np.isnan(std) == 0)
+
+
+def window_mask(fft_params: ConfigParameters, fft: NoiseFFT, norms: Optional[SpectralNorms] = None) -> np.ndarray:
+    """
+    The good windows of a channel, precomputed in its ``SpectralNorms`` if available
+    """
+    if norms is not None and norms.good is not None:
+        return norms.good
+    return good_windows(fft_params, fft.std)
+
+
+def pair_windows(
+    fft_params: ConfigParameters, src_fft: NoiseFFT, src_good: np.ndarray, rec_fft: NoiseFFT, rec_good: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    The rows of the source and receiver spectra of the windows that are good for both channels
+    """
+    if fft_params.reject_windows_early:
+        # the FFTs only hold the windows that passed the test, match them by their start time
+        src_rows = np.where(src_good)[0]
+        rec_rows = np.where(rec_good)[0]
+        _, isrc, irec = np.intersect1d(
+            src_fft.fft_time[src_rows], rec_fft.fft_time[rec_rows], assume_unique=True, return_indices=True
+        )
+        return src_rows[isrc], rec_rows[irec]
+    n = min(len(src_good), len(rec_good))
+    rows = np.where(src_good[:n] & rec_good[:n])[0]
+    return rows, rows
+
+
+def source_spectrum(
+    fft_params: ConfigParameters, src_fft: NoiseFFT, src_norms: Optional[SpectralNorms] = None
+) -> np.ndarray:
+    """
+    The (nwin, nfreq) spectrum of a channel used on the source side of the correlation
+    """
+    if src_norms is not None and src_norms.source is not None:
+        return src_norms.source
     # in the case of pure deconvolution, we recommend smoothing anyway.
     if fft_params.cc_method == CCMethod.DECONV:
         # -----------get the smoothed source spectrum for decon later----------
         sfft1 = noise_module.smooth_source_spect(fft_params, src_fft.fft)
-        sfft1 = sfft1.reshape(src_fft.window_count, src_fft.length // 2)
+        return sfft1.reshape(src_fft.window_count, -1)
     else:
-        sfft1 = np.conj(src_fft.fft).reshape(src_fft.window_count, src_fft.length // 2)
+        return np.conj(src_fft.fft).reshape(src_fft.window_count, -1)
 
-    result = cross_corr(fft_params, src_chan, rec_chan, sfft1, sou_ind, ffts[iiR], Nfft)
-    return result
+
+def spectrum_band(fft: NoiseFFT) -> Tuple[int, int]:
+    """
+    The first frequency bin and the number of bins of the spectra held by ``fft``
+    """
+    nbins = fft.fft.size // fft.window_count if fft.window_count else 0
+    return band_offset(fft) or 0, nbins
+
+
+def full_spectrum(fft: NoiseFFT) -> NoiseFFT:
+    """
+    The ``NoiseFFT`` of the full spectra (length // 2 bins) of a band-limited one
+    """
+    if band_offset(fft) is None:
+        return fft
+    spectra = noise_module.expand_band(fft.fft.reshape(fft.window_count, -1), fft.offset, fft.length // 2)
+    return NoiseFFT(spectra.reshape(spectra.size), fft.std, fft.fft_time, fft.window_count, fft.length)
+
+
+def spectral_norms(fft_params: ConfigParameters, fft: NoiseFFT) -> SpectralNorms:
+    """
+    Computes the normalizations of a channel's spectrum that are shared by all its pairs
+    """
+    shape = (fft.window_count, -1)
+    norms = SpectralNorms(good=good_windows(fft_params, fft.std))
+    if fft_params.cc_method == CCMethod.DECONV:
+        norms.source = noise_module.smooth_source_spect(fft_params, fft.fft).reshape(shape)
+    elif fft_params.cc_method == CCMethod.COHERENCY:
+        smoothed = noise_module.moving_ave(np.abs(fft.fft), fft_params.smoothspect_N)
+        norms.receiver = smoothed.astype(fft.fft.real.dtype).reshape(shape)
+    return norms
+
+
+def compute_norms(
+    executor: Executor, fft_params: ConfigParameters, ffts: Dict[int, NoiseFFT]
+) -> Dict[int, SpectralNorms]:
+    norm_refs = [executor.submit(spectral_norms, fft_params, fft) for fft in ffts.values()]
+    return dict(zip(ffts.keys(), get_results(norm_refs, "Spectral normalizations")))
+
+
+def stackable(ffts: Dict[int, NoiseFFT], same_times: bool = False) -> bool:
+    """
+    Whether the FFTs of the channels all have the same shape and, with ``same_times``, their windows all start
+    at the same times, so that their spectra can be stacked
+    """
+    shapes = set((f.window_count, f.length, f.fft.size, band_offset(f), f.fft.dtype) for f in ffts.values())
+    if len(shapes) != 1:
+        return False
+    if same_times:
+        times = next(iter(ffts.values())).fft_time
+        if not all(np.array_equal(f.fft_time, times) for f in ffts.values()):
+            return False
+    return True
+
+
+def stack_spectra(ffts: Dict[int, NoiseFFT], same_times: bool = False) -> Optional[Tuple[np.ndarray, Dict[int, int]]]:
+    """
+    Stacks the spectra of all channels into one (nchan, nwin, nfreq) array. The ``NoiseFFT`` instances
+    are replaced by views into the stacked array so the memory is not duplicated.
+
+    Returns:
+        The stacked array and a map from channel index to its position in it, or None if the FFTs
+        of the channels don't all have the same shape, or with ``same_times`` their windows don't all
+        start at the same times
+    """
+    if not stackable(ffts, same_times):
+        return None
+    first = next(iter(ffts.values()))
+    nwin, size, offset, dtype = first.window_count, first.fft.size, band_offset(first), first.fft.dtype
+    data = np.empty((len(ffts), nwin, size // nwin), dtype=dtype)
+    index = {}
+    for k, (ich, fft) in enumerate(ffts.items()):
+        data[k] = fft.fft.reshape(nwin, -1)
+        ffts[ich] = make_noise_fft(
+            data[k].reshape(data[k].size), fft.std, fft.fft_time, fft.window_count, fft.length, offset
+        )
+        index[ich] = k
+    return data, index
+
+
+def _batch_work_items(
+    work_items: List[Tuple[Tuple[Station, Station], List[Tuple[int, int]]]], batch_size: int
+) -> List[List[Tuple[Tuple[Station, Station], List[Tuple[int, int]]]]]:
+    # group consecutive station pairs so that each block has about batch_size channel pairs
+    blocks = []
+    block = []
+    count = 0
+    for item in work_items:
+        block.append(item)
+        count += len(item[1])
+        if count >= batch_size:
+            blocks.append(block)
+            block = []
+            count = 0
+    if len(block):
+        blocks.append(block)
+    return blocks
 
 
 def preprocess_all(
@@ -371,9 +1465,12 @@ def preprocess_all(
     ts: DateTimeRange,
 ) -> List[Tuple[Channel, ChannelData]]:
     channels = list(zip(*ch_data))[0]
-    stream_refs = [executor.submit(preprocess, raw_store, t[0], t[1], fft_params, ts) for t in ch_data]
+    if fft_params.preprocess_engine == PreprocessEngine.BATCHED:
+        new_streams = _preprocess_batched(executor, ch_data, raw_store, fft_params, ts)
+    else:
+        stream_refs = [executor.submit(preprocess, raw_store, t[0], t[1], fft_params, ts) for t in ch_data]
+        new_streams = get_results(stream_refs, "Pre-process")
     del ch_data
-    new_streams = get_results(stream_refs, "Pre-process")
     # Log if any streams were removed during pre-processing
     for ch, st in zip(channels, new_streams):
         if len(st) == 0:
@@ -389,24 +1486,43 @@ def cross_corr(
     src_chan: Channel,
     rec_chan: Channel,
     sfft1: np.ndarray,
-    sou_ind: np.ndarray,
+    src_rows: np.ndarray,
     rec_fft: NoiseFFT,
+    rec_rows: np.ndarray,
     Nfft: int,
+    rec_smoothed: Optional[np.ndarray] = None,
+    geometry: Optional[StationGeometry] = None,
 ) -> Tuple[Channel, Channel, dict, np.ndarray]:
-    # read the receiver data
-    sfft2 = rec_fft.fft.reshape(rec_fft.window_count, rec_fft.length // 2)
-    rec_std = rec_fft.std
-
-    # ---------- check the existence of earthquakes or spikes ----------
-    rec_ind = np.where((rec_std < fft_params.max_over_std) & (rec_std > 0) & (np.isnan(rec_std) == 0))[0]
-    bb = np.intersect1d(sou_ind, rec_ind)
-    if len(bb) == 0:
+    if len(rec_rows) == 0:
         return
+    # read the receiver data
+    sfft2 = rec_fft.fft.reshape(rec_fft.window_count, -1)
 
     # ----------- GAME TIME: cross correlation step ---------------
-    corr, tcorr, ncorr = noise_module.correlate(sfft1[bb, :], sfft2[bb, :], fft_params, Nfft, rec_fft.fft_time[bb])
+    smoothed = None if rec_smoothed is None else rec_smoothed[rec_rows, :]
+    corr, tcorr, ncorr = noise_module.correlate(
+        sfft1[src_rows, :],
+        sfft2[rec_rows, :],
+        fft_params,
+        Nfft,
+        rec_fft.fft_time[rec_rows],
+        smoothed,
+        band_offset(rec_fft),
+    )
 
     del sfft2
+    return (src_chan, rec_chan) + cc_metadata(fft_params, src_chan, rec_chan, corr, tcorr, ncorr, geometry)
+
+
+def cc_metadata(
+    fft_params: ConfigParameters,
+    src_chan: Channel,
+    rec_chan: Channel,
+    corr: np.ndarray,
+    tcorr: np.ndarray,
+    ncorr: np.ndarray,
+    geometry: Optional[StationGeometry] = None,
+) -> Tuple[dict, np.ndarray]:
     # ---------- OUTPUT: store metadata and data into file ------------
     coor = {
         "lonS": src_chan.station.lon,
@@ -414,20 +1530,65 @@ def cross_corr(
         "lonR": rec_chan.station.lon,
         "latR": rec_chan.station.lat,
     }
+    if geometry is not None:
+        coor["dist"], coor["azi"], coor["baz"] = geometry.get(src_chan.station, rec_chan.station)
     comp = src_chan.type.get_orientation() + rec_chan.type.get_orientation()
     parameters = noise_module.cc_parameters(fft_params, coor, tcorr, ncorr, comp)
-    return (src_chan, rec_chan, parameters, corr)
+    return (parameters, corr)
 
 
-def preprocess(
-    raw_store: RawDataStore, ch: Channel, ch_data: ChannelData, fft_params: ConfigParameters, ts: DateTimeRange
-) -> obspy.Stream:
+def _preprocess_batched(
+    executor: Executor,
+    ch_data: List[Tuple[Channel, ChannelData]],
+    raw_store: RawDataStore,
+    fft_params: ConfigParameters,
+    ts: DateTimeRange,
+) -> List[obspy.Stream]:
+    # sort by sampling rate and length so that each block is pre-processed as one array
+    order = sorted(
+        range(len(ch_data)),
+        key=lambda i: (ch_data[i][1].sampling_rate, ch_data[i][1].data.size, i),
+    )
+    batch_size = max(1, fft_params.preprocess_batch_size)
+    blocks = [order[i : i + batch_size] for i in range(0, len(order), batch_size)]
+    block_refs = [
+        executor.submit(preprocess_batch, raw_store, [ch_data[i] for i in block], fft_params, ts) for block in blocks
+    ]
+    new_streams = [None] * len(ch_data)
+    for block, streams in zip(blocks, get_results(block_refs, "Pre-process")):
+        for i, st in zip(block, streams):
+            new_streams[i] = st
+    return new_streams
+
+
+def preprocess_batch(
+    raw_store: RawDataStore, ch_data: List[Tuple[Channel, ChannelData]], fft_params: ConfigParameters, ts: DateTimeRange
+) -> List[obspy.Stream]:
+    return noise_module.preprocess_raw_batch(
+        [chd.stream.copy() for _, chd in ch_data],
+        [_channel_inventory(raw_store, ch, ts) for ch, _ in ch_data],
+        fft_params,
+        obspy.UTCDateTime(ts.start_datetime),
+        obspy.UTCDateTime(ts.end_datetime),
+        shared_response_cache(fft_params.response_cache_memory),
+        fft_params.resample_method,
+    )
+
+
+def _channel_inventory(raw_store: RawDataStore, ch: Channel, ts: DateTimeRange) -> obspy.Inventory:
     inv = raw_store.get_inventory(ts, ch.station)
     ch_inv = inv.select(channel=ch.type.name, time=ts.start_datetime)
     # if we don't find an inventory when filtering by time, back off and try
     # without this constraint
     if len(ch_inv) < 1:
         ch_inv = inv.select(channel=ch.type.name)
+    return ch_inv
+
+
+def preprocess(
+    raw_store: RawDataStore, ch: Channel, ch_data: ChannelData, fft_params: ConfigParameters, ts: DateTimeRange
+) -> obspy.Stream:
+    ch_inv = _channel_inventory(raw_store, ch, ts)
 
     return noise_module.preprocess_raw(
         ch_data.stream.copy(),  # If we don't copy it's not writeable
@@ -435,6 +1596,8 @@ def preprocess(
         fft_params,
         obspy.UTCDateTime(ts.start_datetime),
         obspy.UTCDateTime(ts.end_datetime),
+        shared_response_cache(fft_params.response_cache_memory),
+        fft_params.resample_method,
     )
 
 
@@ -446,6 +1609,10 @@ def compute_fft(fft_params: ConfigParameters, ch_data: ChannelData) -> NoiseFFT:
     trace_stdS, dataS_t, dataS = noise_module.cut_trace_make_stat(
         fft_params, ch_data
     )  # optimized version:3-4 times faster
+    if fft_params.reject_windows_early:
+        # the windows that can't pass the test of any pair are not normalized nor transformed
+        good = good_windows(fft_params, trace_stdS)
+        trace_stdS, dataS_t, dataS = trace_stdS[good], dataS_t[good], dataS[good]
     if not len(dataS):
         return NoiseFFT(np.empty(0), np.empty(0), np.empty(0), 0, 0)
 
@@ -453,16 +1620,27 @@ def compute_fft(fft_params: ConfigParameters, ch_data: ChannelData) -> NoiseFFT:
 
     # do normalization if needed
     source_white = noise_module.noise_processing(fft_params, dataS)
-    Nfft = source_white.shape[1]
+    # the spectra only hold the non-negative frequencies
+    Nfft = int(next_fast_len(int(dataS.shape[1])))
     Nfft2 = Nfft // 2
 
+    offset = None
+    if fft_params.band_limited_fft and fft_params.freq_norm != FreqNorm.NO:
+        # the whitened spectra are zero outside of [ix00, ix11), keep that band in single precision. The margin
+        # of smoothspect_N bins keeps the smoothing of the coherency and deconvolution the same inside the band
+        _, _, ix00, ix11 = noise_module.whiten_band(fft_params, Nfft)
+        offset = max(ix00 - fft_params.smoothspect_N, 0)
+        end = min(ix11 + fft_params.smoothspect_N, Nfft2)
+        data = source_white[:, offset:end].astype(np.complex64)
+    else:
+        data = source_white[:, :Nfft2]
+
     # load fft data in memory for cross-correlations
-    data = source_white[:, :Nfft2]
     fft = data.reshape(data.size)
     std = trace_stdS
     fft_time = dataS_t
     del trace_stdS, dataS_t, dataS, source_white, data
-    return NoiseFFT(fft, std, fft_time, N, Nfft)
+    return make_noise_fft(fft, std, fft_time, N, Nfft, offset)
 
 
 def _read_channels(
@@ -480,6 +1658,70 @@ def _read_channels(
     return _filter_channel_data(tuples, samp_freq, single_freq)
 
 
+def _stream_channel_ffts(
+    executor: Executor,
+    raw_store: RawDataStore,
+    fft_params: ConfigParameters,
+    ts: DateTimeRange,
+    channels: List[Channel],
+    metrics: Metrics,
+) -> List[Tuple[Channel, NoiseFFT]]:
+    """
+    Reads, pre-processes and computes the FFT of each channel in a single task, with at most
+    ``channels_in_flight`` tasks submitted at a time. Only the raw and pre-processed data of those channels is in
+    memory at once, the other channels are either waiting to be read or already reduced to their FFT.
+    The channels are pre-processed one at a time, whatever the ``preprocess_engine``.
+    """
+    lock = threading.Lock()
+    # sampling rates of the channels read so far
+    rates: List[float] = []
+
+    def process(ch: Channel) -> Optional[Tuple[float, int, Optional[NoiseFFT]]]:
+        ch_data = _safe_read_data(raw_store, ts, ch)
+        if ch_data.data.size == 0:
+            return None
+        rate = ch_data.sampling_rate
+        nbytes = ch_data.data.nbytes
+        with lock:
+            rates.append(rate)
+            # the channels with a rate too low, or further from samp_freq than one already read, are filtered out
+            skip = rate < fft_params.samp_freq or (
+                fft_params.single_freq and any(fft_params.samp_freq <= r < rate for r in rates)
+            )
+        if skip:
+            return rate, nbytes, None
+        try:
+            st = preprocess(raw_store, ch, ch_data, fft_params, ts)
+            del ch_data
+            if len(st) == 0:
+                logging.warning(f"Empty stream for {ts}/{ch} after pre-processing. ")
+                return rate, nbytes, None
+            return rate, nbytes, compute_fft(fft_params, ChannelData(st))
+        except Exception as e:
+            logger.error(f"Error processing the data of {ch} in {ts}: {e}")
+            return rate, nbytes, None
+
+    results = [None] * len(channels)
+    pending: Dict[Future, int] = {}
+    next_ch = 0
+    while next_ch < len(channels) or len(pending) > 0:
+        while next_ch < len(channels) and len(pending) < fft_params.channels_in_flight:
+            pending[executor.submit(process, channels[next_ch])] = next_ch
+            next_ch += 1
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for f in done:
+            results[pending.pop(f)] = f.result()
+
+    read = [(ch, r) for ch, r in zip(channels, results) if r is not None]
+    metrics.count("channels_read", len(read))
+    metrics.count("read_bytes", sum(r[1] for _, r in read))
+    if len(read) == 0:
+        logger.warning(f"No data available for {ts}")
+        return []
+    kept = _kept_sampling_rates([r[0] for _, r in read], fft_params.samp_freq, fft_params.single_freq)
+    return [(ch, r[2]) for ch, r in read if r[0] in kept and r[2] is not None]
+
+
 def _safe_read_data(store: RawDataStore, ts: DateTimeRange, ch: Channel) -> ChannelData:
     try:
         return store.read_data(ts, ch)
@@ -488,11 +1730,12 @@ def _safe_read_data(store: RawDataStore, ts: DateTimeRange, ch: Channel) -> Chan
         return ChannelData.empty()
 
 
-def _filter_channel_data(
-    tuples: List[Tuple[Channel, ChannelData]], samp_freq: int, single_freq: bool = True
-) -> List[Tuple[Channel, ChannelData]]:
-    frequencies = set(t[1].sampling_rate for t in tuples)
-    frequencies = list(filter(lambda f: f >= samp_freq, frequencies))
+def _kept_sampling_rates(rates: Collection[float], samp_freq: int, single_freq: bool = True) -> List[float]:
+    """
+    The sampling rates of the channels that are used: the one closest to samp_freq with ``single_freq``,
+    otherwise all of those >= samp_freq
+    """
+    frequencies = list(filter(lambda f: f >= samp_freq, set(rates)))
     if len(frequencies) == 0:
         logging.warning(f"No data available with sampling frequency >= {samp_freq}")
         return []
@@ -502,6 +1745,18 @@ def _filter_channel_data(
             key=lambda f: max(f - samp_freq, 0),
         )
         logger.info(f"Picked {closest_freq} as the closest sampling frequence to {samp_freq}. ")
+        return [closest_freq]
+    return frequencies
+
+
+def _filter_channel_data(
+    tuples: List[Tuple[Channel, ChannelData]], samp_freq: int, single_freq: bool = True
+) -> List[Tuple[Channel, ChannelData]]:
+    frequencies = _kept_sampling_rates([t[1].sampling_rate for t in tuples], samp_freq, single_freq)
+    if len(frequencies) == 0:
+        return []
+    if single_freq:
+        closest_freq = frequencies[0]
         filtered_tuples = list(filter(lambda tup: tup[1].sampling_rate == closest_freq, tuples))
         logger.info(f"Filtered to {len(filtered_tuples)}/{len(tuples)} channels with sampling rate == {closest_freq}")
     else:
@@ -511,19 +1766,9 @@ def _filter_channel_data(
     return filtered_tuples
 
 
-def check_memory(params: ConfigParameters, nsta: int) -> int:
-    # maximum memory allowed
-    # TODO: Is this needed? Should it be configurable?
-    MAX_MEM = 96.0
-    # crude estimation on memory needs (assume float32)
+def estimate_memory(params: ConfigParameters, nsta: int) -> float:
+    # crude estimation on memory needs in GB (assume float32)
     nsec_chunk = params.inc_hours / 24 * 86400
     nseg_chunk = int(np.floor((nsec_chunk - params.cc_len) / params.step))
     npts_chunk = int(nseg_chunk * params.cc_len * params.samp_freq)
-    memory_size = nsta * npts_chunk * 4 / 1024**3
-    if memory_size > MAX_MEM:
-        raise ValueError(
-            "Require %5.3fG memory but only %5.3fG provided)! Reduce inc_hours to avoid this issue!"
-            % (memory_size, MAX_MEM)
-        )
-    logger.info(f"Require {memory_size:5.2f}gb memory for cross correlations")
-    return nseg_chunk
+    return nsta * npts_chunk * 4 / 1024**3
@@ -0,0 +1,243 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from enum import Enum
+from typing import Optional
+
+import numpy as np
+from pydantic import Field
+from pydantic_yaml import parse_yaml_raw_as
+
+from noisepy.seis.io import datatypes
+from noisepy.seis.io.utils import get_filesystem
+
+
+class CCEngine(str, Enum):
+    PAIRWISE = "pairwise"
+    BATCHED = "batched"
+
+
+class CCExecutor(str, Enum):
+    THREAD = "thread"
+    PROCESS = "process"
+
+
+class PreprocessEngine(str, Enum):
+    OBSPY = "obspy"
+    BATCHED = "batched"
+
+
+class ResampleMethod(str, Enum):
+    FFT = "fft"
+    POLYPHASE = "polyphase"
+
+
+class FFTLibrary(str, Enum):
+    SCIPY = "scipy"
+    PYFFTW = "pyfftw"
+
+
+class MetricsFormat(str, Enum):
+    JSONL = "jsonl"
+    PROMETHEUS = "prometheus"
+
+
+class ConfigParameters(datatypes.ConfigParameters):
+    """
+    Extends the ``noisepy.seis.io`` configuration with the parameters of how the cross-correlation and stacking
+    steps are executed. Most of them only change the speed and memory use. Those that also change the data
+    produced are:
+
+    - ``cc_engine``: 'batched' rounds differently and smooths the coherency spectra over all the windows of a
+      channel instead of only those used by each pair
+    - ``preprocess_engine``: 'batched' filters in single precision, the results differ by rounding
+    - ``resample_method``: 'polyphase' decimates with a different anti-aliasing filter
+    - ``fft_library``: 'pyfftw' rounds differently
+    - ``reject_windows_early``: the rejected windows are left out of the smoothing of the coherency and
+      deconvolution spectra
+    - ``band_limited_fft``: the spectra are kept in single precision
+    - ``min_distance`` and ``max_distance``: the pairs outside of the range are not correlated
+    """
+
+    cc_engine: CCEngine = Field(
+        default=CCEngine.PAIRWISE,
+        description="'pairwise' to correlate one channel pair at a time, 'batched' to correlate blocks of "
+        "channel pairs with vectorized operations",
+    )
+    cc_batch_size: int = Field(
+        default=32,
+        description="number of channel pairs correlated together when cc_engine is 'batched' "
+        "or sent together to a worker process when cc_executor is 'process'",
+    )
+    cc_executor: CCExecutor = Field(
+        default=CCExecutor.THREAD,
+        description="'thread' to correlate the pairs in a thread pool, 'process' to correlate them in worker "
+        "processes reading the FFTs from shared memory",
+    )
+
+    preprocess_engine: PreprocessEngine = Field(
+        default=PreprocessEngine.OBSPY,
+        description="'obspy' to pre-process one channel at a time, 'batched' to clean, detrend, taper and filter "
+        "the channels with the same sampling rate together with vectorized operations",
+    )
+    preprocess_batch_size: int = Field(
+        default=64, description="number of channels pre-processed together when preprocess_engine is 'batched'"
+    )
+
+    resample_method: ResampleMethod = Field(
+        default=ResampleMethod.FFT,
+        description="'fft' to resample the filtered data with FFTs, 'polyphase' to first decimate it with a "
+        "polyphase filter when the ratio of the sampling rates is a simple fraction, so that the bandpass "
+        "filter and response removal run at samp_freq",
+    )
+    response_cache_memory: float = Field(
+        default=4.0,
+        description="memory (GB) of each process for the evaluated instrument responses, reused by the following "
+        "timespans when rm_resp is 'inv', 0 to disable",
+    )
+
+    fft_library: FFTLibrary = Field(
+        default=FFTLibrary.SCIPY,
+        description="'scipy' for scipy.fft, 'pyfftw' for FFTW with the plans cached and reused by all the channels "
+        "and pairs (needs the pyfftw package)",
+    )
+    fft_workers: int = Field(default=1, description="number of threads of each FFT")
+    fft_wisdom_path: str = Field(
+        default="",
+        description="local file where the FFTW wisdom is loaded from and saved to when fft_library is 'pyfftw', "
+        "disabled when empty",
+    )
+    reject_windows_early: bool = Field(
+        default=False,
+        description="drop the windows that fail the max_over_std test before their normalization and FFT instead of "
+        "for each pair. The windows of the two channels of a pair are then matched by their start time",
+    )
+    band_limited_fft: bool = Field(
+        default=False,
+        description="keep only the whitened frequency band of the FFTs (plus smoothspect_N bins on each side), "
+        "in complex64, when freq_norm is not 'no'. The bins outside of it are zero after the whitening",
+    )
+
+    memory_budget: float = Field(
+        default=96.0,
+        description="memory (GB) available for the FFTs of a timespan. When more is needed, the channels are "
+        "split in blocks that are correlated tile by tile, with the blocks not in use spilled to disk",
+    )
+    spill_dir: str = Field(
+        default="", description="local directory for the spilled FFT blocks, defaults to the system temp directory"
+    )
+
+    fft_store_path: str = Field(
+        default="",
+        description="directory (local or S3) where the FFTs of each channel are kept to be reused by later runs "
+        "with the same pre-processing parameters, disabled when empty",
+    )
+
+    prefetch_depth: int = Field(
+        default=0,
+        description="number of timespans whose raw data is read in the background while the current one is "
+        "correlated, 0 to disable",
+    )
+    prefetch_memory: float = Field(
+        default=16.0, description="maximum size (GB) of the raw data read ahead by prefetch_depth"
+    )
+    channels_in_flight: int = Field(
+        default=0,
+        description="when > 0, each channel is read, pre-processed and transformed in one task, with at most this "
+        "many channels at a time, so that its raw data is freed as soon as its FFT is computed. 0 to read all the "
+        "channels, then pre-process them all, then compute all their FFTs",
+    )
+    timespan_batch: int = Field(
+        default=1,
+        description="number of consecutive timespans processed in one pass: the raw data read for a timespan is "
+        "reused, sliced, for the next ones of the batch it covers. For short inc_hours with a raw data store that "
+        "returns e.g. the daily file of a timespan. The raw data of a batch is kept in memory until its last timespan "
+        "is done. 1 to process each timespan on its own",
+    )
+
+    ledger_path: str = Field(
+        default="",
+        description="local SQLite file (or directory for a 'done.sqlite' file) recording the station pairs and "
+        "timespans already correlated and stacked, to resume runs without checking the stores pair by pair, "
+        "disabled when empty",
+    )
+
+    metrics_path: str = Field(
+        default="",
+        description="local file where the counters, timers and peak memory of each pipeline stage are written, "
+        "disabled when empty",
+    )
+    metrics_format: MetricsFormat = Field(
+        default=MetricsFormat.JSONL,
+        description="'jsonl' to append one JSON record per stage and timespan, 'prometheus' to keep the latest "
+        "values in a Prometheus textfile",
+    )
+
+    min_distance: float = Field(default=0.0, description="minimum distance (km) between the stations of a pair")
+    max_distance: float = Field(
+        default=0.0, description="maximum distance (km) between the stations of a pair, 0 for no maximum"
+    )
+
+    def load_yaml(filename: str, storage_options={}) -> ConfigParameters:
+        fs = get_filesystem(filename, storage_options=storage_options)
+        with fs.open(filename, "r") as f:
+            yaml_str = f.read()
+            config = parse_yaml_raw_as(ConfigParameters, yaml_str)
+            return config
+
+
+@dataclass
+class SpectralNorms:
+    """
+    Per-channel normalizations derived from a ``NoiseFFT``. They only depend on the channel, so they are
+    computed once per timespan and reused by all the pairs the channel is part of.
+
+    Attributes:
+        source: (nwin, nfreq) source side spectrum, when it's more than the conjugate of the FFT (deconv)
+        receiver: (nwin, nfreq) smoothed amplitude spectrum dividing the receiver side (coherency)
+        good: (nwin,) mask of the windows without earthquakes or spikes (according to ``max_over_std``)
+    """
+
+    source: Optional[np.ndarray] = None
+    receiver: Optional[np.ndarray] = None
+    good: Optional[np.ndarray] = None
+
+
+class BandNoiseFFT(datatypes.NoiseFFT):
+    """
+    A ``NoiseFFT`` holding only the frequency bins [offset, offset + nbins) of each window, the others being zero.
+    ``length`` is still the FFT length the spectra are inverted with.
+    """
+
+    def __init__(
+        self, fft: np.ndarray, std: np.ndarray, fft_time: np.ndarray, window_count: int, length: int, offset: int
+    ):
+        super().__init__(fft, std, fft_time, window_count, length)
+        self.offset = offset
+
+    @property
+    def nbins(self) -> int:
+        return self.fft.size // self.window_count if self.window_count else 0
+
+
+def band_offset(fft: datatypes.NoiseFFT) -> Optional[int]:
+    """
+    The first frequency bin held by a ``BandNoiseFFT``, None for the FFTs holding the full spectra
+    """
+    return fft.offset if isinstance(fft, BandNoiseFFT) else None
+
+
+def make_noise_fft(
+    fft: np.ndarray,
+    std: np.ndarray,
+    fft_time: np.ndarray,
+    window_count: int,
+    length: int,
+    offset: Optional[int] = None,
+) -> datatypes.NoiseFFT:
+    """
+    A ``BandNoiseFFT`` starting at bin ``offset``, or a ``NoiseFFT`` of the full spectra when it's None
+    """
+    if offset is None:
+        return datatypes.NoiseFFT(fft, std, fft_time, window_count, length)
+    return BandNoiseFFT(fft, std, fft_time, window_count, length, offset)
@@ -15,10 +15,11 @@ import numpy as np
 import pandas as pd
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from noisepy.seis.io.datatypes import ConfigParameters
 from noisepy.seis.io.channelcatalog import CSVChannelCatalog
 from noisepy.seis.io.utils import TimeLogger
 from . import noise_module
+from .datatypes import ConfigParameters
+from .metrics import Metrics, create_metrics
 from obspy.clients.fdsn import Client
 from obspy.clients.fdsn.header import FDSNNoDataException
 
@@ -86,6 +87,7 @@ def download(direc: str, prepro_para: ConfigParameters) -> None:
 
     tlog = TimeLogger(logger, logging.INFO)
     t_tot = tlog.reset()
+    metrics = create_metrics(prepro_para)
     dlist = os.path.join(direc, "station.csv")  # CSV file for station location info
     prepro_para.respdir = os.path.join(
         direc, "../resp"
@@ -160,6 +162,8 @@ def download(direc: str, prepro_para: ConfigParameters) -> None:
                     location.append("*")
                 nsta += 1
     tlog.log("Getting inventory")
+    metrics.count("channels", nsta)
+    metrics.emit("download_inventory")
     # rough estimation on memory needs (assume float32 dtype)
     nsec_chunk = prepro_para.inc_hours / 24 * 86400
     nseg_chunk = int(np.floor((nsec_chunk - prepro_para.cc_len) / prepro_para.step)) + 1
@@ -202,6 +206,7 @@ def download(direc: str, prepro_para: ConfigParameters) -> None:
         starttime = obspy.UTCDateTime(all_chunk[ick])
         endtime = obspy.UTCDateTime(all_chunk[ick + 1])
 
+        chunk_metrics = Metrics(metrics.sink)
         # keep a track of the channels already exists
         num_records = np.zeros(nsta, dtype=np.int16)
 
@@ -228,6 +233,7 @@ def download(direc: str, prepro_para: ConfigParameters) -> None:
                 # continue when there are alreay data for sta A at day X
                 if num_records[ista] == ncomp:
                     logger.info(f"Already have {num_records[ista]} for {sta[ista]}")
+                    chunk_metrics.count("skipped_channels")
                     continue
                 task = executor.submit(
                     download_stream,
@@ -255,9 +261,17 @@ def download(direc: str, prepro_para: ConfigParameters) -> None:
                     new_tags = "{0:s}_{1:s}".format(chan[ista].lower(), tlocation.lower())
                     logger.info(f"Downloaded {chan[ista]}/{new_tags}")
                     # above we should change the dag for: net.sta.loc.chan
-                    ds.add_waveforms(tr, tag=new_tags)
+                    with chunk_metrics.timer("save"):
+                        ds.add_waveforms(tr, tag=new_tags)
+                    chunk_metrics.count("downloaded_channels")
+                    chunk_metrics.count("bytes", sum(t.data.nbytes for t in tr))
+                else:
+                    chunk_metrics.count("failed_channels")
+        chunk_metrics.emit("download_chunk", chunk=all_chunk[ick])
+        metrics.count("chunks")
 
     tlog.log("Total Download", t_tot)
+    metrics.emit("download")
 
 
 def download_stream(
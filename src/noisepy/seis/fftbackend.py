@@ -0,0 +1,186 @@
+"""
+The FFTs of the pre-processing, correlation, stacking and monitoring functions go through the backend
+selected here, once per process, from the ``fft_library``, ``fft_workers`` and ``fft_wisdom_path``
+parameters:
+
+- ``scipy``: ``scipy.fft`` with ``workers`` threads per transform (pocketfft keeps its own plan cache)
+- ``pyfftw``: FFTW plans built once per (transform, shape, dtype, n, axis) and thread, and reused by all the
+  channels and pairs. The accumulated wisdom is loaded from and saved to ``fft_wisdom_path``.
+"""
+import logging
+import os
+import pickle
+import threading
+from typing import Optional
+
+import numpy as np
+import scipy.fft
+
+from .datatypes import ConfigParameters, FFTLibrary
+
+logger = logging.getLogger(__name__)
+
+# plans kept per thread by the pyfftw backend
+MAX_PLANS = 64
+
+
+class ScipyFFT:
+    """
+    ``scipy.fft`` transforms using ``workers`` threads
+    """
+
+    library = FFTLibrary.SCIPY
+
+    def __init__(self, workers: int = 1) -> None:
+        self.workers = workers
+
+    def rfft(self, x: np.ndarray, n: Optional[int] = None, axis: int = -1) -> np.ndarray:
+        return scipy.fft.rfft(x, n, axis=axis, workers=self.workers)
+
+    def irfft(self, x: np.ndarray, n: Optional[int] = None, axis: int = -1) -> np.ndarray:
+        return scipy.fft.irfft(x, n, axis=axis, workers=self.workers)
+
+    def fft(self, x: np.ndarray, n: Optional[int] = None, axis: int = -1) -> np.ndarray:
+        return scipy.fft.fft(x, n, axis=axis, workers=self.workers)
+
+    def ifft(self, x: np.ndarray, n: Optional[int] = None, axis: int = -1) -> np.ndarray:
+        return scipy.fft.ifft(x, n, axis=axis, workers=self.workers)
+
+    def save_wisdom(self):
+        pass
+
+
+class PyFFTW(ScipyFFT):
+    """
+    FFTW transforms through cached ``pyfftw.builders`` plans. The plans are not thread-safe, so each thread
+    has its own.
+    """
+
+    library = FFTLibrary.PYFFTW
+
+    def __init__(self, workers: int = 1, wisdom_path: str = "", planner_effort: str = "FFTW_MEASURE") -> None:
+        import pyfftw
+
+        super().__init__(workers)
+        self.pyfftw = pyfftw
+        self.wisdom_path = wisdom_path
+        self.planner_effort = planner_effort
+        self._local = threading.local()
+        if wisdom_path and os.path.exists(wisdom_path):
+            with open(wisdom_path, "rb") as f:
+                pyfftw.import_wisdom(pickle.load(f))
+            logger.info(f"Loaded the FFTW wisdom from {wisdom_path}")
+
+    def _plan(self, kind: str, x: np.ndarray, n: Optional[int], axis: int):
+        plans = getattr(self._local, "plans", None)
+        if plans is None:
+            plans = self._local.plans = {}
+        key = (kind, x.shape, x.dtype.str, n, axis)
+        plan = plans.get(key)
+        if plan is None:
+            if len(plans) >= MAX_PLANS:
+                plans.clear()
+            # planning overwrites the input, so plan on a scratch array
+            scratch = self.pyfftw.empty_aligned(x.shape, dtype=x.dtype)
+            builder = getattr(self.pyfftw.builders, kind)
+            plan = builder(scratch, n=n, axis=axis, threads=self.workers, planner_effort=self.planner_effort)
+            plans[key] = plan
+        return plan
+
+    def _execute(self, kind: str, x: np.ndarray, n: Optional[int], axis: int) -> np.ndarray:
+        x = np.asarray(x)
+        if x.dtype.kind not in "fc" or x.dtype.itemsize not in (4, 8, 16):
+            x = x.astype(np.complex128 if np.iscomplexobj(x) else np.float64)
+        # the output array belongs to the plan and is overwritten by its next execution
+        return self._plan(kind, x, n, axis)(x).copy()
+
+    def rfft(self, x: np.ndarray, n: Optional[int] = None, axis: int = -1) -> np.ndarray:
+        return self._execute("rfft", x, n, axis)
+
+    def irfft(self, x: np.ndarray, n: Optional[int] = None, axis: int = -1) -> np.ndarray:
+        return self._execute("irfft", x, n, axis)
+
+    def fft(self, x: np.ndarray, n: Optional[int] = None, axis: int = -1) -> np.ndarray:
+        return self._execute("fft", x, n, axis)
+
+    def ifft(self, x: np.ndarray, n: Optional[int] = None, axis: int = -1) -> np.ndarray:
+        return self._execute("ifft", x, n, axis)
+
+    def save_wisdom(self):
+        if not self.wisdom_path:
+            return
+        tmp = self.wisdom_path + ".tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(self.pyfftw.export_wisdom(), f)
+        os.replace(tmp, self.wisdom_path)
+
+
+_backend: ScipyFFT = ScipyFFT()
+_lock = threading.Lock()
+
+
+def configure(config: ConfigParameters) -> ScipyFFT:
+    """
+    Selects the FFT backend of this process from the configuration. Falls back to ``scipy`` if pyfftw is
+    not installed.
+    """
+    global _backend
+    with _lock:
+        if config.fft_library == FFTLibrary.PYFFTW:
+            if (
+                isinstance(_backend, PyFFTW)
+                and _backend.workers == config.fft_workers
+                and _backend.wisdom_path == config.fft_wisdom_path
+            ):
+                return _backend
+            try:
+                _backend = PyFFTW(config.fft_workers, config.fft_wisdom_path)
+            except ImportError:
+                logger.warning("pyfftw is not installed, using scipy.fft for the FFTs")
+                _backend = ScipyFFT(config.fft_workers)
+        elif not isinstance(_backend, PyFFTW) and _backend.workers == config.fft_workers:
+            return _backend
+        else:
+            _backend = ScipyFFT(config.fft_workers)
+        return _backend
+
+
+def get_backend() -> ScipyFFT:
+    return _backend
+
+
+def rfft(x: np.ndarray, n: Optional[int] = None, axis: int = -1) -> np.ndarray:
+    return _backend.rfft(x, n, axis)
+
+
+def irfft(x: np.ndarray, n: Optional[int] = None, axis: int = -1) -> np.ndarray:
+    return _backend.irfft(x, n, axis)
+
+
+def fft(x: np.ndarray, n: Optional[int] = None, axis: int = -1) -> np.ndarray:
+    return _backend.fft(x, n, axis)
+
+
+def ifft(x: np.ndarray, n: Optional[int] = None, axis: int = -1) -> np.ndarray:
+    return _backend.ifft(x, n, axis)
+
+
+def hilbert(x: np.ndarray, N: Optional[int] = None, axis: int = -1) -> np.ndarray:
+    """
+    Analytic signal as computed by ``scipy.signal.hilbert``, with the FFTs of the backend
+    """
+    if N is None:
+        N = x.shape[axis]
+    Xf = fft(x, N, axis=axis)
+    h = np.zeros(N, dtype=Xf.real.dtype)
+    if N % 2 == 0:
+        h[0] = h[N // 2] = 1
+        h[1 : N // 2] = 2
+    else:
+        h[0] = 1
+        h[1 : (N + 1) // 2] = 2
+    if x.ndim > 1:
+        ind = [np.newaxis] * x.ndim
+        ind[axis] = slice(None)
+        h = h[tuple(ind)]
+    return ifft(Xf * h, axis=axis)
@@ -0,0 +1,125 @@
+import hashlib
+import io
+import json
+import logging
+from typing import Optional
+
+import numpy as np
+from datetimerange import DateTimeRange
+
+from noisepy.seis.io.datatypes import Channel, NoiseFFT, to_json_types
+from noisepy.seis.io.stores import timespan_str
+from noisepy.seis.io.utils import fs_join, get_filesystem
+
+from .datatypes import ConfigParameters, band_offset, make_noise_fft
+
+logger = logging.getLogger(__name__)
+
+FILE_PARAMS_JSON = "params.json"
+NPZ_EXTENSION = ".npz"
+
+# The parameters used by the read, pre-processing and FFT steps. FFTs computed with the same values
+# for all of these are the same, whatever the other (correlation, stacking, execution) parameters.
+FFT_PARAMETERS = [
+    "samp_freq",
+    "single_freq",
+    "resample_method",
+    "rm_resp",
+    "rm_resp_out",
+    "respdir",
+    "freqmin",
+    "freqmax",
+    "inc_hours",
+    "cc_len",
+    "step",
+    "time_norm",
+    "freq_norm",
+    "smooth_N",
+    "max_over_std",
+    "reject_windows_early",
+    "band_limited_fft",
+    "preprocess_engine",
+    "fft_library",
+]
+# band_limited_fft keeps a margin of smoothspect_N bins around the band
+BAND_PARAMETERS = ["smoothspect_N"]
+
+
+def fft_parameters(fft_params: ConfigParameters) -> dict:
+    """
+    The values of the parameters that determine the FFT of a channel's data
+    """
+    keys = FFT_PARAMETERS + (BAND_PARAMETERS if fft_params.band_limited_fft else [])
+    return to_json_types({k: getattr(fft_params, k) for k in keys})
+
+
+def fft_params_hash(fft_params: ConfigParameters) -> str:
+    """
+    A hash of the parameters that determine the FFT of a channel's data
+    """
+    js = json.dumps(fft_parameters(fft_params), sort_keys=True, default=str)
+    return hashlib.sha256(js.encode("utf-8")).hexdigest()[:16]
+
+
+class NumpyFFTStore:
+    """
+    A store for the ``NoiseFFT`` of each channel and timespan, to skip reading, pre-processing and FFT
+    when re-running the cross-correlation with different correlation parameters. The FFTs are saved in
+    ``.npz`` files under ``<root_dir>/<parameters hash>/<timespan>/<channel>.npz``, so changing any of the
+    ``FFT_PARAMETERS`` (and ``BAND_PARAMETERS`` for band limited FFTs) starts a new, separate cache.
+    """
+
+    def __init__(self, root_dir: str, fft_params: ConfigParameters, storage_options={}) -> None:
+        self.fs = get_filesystem(root_dir, storage_options=storage_options)
+        self.root_dir = fs_join(root_dir, fft_params_hash(fft_params))
+        self.fs.makedirs(self.root_dir, exist_ok=True)
+        # keep the parameters along with the FFTs for reference
+        params_file = fs_join(self.root_dir, FILE_PARAMS_JSON)
+        if not self.fs.exists(params_file):
+            params = fft_parameters(fft_params)
+            with self.fs.open(params_file, "w") as f:
+                json.dump(params, f, default=str)
+        logger.info(f"FFT store at {self.root_dir}")
+
+    def _path(self, ts: DateTimeRange, chan: Channel) -> str:
+        return fs_join(fs_join(self.root_dir, timespan_str(ts)), f"{chan}{NPZ_EXTENSION}")
+
+    def contains(self, ts: DateTimeRange, chan: Channel) -> bool:
+        return self.fs.exists(self._path(ts, chan))
+
+    def append(self, ts: DateTimeRange, chan: Channel, fft: NoiseFFT):
+        path = self._path(ts, chan)
+        self.fs.makedirs(fs_join(self.root_dir, timespan_str(ts)), exist_ok=True)
+        with io.BytesIO() as buf:
+            np.savez(
+                buf,
+                fft=fft.fft,
+                std=fft.std,
+                fft_time=fft.fft_time,
+                shape=np.array([fft.window_count, fft.length]),
+                offset=-1 if band_offset(fft) is None else band_offset(fft),
+            )
+            with self.fs.open(path, "wb") as f:
+                f.write(buf.getbuffer())
+
+    def read(self, ts: DateTimeRange, chan: Channel) -> Optional[NoiseFFT]:
+        path = self._path(ts, chan)
+        if not self.fs.exists(path):
+            return None
+        try:
+            with self.fs.open(path, "rb") as f:
+                with np.load(io.BytesIO(f.read()), allow_pickle=False) as data:
+                    window_count, length = data["shape"]
+                    # -1 (or no offset, in older files) for the full spectra
+                    offset = int(data["offset"]) if "offset" in data else -1
+                    return make_noise_fft(
+                        data["fft"],
+                        data["std"],
+                        data["fft_time"],
+                        int(window_count),
+                        int(length),
+                        offset if offset >= 0 else None,
+                    )
+        except Exception as e:
+            logger.error(f"Error reading {path}: {e}")
+            return None
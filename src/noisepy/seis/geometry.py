@@ -0,0 +1,170 @@
+import logging
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+import obspy
+from scipy.spatial import cKDTree
+
+from noisepy.seis.io.datatypes import Station
+
+logger = logging.getLogger(__name__)
+
+# WGS84 ellipsoid, as used by obspy.geodetics
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+# the sphere used for the spatial index, with a margin for the difference with the ellipsoid distances
+INDEX_RADIUS_KM = 6371.0
+INDEX_MARGIN = 1.01
+
+
+def gps2dist_azimuth(
+    lat1: np.ndarray, lon1: np.ndarray, lat2: np.ndarray, lon2: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Vectorized counterpart of ``obspy.geodetics.gps2dist_azimuth``: great circle distance (m), azimuth and
+    back-azimuth (degrees) between arrays of points on the WGS84 ellipsoid, with Vincenty's inverse formula.
+    The few pairs where the iteration doesn't converge (nearly antipodal points) fall back to obspy.
+    """
+    lat1, lon1, lat2, lon2 = np.broadcast_arrays(*(np.asarray(x, dtype=np.float64) for x in (lat1, lon1, lat2, lon2)))
+    a = WGS84_A
+    f = WGS84_F
+    b = a * (1 - f)
+    L = np.radians(lon2 - lon1)
+    U1 = np.arctan((1 - f) * np.tan(np.radians(lat1)))
+    U2 = np.arctan((1 - f) * np.tan(np.radians(lat2)))
+    sinU1, cosU1 = np.sin(U1), np.cos(U1)
+    sinU2, cosU2 = np.sin(U2), np.cos(U2)
+
+    lam = L.copy()
+    converged = np.zeros(L.shape, dtype=bool)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for _ in range(200):
+            sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+            sin_sigma = np.sqrt((cosU2 * sin_lam) ** 2 + (cosU1 * sinU2 - sinU1 * cosU2 * cos_lam) ** 2)
+            cos_sigma = sinU1 * sinU2 + cosU1 * cosU2 * cos_lam
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+            sin_alpha = np.where(sin_sigma == 0, 0.0, cosU1 * cosU2 * sin_lam / sin_sigma)
+            cos2_alpha = 1 - sin_alpha**2
+            # equatorial lines have cos2_alpha == 0
+            cos_2sigma_m = np.where(cos2_alpha == 0, 0.0, cos_sigma - 2 * sinU1 * sinU2 / cos2_alpha)
+            C = f / 16 * cos2_alpha * (4 + f * (4 - 3 * cos2_alpha))
+            lam_prev = lam
+            lam = L + (1 - C) * f * sin_alpha * (
+                sigma + C * sin_sigma * (cos_2sigma_m + C * cos_sigma * (-1 + 2 * cos_2sigma_m**2))
+            )
+            converged = np.abs(lam - lam_prev) < 1e-12
+            if converged.all():
+                break
+
+        u2 = cos2_alpha * (a**2 - b**2) / b**2
+        A = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+        B = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+        delta_sigma = (
+            B
+            * sin_sigma
+            * (
+                cos_2sigma_m
+                + B
+                / 4
+                * (
+                    cos_sigma * (-1 + 2 * cos_2sigma_m**2)
+                    - B / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma**2) * (-3 + 4 * cos_2sigma_m**2)
+                )
+            )
+        )
+        dist = b * A * (sigma - delta_sigma)
+        sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+        alpha1 = np.arctan2(cosU2 * sin_lam, cosU1 * sinU2 - sinU1 * cosU2 * cos_lam)
+        alpha2 = np.arctan2(cosU1 * sin_lam, -sinU1 * cosU2 + cosU1 * sinU2 * cos_lam)
+    azi = np.degrees(alpha1) % 360.0
+    baz = (np.degrees(alpha2) + 180.0) % 360.0
+    # coincident points
+    same = (lat1 == lat2) & (lon1 == lon2)
+    dist[same] = 0.0
+    azi[same] = 0.0
+    baz[same] = 0.0
+
+    failed = ~converged & ~same
+    for i in zip(*np.nonzero(failed)):
+        dist[i], azi[i], baz[i] = obspy.geodetics.base.gps2dist_azimuth(lat1[i], lon1[i], lat2[i], lon2[i])
+    return dist, azi, baz
+
+
+class StationGeometry:
+    """
+    Table of the distance (km), azimuth and back-azimuth between stations. The values are computed for many
+    station pairs at once with vectorized geodesics and kept for the rest of the run. A spatial index (KD-tree
+    over the station locations) selects the pairs within a distance range without going over all of them.
+    """
+
+    def __init__(self):
+        self.pairs: Dict[Tuple[str, str], Tuple[float, float, float]] = {}
+
+    def compute(self, pairs: Iterable[Tuple[Station, Station]]):
+        """
+        Computes the geometry of the station pairs that are not in the table yet, all together
+        """
+        todo = [(src, rec) for src, rec in pairs if (str(src), str(rec)) not in self.pairs]
+        if len(todo) == 0:
+            return
+        coords = np.array([(src.lat, src.lon, rec.lat, rec.lon) for src, rec in todo], dtype=np.float64)
+        dist, azi, baz = gps2dist_azimuth(coords[:, 0], coords[:, 1], coords[:, 2], coords[:, 3])
+        for (src, rec), d, a, b in zip(todo, dist / 1000.0, azi, baz):
+            self.pairs[(str(src), str(rec))] = (float(d), float(a), float(b))
+        logger.debug(f"Computed the geometry of {len(todo)} station pairs, {len(self.pairs)} in total")
+
+    def get(self, src: Station, rec: Station) -> Tuple[float, float, float]:
+        """
+        Distance (km), azimuth and back-azimuth from ``src`` to ``rec``
+        """
+        key = (str(src), str(rec))
+        if key not in self.pairs:
+            reverse = self.pairs.get((str(rec), str(src)))
+            if reverse is not None:
+                # the azimuth from the receiver is the back-azimuth from the source and vice versa
+                return (reverse[0], reverse[2], reverse[1])
+            self.compute([(src, rec)])
+        return self.pairs[key]
+
+    def subset(self, pairs: Iterable[Tuple[Station, Station]]) -> "StationGeometry":
+        """
+        A table with only the given station pairs, e.g. to send to worker processes
+        """
+        geometry = StationGeometry()
+        for src, rec in pairs:
+            geometry.pairs[(str(src), str(rec))] = self.get(src, rec)
+        return geometry
+
+    def station_pairs(
+        self, stations: List[Station], min_distance: float = 0.0, max_distance: float = 0.0
+    ) -> List[Tuple[int, int]]:
+        """
+        Sorted (i, j) pairs of indices in ``stations``, with i <= j, of the stations between ``min_distance``
+        and ``max_distance`` km of each other. A ``max_distance`` of 0 means no maximum. Each station is always
+        paired with itself.
+        """
+        n = len(stations)
+        if max_distance > 0:
+            # candidates within the chord of the maximum distance on a sphere, with some margin for the ellipsoid
+            tree = cKDTree(_unit_vectors(stations))
+            chord = 2 * np.sin(min(np.pi, INDEX_MARGIN * max_distance / INDEX_RADIUS_KM) / 2)
+            candidates = tree.query_pairs(chord, output_type="ndarray").reshape(-1, 2)
+            ii = np.concatenate([np.arange(n), candidates.min(axis=1)])
+            jj = np.concatenate([np.arange(n), candidates.max(axis=1)])
+        else:
+            ii, jj = np.triu_indices(n)
+        if min_distance > 0 or max_distance > 0:
+            lat = np.array([sta.lat for sta in stations], dtype=np.float64)
+            lon = np.array([sta.lon for sta in stations], dtype=np.float64)
+            dist = gps2dist_azimuth(lat[ii], lon[ii], lat[jj], lon[jj])[0] / 1000.0
+            keep = (dist >= min_distance) | (ii == jj)
+            if max_distance > 0:
+                keep &= dist <= max_distance
+            ii, jj = ii[keep], jj[keep]
+        return sorted(zip(ii.tolist(), jj.tolist()))
+
+
+def _unit_vectors(stations: List[Station]) -> np.ndarray:
+    lat = np.radians([sta.lat for sta in stations])
+    lon = np.radians([sta.lon for sta in stations])
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1).reshape(-1, 3)
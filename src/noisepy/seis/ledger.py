@@ -0,0 +1,135 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+from typing import Iterable, List, Set, Tuple
+
+from datetimerange import DateTimeRange
+
+from noisepy.seis.io.datatypes import Channel, Station
+from noisepy.seis.io.stores import timespan_str
+
+from .constants import DONE_PATH
+
+logger = logging.getLogger(__name__)
+
+LEDGER_FILE = f"{DONE_PATH}.sqlite"
+# seconds to wait for other processes (e.g. MPI ranks) holding the database lock
+LOCK_TIMEOUT = 60.0
+
+STEP_CC = "cc"
+STEP_STACK = "stack"
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS pairs (step TEXT, timespan TEXT, src TEXT, rec TEXT, "
+    "PRIMARY KEY (step, timespan, src, rec)) WITHOUT ROWID",
+    # the timespans done for a selection of channels and station pairs, see selection_key
+    "CREATE TABLE IF NOT EXISTS timespan_selections (step TEXT, timespan TEXT, selection TEXT, "
+    "PRIMARY KEY (step, timespan, selection)) WITHOUT ROWID",
+]
+
+
+def selection_key(channels: Iterable[Channel], pairs: Iterable[Tuple[Station, Station]]) -> str:
+    """
+    Hash of the channels and station pairs selected for a timespan. A timespan is only done for the selection it
+    was recorded with, so it is processed again e.g. when more stations are available or the pair selection
+    (pair filter, distances) changed.
+    """
+    h = hashlib.sha1()
+    for ch in sorted(map(str, channels)):
+        h.update(f"{ch}\n".encode())
+    h.update(b"\0")
+    for pair in sorted(f"{src}_{rec}" for src, rec in pairs):
+        h.update(f"{pair}\n".encode())
+    return h.hexdigest()
+
+
+class CompletionLedger:
+    """
+    A local SQLite database of the station pairs and timespans that are done, so that resuming a run only
+    needs a few bulk queries instead of a ``contains`` call to the store (a remote request on S3) for each
+    station pair. The correlation and stacking steps record their completions separately.
+
+    The ledger only knows about what was recorded in it: pairs that are not in it are still looked up in the
+    stores, so it can be added to an existing output. Use a separate ledger for each output directory.
+    """
+
+    def __init__(self, path: str) -> None:
+        if os.path.isdir(path):
+            path = os.path.join(path, LEDGER_FILE)
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            for stmt in SCHEMA:
+                conn.execute(stmt)
+        logger.info(f"Completion ledger at {self.path}")
+
+    def __getstate__(self):
+        # connections can't be shared across processes, each one opens its own
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.path = state["path"]
+        self._local = threading.local()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=LOCK_TIMEOUT)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def done_pairs(self, step: str, ts: DateTimeRange) -> Set[Tuple[str, str]]:
+        """
+        The ``(str(src), str(rec))`` station pairs done for the timespan
+        """
+        conn = self._connect()
+        rows = conn.execute(
+            "SELECT src, rec FROM pairs WHERE step = ? AND timespan = ?", (step, timespan_str(ts))
+        ).fetchall()
+        return set(rows)
+
+    def is_done(self, step: str, ts: DateTimeRange, src: Station, rec: Station) -> bool:
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT 1 FROM pairs WHERE step = ? AND timespan = ? AND src = ? AND rec = ?",
+            (step, timespan_str(ts), str(src), str(rec)),
+        ).fetchone()
+        return row is not None
+
+    def mark_pairs(self, step: str, ts: DateTimeRange, pairs: Iterable[Tuple[Station, Station]]):
+        rows = [(step, timespan_str(ts), str(src), str(rec)) for src, rec in pairs]
+        if len(rows) == 0:
+            return
+        with self._connect() as conn:
+            conn.executemany("INSERT OR IGNORE INTO pairs VALUES (?, ?, ?, ?)", rows)
+
+    def timespan_done(self, step: str, ts: DateTimeRange, selection: str) -> bool:
+        """
+        Whether all the station pairs of the timespan were done for the ``selection_key`` of its channels and pairs
+        """
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT 1 FROM timespan_selections WHERE step = ? AND timespan = ? AND selection = ?",
+            (step, timespan_str(ts), selection),
+        ).fetchone()
+        return row is not None
+
+    def mark_timespan(self, step: str, ts: DateTimeRange, selection: str):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO timespan_selections VALUES (?, ?, ?)", (step, timespan_str(ts), selection)
+            )
+
+    def filter_done(
+        self, step: str, ts: DateTimeRange, pairs: List[Tuple[Station, Station]]
+    ) -> Tuple[List[Tuple[Station, Station]], List[Tuple[Station, Station]]]:
+        """
+        Splits the station pairs into the ones recorded as done and the others
+        """
+        done = self.done_pairs(step, ts)
+        recorded = [p for p in pairs if (str(p[0]), str(p[1])) in done]
+        unknown = [p for p in pairs if (str(p[0]), str(p[1])) not in done]
+        return recorded, unknown
@@ -17,7 +17,6 @@ from noisepy.seis.io.channel_filter_store import (
     channel_filter,
 )
 from noisepy.seis.io.channelcatalog import CSVChannelCatalog, XMLStationChannelCatalog
-from noisepy.seis.io.datatypes import ConfigParameters
 from noisepy.seis.io.numpystore import NumpyCCStore, NumpyStackStore
 from noisepy.seis.io.s3store import SCEDCS3DataStore
 from noisepy.seis.io.utils import fs_join, get_filesystem, io_retry
@@ -26,6 +25,7 @@ from noisepy.seis.io.zarrstore import ZarrCCStore, ZarrStackStore
 from . import __version__
 from .constants import CONFIG_FILE, STATION_FILE
 from .correlate import cross_correlate
+from .datatypes import ConfigParameters
 from .fdsn_download import download
 from .scheduler import (
     AWSBatchArrayScheduler,
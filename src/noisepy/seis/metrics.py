@@ -0,0 +1,178 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+import psutil
+
+from .datatypes import ConfigParameters, MetricsFormat
+
+try:
+    import resource
+except ImportError:
+    # not on Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+PROMETHEUS_PREFIX = "noisepy"
+# labels of the unit of work (e.g. each timespan) of a record, not kept as Prometheus labels: a new series for
+# each of them would grow the textfile without limit
+PROMETHEUS_UNIT_LABELS = ["timespan", "chunk"]
+
+
+class MetricsSink(ABC):
+    """
+    Where the metrics records of the pipeline stages are written
+    """
+
+    @abstractmethod
+    def write(self, record: dict):
+        pass
+
+
+class JsonLinesSink(MetricsSink):
+    """
+    Appends one JSON object per record to a local file
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+
+    def write(self, record: dict):
+        line = json.dumps(record, default=str)
+        with self.lock:
+            with open(self.path, "a") as f:
+                f.write(line + "\n")
+
+
+class PrometheusSink(MetricsSink):
+    """
+    Keeps the latest values of each stage and label set in a Prometheus textfile, e.g. for the
+    node_exporter textfile collector. The file is replaced atomically on every write. The
+    ``PROMETHEUS_UNIT_LABELS`` are dropped, so e.g. the timespan records only keep the latest one.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.samples: Dict[str, float] = {}
+
+    def write(self, record: dict):
+        labels = {k: v for k, v in record["labels"].items() if k not in PROMETHEUS_UNIT_LABELS}
+        labels["stage"] = record["stage"]
+        label_str = ",".join(f'{k}="{_escape(str(v))}"' for k, v in sorted(labels.items()))
+        with self.lock:
+            self.samples[f"{PROMETHEUS_PREFIX}_elapsed_seconds{{{label_str}}}"] = record["elapsed"]
+            for kind in ["counters", "timers", "gauges"]:
+                for name, value in record[kind].items():
+                    suffix = "_seconds" if kind == "timers" else ""
+                    self.samples[f"{PROMETHEUS_PREFIX}_{name}{suffix}{{{label_str}}}"] = value
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                for sample, value in sorted(self.samples.items()):
+                    f.write(f"{sample} {value}\n")
+            os.replace(tmp, self.path)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metrics:
+    """
+    Thread-safe counters, timers (total seconds) and high-water marks for one pipeline stage. ``emit`` writes
+    them to the sink as a record and starts over, so the same object can be used for e.g. each timespan.
+    Without a sink nothing is written and the values are only kept in memory.
+    """
+
+    def __init__(self, sink: Optional[MetricsSink] = None) -> None:
+        self.sink = sink
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.counters: Dict[str, float] = {}
+        self.timers: Dict[str, float] = {}
+        self.gauges: Dict[str, float] = {}
+        self.start = time.time()
+
+    def count(self, name: str, value: float = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name: str, value: float):
+        with self.lock:
+            self.gauges[name] = value
+
+    def high_water(self, name: str, value: float):
+        with self.lock:
+            self.gauges[name] = max(self.gauges.get(name, value), value)
+
+    def memory(self):
+        """
+        Updates the peak resident memory of the process
+        """
+        self.high_water("peak_rss_bytes", peak_rss())
+
+    def add_time(self, name: str, seconds: float):
+        with self.lock:
+            self.timers[name] = self.timers.get(name, 0.0) + seconds
+
+    @contextmanager
+    def timer(self, name: str):
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - t0)
+
+    def emit(self, stage: str, **labels):
+        self.memory()
+        with self.lock:
+            record = {
+                "time": datetime.now(timezone.utc).isoformat(),
+                "stage": stage,
+                "labels": labels,
+                "elapsed": time.time() - self.start,
+                "counters": self.counters,
+                "timers": self.timers,
+                "gauges": self.gauges,
+            }
+            self._reset()
+        if self.sink is None:
+            return
+        try:
+            self.sink.write(record)
+        except Exception as e:
+            logger.warning(f"Error writing the metrics of {stage}: {e}")
+
+
+def peak_rss() -> int:
+    """
+    Peak resident memory (bytes) of the process since it started
+    """
+    if resource is None:
+        info = psutil.Process().memory_info()
+        return getattr(info, "peak_wset", info.rss)
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def create_metrics(config: ConfigParameters) -> Metrics:
+    """
+    Metrics writing to the sink configured by ``metrics_path`` and ``metrics_format``, if any
+    """
+    if not config.metrics_path:
+        return Metrics()
+    if config.metrics_format == MetricsFormat.PROMETHEUS:
+        return Metrics(PrometheusSink(config.metrics_path))
+    return Metrics(JsonLinesSink(config.metrics_path))
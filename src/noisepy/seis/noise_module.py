@@ -4,19 +4,23 @@
 # noqa: F811
 
 import datetime
+import functools
 import glob
 import logging
 import os
+from fractions import Fraction
+from typing import Dict, List, Optional, Tuple
 
 import numpy as np
 import obspy
 import scipy
+import scipy.signal
 from numba import jit
 from obspy.core.util.base import _get_function_from_entry_point
 from obspy.signal.filter import bandpass
 from obspy.signal.util import _npts2nfft
 from scipy.fftpack import next_fast_len
-from scipy.signal import hilbert
+from scipy.ndimage import uniform_filter1d
 
 from noisepy.seis.io.datatypes import (
     CCMethod,
@@ -28,7 +32,13 @@ from noisepy.seis.io.datatypes import (
     TimeNorm,
 )
 
+from . import fftbackend
+from .datatypes import ResampleMethod
+from .response import ResponseCache, remove_response
+
 logger = logging.getLogger(__name__)
+# largest up or down factor of the polyphase resampling
+MAX_POLYPHASE_FACTOR = 1000
 """
 This VERY LONG noise module file is necessary to keep the NoisePy working properly. In general,
 the modules are organized based on their functionality in the following way. it includes:
@@ -78,6 +88,8 @@ def preprocess_raw(
     prepro_para: ConfigParameters,
     starttime: obspy.UTCDateTime,
     endtime: obspy.UTCDateTime,
+    response_cache: Optional[ResponseCache] = None,
+    resample_method: ResampleMethod = ResampleMethod.FFT,
 ):
     """
     this function pre-processes the raw data stream by:
@@ -99,19 +111,95 @@ def preprocess_raw(
     prepro_para: dict containing fft parameters, such as frequency bands and
     selection for instrument response removal etc.
     date_info:   dict of start and end time of the stream data
+    response_cache: optional cache of the evaluated instrument responses, reused across calls
+    resample_method: 'polyphase' to decimate by a rational factor before the bandpass filter, instead of
+    the FFT resampling after it
     RETURNS:
     -----------------------
     ntr: obspy stream object of cleaned, merged and filtered noise data
     """
-    # load paramters from fft dict
-    rm_resp = prepro_para["rm_resp"]
-    rm_resp_out = prepro_para["rm_resp_out"]
-    respdir = prepro_para["respdir"]
+    pre_filt = prefilter_band(prepro_para)
+
+    # check sampling rate and trace length
+    st = check_sample_gaps(st, starttime, endtime)
+    if len(st) == 0:
+        logger.warning("No traces in Stream: Continue!")
+        return st
+    decimation = decimation_factors(st[0].stats.sampling_rate, prepro_para["samp_freq"], resample_method)
+    st = clean_and_filter(st, pre_filt, decimation)
+    return resample_and_remove_response(st, inv, prepro_para, pre_filt, starttime, endtime, response_cache)
+
+
+def preprocess_raw_batch(
+    streams: List[obspy.Stream],
+    invs: List[obspy.Inventory],
+    prepro_para: ConfigParameters,
+    starttime: obspy.UTCDateTime,
+    endtime: obspy.UTCDateTime,
+    response_cache: Optional[ResponseCache] = None,
+    resample_method: ResampleMethod = ResampleMethod.FFT,
+) -> List[obspy.Stream]:
+    """
+    Same as preprocess_raw for a list of streams, e.g. all the channels of a timespan. The gap-free streams
+    that share a sampling rate and length are stacked into a 2D float32 array that is cleaned, detrended,
+    tapered and filtered with single vectorized calls. The other streams (e.g. with gaps to merge) go
+    through the per-trace obspy path. The resampling, response removal and trimming are done per stream.
+    PARAMETERS:
+    -----------------------
+    streams: obspy stream objects, modified in place
+    invs: obspy inventory objects of each stream
+    prepro_para: pre-processing parameters, see preprocess_raw
+    response_cache: optional cache of the evaluated instrument responses
+    resample_method: see preprocess_raw
+    RETURNS:
+    -----------------------
+    list of pre-processed streams, in the same order
+    """
+    pre_filt = prefilter_band(prepro_para)
+    streams = [check_sample_gaps(st, starttime, endtime) for st in streams]
+
+    groups: Dict[Tuple[float, int], List[int]] = {}
+    for i, st in enumerate(streams):
+        if len(st) == 0:
+            logger.warning("No traces in Stream: Continue!")
+            continue
+        sampling_rate = st[0].stats.sampling_rate
+        decimation = decimation_factors(sampling_rate, prepro_para["samp_freq"], resample_method)
+        sps = sampling_rate * decimation[0] / decimation[1] if decimation else int(sampling_rate)
+        if len(st) == 1 and _bandpass_sos(pre_filt[0], pre_filt[-1], sps) is not None:
+            groups.setdefault((sampling_rate, st[0].stats.npts), []).append(i)
+        else:
+            streams[i] = clean_and_filter(st, pre_filt, decimation)
+
+    for (sampling_rate, npts), indices in groups.items():
+        decimation = decimation_factors(sampling_rate, prepro_para["samp_freq"], resample_method)
+        data = np.empty((len(indices), npts), dtype=np.float32)
+        for row, i in enumerate(indices):
+            data[row] = streams[i][0].data
+        data = clean_and_filter_2D(data, sampling_rate, pre_filt, decimation)
+        for row, i in enumerate(indices):
+            streams[i][0].data = data[row]
+            if decimation:
+                streams[i][0].stats.sampling_rate = sampling_rate * decimation[0] / decimation[1]
+                align_start(streams[i])
+        del data
+
+    return [
+        resample_and_remove_response(st, inv, prepro_para, pre_filt, starttime, endtime, response_cache)
+        if len(st)
+        else st
+        for st, inv in zip(streams, invs)
+    ]
+
+
+def prefilter_band(prepro_para: ConfigParameters) -> List[float]:
+    """
+    corner frequencies of the butterworth filter (and response removal pre-filter) of the pre-processing
+    """
     freqmin = prepro_para["freqmin"]
     freqmax = prepro_para["freqmax"]
     samp_freq = prepro_para["samp_freq"]
 
-    # parameters for butterworth filter
     f1 = 0.9 * freqmin
     f2 = freqmin
     if 1.1 * freqmax > 0.45 * samp_freq:
@@ -120,16 +208,18 @@ def preprocess_raw(
     else:
         f3 = freqmax
         f4 = 1.1 * freqmax
-    pre_filt = [f1, f2, f3, f4]
+    return [f1, f2, f3, f4]
 
-    # check sampling rate and trace length
-    st = check_sample_gaps(st, starttime, endtime)
-    if len(st) == 0:
-        logger.warning("No traces in Stream: Continue!")
-        return st
-    sps = int(st[0].stats.sampling_rate)
-    station = st[0].stats.station
 
+def clean_and_filter(
+    st: obspy.Stream, pre_filt: List[float], decimation: Optional[Tuple[int, int]] = None
+) -> obspy.Stream:
+    """
+    removes the nan/inf values, mean and trend of each trace, merges them and applies the taper and
+    zero-phase bandpass filter of the pre-processing. With the (up, down) factors of decimation, the
+    merged trace is decimated with a polyphase filter before the taper and bandpass.
+    """
+    sps = int(st[0].stats.sampling_rate)
     # remove nan/inf, mean and trend of each trace before merging
     for ii in range(len(st)):
         # -----set nan/inf values to zeros (it does happens!)-----
@@ -148,22 +238,170 @@ def preprocess_raw(
     # merge, taper and filter the data
     if len(st) > 1:
         st.merge(method=1, fill_value=0)
+    if decimation:
+        sampling_rate = st[0].stats.sampling_rate * decimation[0] / decimation[1]
+        st[0].data = np.float32(polyphase_resample(st[0].data, *decimation))
+        st[0].stats.sampling_rate = sampling_rate
+        sps = sampling_rate
     st[0].taper(max_percentage=0.05, max_length=50)  # taper window
     st[0].data = np.float32(bandpass(st[0].data, pre_filt[0], pre_filt[-1], df=sps, corners=4, zerophase=True))
+    if decimation:
+        align_start(st)
+    return st
+
+
+def clean_and_filter_2D(
+    data: np.ndarray, sampling_rate: float, pre_filt: List[float], decimation: Optional[Tuple[int, int]] = None
+) -> np.ndarray:
+    """
+    vectorized clean_and_filter of single-trace streams: each row of data is the record of a channel,
+    all with the same sampling rate. Gives the same result as the obspy functions.
+    PARAMETERS:
+    ---------------------
+    data: (nchan, npts) float32 data matrix, modified in place
+    sampling_rate: sampling rate of the data
+    pre_filt: corner frequencies from prefilter_band
+    decimation: optional (up, down) factors of the polyphase decimation before the bandpass
+    RETURNS:
+    ---------------------
+    data: (nchan, npts) float32 filtered data matrix, with fewer samples when decimated
+    """
+    sps = int(sampling_rate)
+    data[~np.isfinite(data)] = 0
+    data = scipy.signal.detrend(data, axis=-1, type="constant")
+    data = scipy.signal.detrend(data, axis=-1, type="linear")
+    data *= _obspy_taper_window(data.shape[1], sampling_rate, 0.05, None)
+    if decimation:
+        data = np.float32(polyphase_resample(data, *decimation))
+        sampling_rate = sampling_rate * decimation[0] / decimation[1]
+        sps = sampling_rate
+    data *= _obspy_taper_window(data.shape[1], sampling_rate, 0.05, 50)
+
+    # zero-phase filter as in obspy.signal.filter.bandpass: forwards and backwards
+    # sosfilt needs a writeable array (scipy < 1.13), the cached one is read-only
+    sos = _bandpass_sos(pre_filt[0], pre_filt[-1], sps).copy()
+    firstpass = scipy.signal.sosfilt(sos, data, axis=-1)
+    del data
+    filtered = scipy.signal.sosfilt(sos, firstpass[:, ::-1], axis=-1)[:, ::-1]
+    del firstpass
+    return np.ascontiguousarray(filtered, dtype=np.float32)
+
+
+@functools.lru_cache(maxsize=None)
+def _bandpass_sos(freqmin: float, freqmax: float, df: float, corners: int = 4) -> Optional[np.ndarray]:
+    """
+    second-order sections of the butterworth bandpass designed by obspy.signal.filter.bandpass, or None
+    when obspy would switch to a highpass or fail because the band is above nyquist
+    """
+    fe = 0.5 * df
+    low = freqmin / fe
+    high = freqmax / fe
+    if high - 1.0 > -1e-6 or low > 1:
+        return None
+    z, p, k = scipy.signal.iirfilter(corners, [low, high], btype="band", ftype="butter", output="zpk")
+    sos = scipy.signal.zpk2sos(z, p, k)
+    sos.setflags(write=False)
+    return sos
+
+
+@functools.lru_cache(maxsize=32)
+def _obspy_taper_window(npts: int, sampling_rate: float, max_percentage: float, max_length: Optional[float]):
+    """
+    hann taper window of obspy.core.trace.Trace.taper
+    """
+    max_half_lengths = [int(max_percentage * npts)]
+    if max_length is not None:
+        max_half_lengths.append(int(max_length * sampling_rate))
+    max_half_lengths.append(int(npts / 2))
+    wlen = min(max_half_lengths)
+    func = _get_function_from_entry_point("taper", "hann")
+    if 2 * wlen == npts:
+        taper_sides = func(2 * wlen)
+    else:
+        taper_sides = func(2 * wlen + 1)
+    win = np.hstack(
+        (
+            taper_sides[:wlen],
+            np.ones(npts - 2 * wlen),
+            taper_sides[len(taper_sides) - wlen :],
+        )
+    )
+    win.setflags(write=False)
+    return win
+
+
+def decimation_factors(
+    sampling_rate: float, samp_freq: float, resample_method: ResampleMethod
+) -> Optional[Tuple[int, int]]:
+    """
+    (up, down) factors of the polyphase decimation from sampling_rate to samp_freq, or None when the data is
+    resampled with FFTs: resample_method is 'fft', the target rate is not lower or the ratio is not a simple
+    fraction (which would need very long filters)
+    """
+    if resample_method != ResampleMethod.POLYPHASE or samp_freq >= sampling_rate - 1e-4:
+        return None
+    ratio = Fraction(samp_freq) / Fraction(sampling_rate)
+    if max(ratio.numerator, ratio.denominator) > MAX_POLYPHASE_FACTOR:
+        return None
+    return ratio.numerator, ratio.denominator
+
+
+def polyphase_resample(data: np.ndarray, up: int, down: int) -> np.ndarray:
+    """
+    resamples data (along its last axis) by up / down with scipy.signal.resample_poly and a cached FIR filter
+    """
+    return scipy.signal.resample_poly(data, up, down, axis=-1, window=_polyphase_fir(up, down))
+
+
+@functools.lru_cache(maxsize=None)
+def _polyphase_fir(up: int, down: int) -> np.ndarray:
+    # the anti-aliasing low-pass filter that scipy.signal.resample_poly designs on every call
+    max_rate = max(up, down)
+    h = scipy.signal.firwin(2 * 10 * max_rate + 1, 1.0 / max_rate, window=("kaiser", 5.0))
+    h.setflags(write=False)
+    return h
+
+
+def align_start(st: obspy.Stream):
+    """
+    shifts the data of the (resampled) trace to start on a whole sample when its starttime is between
+    sampling points
+    """
+    delta = st[0].stats.delta
+    fric = st[0].stats.starttime.microsecond % (delta * 1e6)
+    if fric > 1e-4:
+        st[0].data = segment_interpolate(np.float32(st[0].data), float(fric / (delta * 1e6)))
+        # --reset the time to remove the discrepancy---
+        st[0].stats.starttime -= fric * 1e-6
+
+
+def resample_and_remove_response(
+    st: obspy.Stream,
+    inv: obspy.Inventory,
+    prepro_para: ConfigParameters,
+    pre_filt: List[float],
+    starttime: obspy.UTCDateTime,
+    endtime: obspy.UTCDateTime,
+    response_cache: Optional[ResponseCache] = None,
+) -> obspy.Stream:
+    """
+    last steps of preprocess_raw on the filtered stream: downsampling, instrument response removal and
+    trimming to the starttime-endtime sequence
+    """
+    rm_resp = prepro_para["rm_resp"]
+    rm_resp_out = prepro_para["rm_resp_out"]
+    respdir = prepro_para["respdir"]
+    samp_freq = prepro_para["samp_freq"]
+    sps = int(st[0].stats.sampling_rate)
+    station = st[0].stats.station
 
     # make downsampling if needed
     if abs(samp_freq - sps) > 1e-4:
         # downsampling here
         # st.interpolate(samp_freq, method="weighted_average_slopes")
         st.resample(samp_freq)
-        delta = st[0].stats.delta
-
         # when starttimes are between sampling points
-        fric = st[0].stats.starttime.microsecond % (delta * 1e6)
-        if fric > 1e-4:
-            st[0].data = segment_interpolate(np.float32(st[0].data), float(fric / (delta * 1e6)))
-            # --reset the time to remove the discrepancy---
-            st[0].stats.starttime -= fric * 1e-6
+        align_start(st)
 
     # options to remove instrument response
     if rm_resp != RmResp.NO:
@@ -180,8 +418,7 @@ def preprocess_raw(
             else:
                 try:
                     logger.info("removing response for %s using inv" % st[0])
-                    st[0].attach_response(inv)
-                    st[0].remove_response(output=rm_resp_out, pre_filt=pre_filt, water_level=60)
+                    remove_response(st[0], inv, rm_resp_out, pre_filt, response_cache)
                 except Exception as e:
                     logger.warning("Failed to remove response from %s. Returning empty stream. %s" % (st[0], e))
                     st = []
@@ -275,30 +512,27 @@ def cut_trace_make_stat(fc_para: ConfigParameters, ch_data: ChannelData):
         logger.debug("continue! madS or stdS equals to 0 for %s")
         return source_params, dataS_t, dataS
 
-    # initialize variables
+    # overlapping windows of the trace, as a view of the data
     npts = int(fc_para.cc_len * sps)
-    # trace_madS = np.zeros(nseg,dtype=np.float32)
-    trace_stdS = np.zeros(nseg, dtype=np.float32)
-    dataS = np.zeros(shape=(int(nseg), int(npts)), dtype=np.float32)
-    dataS_t = np.zeros(nseg, dtype=np.float32)
-
-    indx1 = 0
-    for iseg in range(nseg):
-        indx2 = indx1 + npts
-        dataS[iseg] = data[indx1:indx2]
-        # trace_madS[iseg] = (np.max(np.abs(dataS[iseg]))/all_madS)
-        trace_stdS[iseg] = np.max(np.abs(dataS[iseg])) / all_stdS
-        dataS_t[iseg] = starttime + fc_para.step * iseg
-        indx1 = indx1 + int(fc_para.step) * sps
-
-    # 2D array processing
-    dataS = demean(dataS)
-    dataS = detrend(dataS)
-    dataS = taper(dataS)
+    windows = segment_windows(data, npts, int(fc_para.step) * sps, nseg)
+    nseg = windows.shape[0]
+    # max absolute amplitude of each window, without an np.abs copy of the windows
+    trace_stdS = (np.maximum(windows.max(axis=1), -windows.min(axis=1)) / all_stdS).astype(np.float32)
+    dataS_t = (starttime + fc_para.step * np.arange(nseg)).astype(np.float32)
+
+    # 2D array processing: demean, detrend and taper, the windows are first copied here
+    dataS = demean_detrend_taper(windows)
 
     return trace_stdS, dataS_t, dataS
 
 
+def segment_windows(data: np.ndarray, npts: int, stride: int, nseg: int) -> np.ndarray:
+    """
+    read-only (nseg, npts) view of the windows of npts samples starting every stride samples of data
+    """
+    return np.lib.stride_tricks.sliding_window_view(data, npts)[::stride][:nseg]
+
+
 def noise_processing(fft_para: ConfigParameters, dataS):
     """
     this function performs time domain and frequency domain normalization if needed. in real case, we prefer use include
@@ -309,16 +543,15 @@ def noise_processing(fft_para: ConfigParameters, dataS):
     fft_para: ConfigParameters class containing all useful variables used for fft and cc
     dataS: 2D matrix of all segmented noise data
     # OUTPUT VARIABLES:
-    source_white: 2D matrix of data spectra
+    source_white: 2D matrix of data spectra, only the non-negative frequencies (Nfft // 2 + 1 points)
     """
     # ------to normalize in time or not------
     if fft_para.time_norm != TimeNorm.NO:
         if fft_para.time_norm == TimeNorm.ONE_BIT:  # sign normalization
             white = np.sign(dataS)
         elif fft_para.time_norm == TimeNorm.RMA:  # running mean: normalization over smoothed absolute average
-            white = np.zeros(shape=dataS.shape, dtype=dataS.dtype)
-            for kkk in range(dataS.shape[0]):
-                white[kkk, :] = dataS[kkk, :] / moving_ave(np.abs(dataS[kkk, :]), fft_para.smooth_N)
+            smoothed = running_mean_2D(np.abs(dataS), fft_para.smooth_N)
+            white = np.divide(dataS, smoothed, out=smoothed)
 
     else:  # don't normalize
         white = dataS
@@ -328,7 +561,7 @@ def noise_processing(fft_para: ConfigParameters, dataS):
         source_white = whiten(white, fft_para)  # whiten and return FFT
     else:
         Nfft = int(next_fast_len(int(dataS.shape[1])))
-        source_white = scipy.fftpack.fft(white, Nfft, axis=1)  # return FFT
+        source_white = fftbackend.rfft(white, Nfft, axis=1)  # return FFT
 
     return source_white
 
@@ -372,7 +605,7 @@ def smooth_source_spect(cc_para, fft1):
     return sfft1
 
 
-def correlate(fft1_smoothed_abs, fft2, D, Nfft, dataS_t):
+def correlate(fft1_smoothed_abs, fft2, D, Nfft, dataS_t, fft2_smoothed_abs=None, offset=None):
     """
     this function does the cross-correlation in freq domain and has the option to keep sub-stacks of
     the cross-correlation if needed. it takes advantage of the linear relationship of ifft, so that
@@ -390,6 +623,9 @@ def correlate(fft1_smoothed_abs, fft2, D, Nfft, dataS_t):
         freqmax: maximum frequency (Hz)
     Nfft:    number of frequency points for ifft
     dataS_t: matrix of datetime object.
+    fft2_smoothed_abs: (optional) precomputed smoothed amplitude spectrum of fft2 for coherency
+    offset:  (optional) first frequency bin of band-limited spectra, which then only hold the bins
+             [offset, offset + nbins) of the Nfft // 2 bins, the others being zero
 
     RETURNS:
     ---------------------
@@ -410,11 +646,12 @@ def correlate(fft1_smoothed_abs, fft2, D, Nfft, dataS_t):
     substack_len = D["substack_len"]
     smoothspect_N = D["smoothspect_N"]
 
-    nwin = fft1_smoothed_abs.shape[0]
-    Nfft2 = fft1_smoothed_abs.shape[1]
+    nwin, nbins = fft1_smoothed_abs.shape
+    Nfft2 = nbins if offset is None else Nfft // 2
+    # only the band is multiplied, it is zero-padded to Nfft2 bins before the inverse FFTs
+    band = slice(offset or 0, (offset or 0) + nbins)
 
     # ------convert all 2D arrays into 1D to speed up--------
-    corr = np.zeros(nwin * Nfft2, dtype=np.complex64)
     corr = fft1_smoothed_abs.reshape(
         fft1_smoothed_abs.size,
     ) * fft2.reshape(
@@ -422,32 +659,26 @@ def correlate(fft1_smoothed_abs, fft2, D, Nfft, dataS_t):
     )
 
     if method == "coherency":
-        temp = moving_ave(
-            np.abs(
-                fft2.reshape(
-                    fft2.size,
-                )
-            ),
-            smoothspect_N,
-        )
+        if fft2_smoothed_abs is None:
+            temp = moving_ave(
+                np.abs(
+                    fft2.reshape(
+                        fft2.size,
+                    )
+                ),
+                smoothspect_N,
+            )
+        else:
+            temp = fft2_smoothed_abs.reshape(fft2_smoothed_abs.size)
         corr /= temp
-    corr = corr.reshape(nwin, Nfft2)
+    corr = corr.reshape(nwin, nbins)
 
     if substack:
         if substack_len == cc_len:
             # choose to keep all fft data for a day
-            s_corr = np.zeros(shape=(nwin, Nfft), dtype=np.float32)  # stacked correlation
-            ampmax = np.zeros(nwin, dtype=np.float32)
-            n_corr = np.zeros(nwin, dtype=np.int16)  # number of correlations for each substack
+            s_corr = substacks_to_time(corr, band, Nfft2, Nfft)  # stacked correlation
+            n_corr = np.ones(nwin, dtype=np.int16)  # number of correlations for each substack
             t_corr = dataS_t  # timestamp
-            crap = np.zeros(Nfft, dtype=np.complex64)
-            for i in range(nwin):
-                n_corr[i] = 1
-                crap[:Nfft2] = corr[i, :]
-                crap[:Nfft2] = crap[:Nfft2] - np.mean(crap[:Nfft2])  # remove the mean in freq domain (spike at t=0)
-                crap[-(Nfft2) + 1 :] = np.flip(np.conj(crap[1:(Nfft2)]), axis=0)
-                crap[0] = complex(0, 0)
-                s_corr[i, :] = np.real(np.fft.ifftshift(scipy.fftpack.ifft(crap, Nfft, axis=0)))
 
             # remove abnormal data
             ampmax = np.max(s_corr, axis=1)
@@ -462,28 +693,30 @@ def correlate(fft1_smoothed_abs, fft2, D, Nfft, dataS_t):
             tstart = dataS_t[0]
 
             nstack = int(np.round(Ttotal / substack_len))
-            ampmax = np.zeros(nstack, dtype=np.float32)
             s_corr = np.zeros(shape=(nstack, Nfft), dtype=np.float32)
             n_corr = np.zeros(nstack, dtype=np.int16)
             t_corr = np.zeros(nstack, dtype=np.float32)
-            crap = np.zeros(Nfft, dtype=np.complex64)
 
+            # bounds of the sub-stacks, accumulated as the time stamps of the windows are compared to them
+            starts = np.zeros(nstack, dtype=dataS_t.dtype)
+            ends = np.zeros(nstack, dtype=dataS_t.dtype)
             for istack in range(nstack):
-                # find the indexes of all of the windows that start or end within
-                itime = np.where((dataS_t >= tstart) & (dataS_t < tstart + substack_len))[0]
-                if len(itime) == 0:
-                    tstart += substack_len
-                    continue
-
-                crap[:Nfft2] = np.mean(corr[itime, :], axis=0)  # linear average of the correlation
-                crap[:Nfft2] = crap[:Nfft2] - np.mean(crap[:Nfft2])  # remove the mean in freq domain (spike at t=0)
-                crap[-(Nfft2) + 1 :] = np.flip(np.conj(crap[1:(Nfft2)]), axis=0)
-                crap[0] = complex(0, 0)
-                s_corr[istack, :] = np.real(np.fft.ifftshift(scipy.fftpack.ifft(crap, Nfft, axis=0)))
-                n_corr[istack] = len(itime)  # number of windows stacks
-                t_corr[istack] = tstart  # save the time stamps
+                starts[istack] = tstart
+                ends[istack] = tstart + substack_len
                 tstart += substack_len
-                # print('correlation done and stacked at time %s' % str(t_corr[istack]))
+            # the windows are in time order, so the ones of each sub-stack are contiguous
+            first = np.searchsorted(dataS_t, starts, side="left")
+            counts = np.searchsorted(dataS_t, ends, side="left") - first
+            stacks = np.where(counts > 0)[0]
+            if len(stacks):
+                # linear average of the correlation, with np.mean for each sub-stack as it rounds differently
+                # from a sum divided by the count
+                mean = np.empty((len(stacks), nbins), dtype=corr.dtype)
+                for k, istack in enumerate(stacks):
+                    mean[k] = np.mean(corr[first[istack] : first[istack] + counts[istack]], axis=0)
+                s_corr[stacks] = substacks_to_time(mean, band, Nfft2, Nfft)
+                n_corr[stacks] = counts[stacks]  # number of windows stacks
+                t_corr[stacks] = starts[stacks]  # save the time stamps
 
             # remove abnormal data
             ampmax = np.max(s_corr, axis=1)
@@ -495,15 +728,16 @@ def correlate(fft1_smoothed_abs, fft2, D, Nfft, dataS_t):
     else:
         # average daily cross correlation functions
         ampmax = np.max(corr, axis=1)
+        if nbins < Nfft2:
+            # the maximum over all the bins, including the zeros outside of the band
+            ampmax = np.maximum(ampmax, 0)
         tindx = np.where((ampmax < 20 * np.median(ampmax)) & (ampmax > 0))[0]
         n_corr = nwin
-        s_corr = np.zeros(Nfft, dtype=np.float32)
         t_corr = dataS_t[0]
-        crap = np.zeros(Nfft, dtype=np.complex64)
-        crap[:Nfft2] = np.mean(corr[tindx], axis=0)
-        crap[:Nfft2] = crap[:Nfft2] - np.mean(crap[:Nfft2], axis=0)
-        crap[-(Nfft2) + 1 :] = np.flip(np.conj(crap[1:(Nfft2)]), axis=0)
-        s_corr = np.real(np.fft.ifftshift(scipy.fftpack.ifft(crap, Nfft, axis=0)))
+        crap = np.zeros(Nfft2, dtype=np.complex64)
+        crap[band] = np.mean(corr[tindx], axis=0)
+        crap -= np.mean(crap, axis=0)
+        s_corr = np.fft.ifftshift(fftbackend.irfft(crap, Nfft))
 
     # trim the CCFs in [-maxlag maxlag]
     t = np.arange(-Nfft2 + 1, Nfft2) * dt
@@ -516,6 +750,175 @@ def correlate(fft1_smoothed_abs, fft2, D, Nfft, dataS_t):
     return s_corr, t_corr, n_corr
 
 
+def substacks_to_time(spec, band, Nfft2, Nfft):
+    """
+    removes the mean in freq domain (spike at t=0) of each row of a 2D matrix of spectra and inverts them all
+    with one 2D inverse FFT. the results are the same as processing the rows one at a time.
+    PARAMETERS:
+    ---------------------
+    spec: 2D matrix of the (averaged) correlation spectra, holding the frequency bins band of Nfft2
+    band: slice of the bins held by spec
+    Nfft2: number of frequency bins of the full spectra
+    Nfft: number of points of the inverse FFT
+
+    RETURNS:
+    ---------------------
+    s_corr: 2D float32 matrix of the correlation functions in time domain
+    """
+    crap = np.zeros((spec.shape[0], Nfft2), dtype=np.complex64)
+    crap[:, band] = spec
+    # np.mean of a single complex64 row divides its sum in double precision
+    crap -= (np.sum(crap, axis=1).astype(np.complex128) / Nfft2).astype(np.complex64)[:, None]
+    crap[:, 0] = complex(0, 0)
+    # irfft rebuilds the negative frequencies from the Hermitian symmetry
+    return np.fft.ifftshift(fftbackend.irfft(crap, Nfft, axis=1), axes=1)
+
+
+def correlate_batch(fft1_smoothed_abs, fft2, good, D, Nfft, dataS_t, fft2_smoothed_abs=None, offset=None):
+    """
+    batched version of correlate(): cross-correlates a block of channel pairs at once. the spectral
+    multiplication, the averaging over windows and the inverse FFTs are vectorized over the pairs of
+    the block, so the results are the same as calling correlate() for each pair with only its good windows.
+    PARAMETERS:
+    ---------------------
+    fft1_smoothed_abs: 3D matrix (npair, nwin, Nfft2) of the source spectra (conjugated/smoothed).
+                       NOTE: it is overwritten with the product of the spectra
+    fft2:    3D matrix (npair, nwin, Nfft2) of the receiver spectra
+    good:    2D boolean matrix (npair, nwin) of the windows usable for each pair
+    D:       dictionary containing the cc parameters (see correlate())
+    Nfft:    number of frequency points for ifft
+    dataS_t: 2D matrix (npair, nwin) of the window timestamps
+    fft2_smoothed_abs: (optional) 3D matrix of the precomputed smoothed amplitude of fft2 for coherency
+    offset:  (optional) first frequency bin of band-limited spectra (see correlate())
+
+    RETURNS:
+    ---------------------
+    results: list with a (s_corr, t_corr, n_corr) tuple for each pair (None if the pair has no good windows)
+    """
+    # ----load paramters----
+    dt = D["dt"]
+    maxlag = D["maxlag"]
+    method = D["cc_method"]
+    cc_len = D["cc_len"]
+    substack = D["substack"]
+    substack_len = D["substack_len"]
+    smoothspect_N = D["smoothspect_N"]
+
+    npair, nwin, nbins = fft1_smoothed_abs.shape
+    Nfft2 = nbins if offset is None else Nfft // 2
+    corr = np.multiply(fft1_smoothed_abs, fft2, out=fft1_smoothed_abs)
+    if method == CCMethod.COHERENCY:
+        if fft2_smoothed_abs is None:
+            for ii in range(npair):
+                temp = moving_ave(np.abs(fft2[ii].reshape(fft2[ii].size)), smoothspect_N)
+                corr[ii] /= temp.reshape(nwin, nbins)
+        else:
+            corr /= fft2_smoothed_abs
+
+    # indices of the lags to keep in [-maxlag maxlag]
+    t = np.arange(-Nfft2 + 1, Nfft2) * dt
+    ind = np.where(np.abs(t) <= maxlag)[0]
+
+    def to_time(spec):
+        # remove the mean in freq domain (spike at t=0) and go back to time domain
+        if offset is None:
+            spec = spec.astype(np.complex64)
+        else:
+            spec = expand_band(spec, offset, Nfft2)
+        spec -= np.mean(spec, axis=-1, keepdims=True)
+        return spec
+
+    def inverse(spec):
+        # the spectra only hold the positive frequencies, so irfft takes care of the Hermitian symmetry
+        return np.fft.ifftshift(fftbackend.irfft(spec, Nfft, axis=-1), axes=-1)
+
+    def keep_normal(s_corr):
+        # remove abnormal data
+        ampmax = np.max(s_corr, axis=1)
+        return np.where((ampmax < 20 * np.median(ampmax)) & (ampmax > 0))[0]
+
+    rows = [np.where(good[ii])[0] for ii in range(npair)]
+    results = [None] * npair
+    if substack:
+        if substack_len == cc_len:
+            # choose to keep all fft data for a day
+            spec = to_time(corr)
+            spec[:, :, 0] = complex(0, 0)
+            s_corr = inverse(spec)
+            for ii in range(npair):
+                if len(rows[ii]) == 0:
+                    continue
+                pcorr = s_corr[ii, rows[ii]]
+                tindx = keep_normal(pcorr)
+                n_corr = np.ones(len(rows[ii]), dtype=np.int16)
+                results[ii] = (pcorr[tindx][:, ind], dataS_t[ii, rows[ii]][tindx], n_corr[tindx])
+        else:
+            specs = []
+            stamps = []
+            for ii in range(npair):
+                if len(rows[ii]) == 0:
+                    continue
+                # get time information
+                t_win = dataS_t[ii, rows[ii]]
+                Ttotal = t_win[-1] - t_win[0]  # total duration of what we have now
+                tstart = t_win[0]
+                nstack = int(np.round(Ttotal / substack_len))
+                # assign the windows of each sub-stack, as the sequential loop in correlate() does
+                weights = np.zeros((nstack, len(t_win)), dtype=np.float64)
+                n_corr = np.zeros(nstack, dtype=np.int16)
+                t_corr = np.zeros(nstack, dtype=np.float32)
+                for istack in range(nstack):
+                    itime = np.where((t_win >= tstart) & (t_win < tstart + substack_len))[0]
+                    if len(itime) > 0:
+                        weights[istack, itime] = 1.0 / len(itime)
+                        n_corr[istack] = len(itime)
+                        t_corr[istack] = tstart
+                    tstart += substack_len
+                # linear average of the correlation
+                spec = to_time(np.matmul(weights.astype(corr.dtype), corr[ii, rows[ii]]))
+                spec[:, 0] = complex(0, 0)
+                specs.append(spec)
+                stamps.append((ii, t_corr, n_corr))
+            if len(specs):
+                s_corrs = np.split(inverse(np.concatenate(specs)), np.cumsum([len(s) for s in specs])[:-1])
+                for s_corr, (ii, t_corr, n_corr) in zip(s_corrs, stamps):
+                    tindx = keep_normal(s_corr)
+                    results[ii] = (s_corr[tindx][:, ind], t_corr[tindx], n_corr[tindx])
+    else:
+        # average daily cross correlation functions
+        ampmax = np.max(corr, axis=2)
+        if nbins < Nfft2:
+            # the maximum over all the bins, including the zeros outside of the band
+            ampmax = np.maximum(ampmax, 0)
+        weights = np.zeros((npair, 1, nwin), dtype=corr.dtype)
+        valid = []
+        for ii in range(npair):
+            if len(rows[ii]) == 0:
+                continue
+            pamp = ampmax[ii, rows[ii]]
+            tindx = rows[ii][np.where((pamp < 20 * np.median(pamp)) & (pamp > 0))[0]]
+            if len(tindx) == 0:
+                # nothing to average: NaNs, as the mean of no window in correlate()
+                weights[ii, 0, :] = np.nan
+            else:
+                weights[ii, 0, tindx] = 1.0 / len(tindx)
+            valid.append(ii)
+        s_corr = inverse(to_time(np.matmul(weights, corr)[:, 0, :]))
+        for ii in valid:
+            results[ii] = (np.expand_dims(s_corr[ii, ind], axis=0), dataS_t[ii, rows[ii][0]], len(rows[ii]))
+    return results
+
+
+def expand_band(spec, offset, Nfft2):
+    """
+    zero-pads band-limited spectra, holding the frequency bins [offset, offset + nbins) along the last axis,
+    to the Nfft2 bins of the full spectra (as complex64)
+    """
+    out = np.zeros(spec.shape[:-1] + (Nfft2,), dtype=np.complex64)
+    out[..., offset : offset + spec.shape[-1]] = spec
+    return out
+
+
 def cc_parameters(cc_para, coor, tcorr, ncorr, comp):
     """
     this function assembles the parameters for the cc function, which is used
@@ -523,7 +926,8 @@ def cc_parameters(cc_para, coor, tcorr, ncorr, comp):
     PARAMETERS:
     ---------------------
     cc_para: dict containing parameters used in the fft_cc step
-    coor:    dict containing coordinates info of the source and receiver stations
+    coor:    dict containing coordinates info of the source and receiver stations, and optionally their
+             distance (km), azimuth and back-azimuth ('dist', 'azi', 'baz') when already known
     tcorr:   timestamp matrix
     ncorr:   matrix of number of good segments for each sub-stack/final stack
     comp:    2 character strings for the cross correlation component
@@ -540,11 +944,15 @@ def cc_parameters(cc_para, coor, tcorr, ncorr, comp):
     substack = cc_para["substack"]
     cc_method = cc_para["cc_method"]
 
-    dist, azi, baz = obspy.geodetics.base.gps2dist_azimuth(latS, lonS, latR, lonR)
+    if "dist" in coor:
+        dist, azi, baz = coor["dist"], coor["azi"], coor["baz"]
+    else:
+        dist, azi, baz = obspy.geodetics.base.gps2dist_azimuth(latS, lonS, latR, lonR)
+        dist /= 1000
     parameters = {
         "dt": dt,
         "maxlag": int(maxlag),
-        "dist": np.float32(dist / 1000),
+        "dist": np.float32(dist),
         "azi": np.float32(azi),
         "baz": np.float32(baz),
         "lonS": np.float32(lonS),
@@ -971,6 +1379,71 @@ def taper(data: np.ndarray) -> np.ndarray:
     return data
 
 
+def demean_detrend_taper(data: np.ndarray) -> np.ndarray:
+    """
+    fused demean, detrend and taper of each row of a 2D data matrix: same result as
+    taper(detrend(demean(data))) in a single pass over the data, with the trend estimated in closed form
+    and the taper window cached for each npts.
+    PARAMETERS:
+    ---------------------
+    data: input data matrix, e.g. a read-only view of the windows of a trace
+    RETURNS:
+    ---------------------
+    out: new float32 data matrix with mean and trend removed and taper applied
+    """
+    npts = data.shape[1]
+    out = np.empty(data.shape, dtype=np.float32)
+    if npts == 0:
+        return out
+    _demean_detrend_taper(data, _taper_window(npts), _trend_norm(npts), out)
+    return out
+
+
+@functools.lru_cache(maxsize=8)
+def _taper_window(npts: int) -> np.ndarray:
+    # the window applied by taper()
+    if npts * 0.05 > 20:
+        wlen = 20
+    else:
+        wlen = int(npts * 0.05)
+    func = _get_function_from_entry_point("taper", "hann")
+    if 2 * wlen == npts:
+        taper_sides = func(2 * wlen)
+    else:
+        taper_sides = func(2 * wlen + 1)
+    win = np.hstack(
+        (
+            taper_sides[:wlen],
+            np.ones(npts - 2 * wlen),
+            taper_sides[len(taper_sides) - wlen :],
+        )
+    ).astype(np.float32)
+    win.setflags(write=False)
+    return win
+
+
+def _trend_norm(npts: int) -> float:
+    # sum of (t - mean(t))**2 for t = i / npts, i = 0..npts-1
+    return (npts**2 - 1) / (12.0 * npts)
+
+
+@jit(nopython=True, cache=True)
+def _demean_detrend_taper(data, win, tnorm, out):
+    nseg, npts = data.shape
+    tmean = (npts - 1) / (2.0 * npts)
+    for i in range(nseg):
+        sx = 0.0
+        stx = 0.0
+        for j in range(npts):
+            x = data[i, j]
+            sx += x
+            stx += (j / npts - tmean) * x
+        mean = sx / npts
+        slope = stx / tnorm if tnorm > 0 else 0.0
+        for j in range(npts):
+            out[i, j] = (data[i, j] - mean - slope * (j / npts - tmean)) * win[j]
+
+
 # @jit(nopython = True)
 
 
@@ -1012,19 +1485,23 @@ def moving_ave_2D(A, N):
     ---------------------
     B: 2-D array with smoothed data
     """
-    ntc, nspt = A.shape
-    # defines an array with N extra samples at either side
-    temp = np.zeros([ntc, nspt + 2 * N])
-    # set the central portion of the array to A
-    temp[:, N:-N] = A
-    # leading samples: equal to first sample of actual array
-    temp[:, 0:N] = np.repeat(np.expand_dims(temp[:, N], axis=-1), N, axis=-1)
-    # trailing samples: Equal to last sample of actual array
-    temp[:, -N:] = np.repeat(np.expand_dims(temp[:, -N - 1], axis=-1), N, axis=-1)
-    # convolve with a boxcar and normalize, and use only central portion of the result
-    # with length equal to the original array, discarding the added leading and trailing samples
-    B = scipy.signal.convolve2d(temp, np.expand_dims(np.ones(N) / N, axis=0), mode="same")[:, N:-N]
-    return B
+    # edges extended with the first and last samples, running sum instead of a convolution
+    return running_mean_2D(np.asarray(A, dtype=np.float64), N)
+
+
+def running_mean_2D(A: np.ndarray, N: int) -> np.ndarray:
+    """
+    Same moving average as moving_ave_2D (full window length N, edges extended with the first and last
+    samples) along the last axis, computed with a running sum in O(npts) and in the dtype of A.
+    PARAMETERS:
+    ---------------------
+    A: 2-D array of data to be smoothed
+    N: integer, it defines the full!! window length to smooth
+    RETURNS:
+    ---------------------
+    B: 2-D array with smoothed data
+    """
+    return uniform_filter1d(A, N, axis=-1, mode="nearest")
 
 
 def robust_stack(cc_array, epsilon):
@@ -1081,38 +1558,28 @@ def whiten_1D(timeseries, fft_para: ConfigParameters, n_taper):
     RETURNS:
     ----------------------
     FFTRawSign: numpy.ndarray contains the FFT of the whitened input trace between the frequency bounds
+        (non-negative frequencies only, nfft // 2 + 1 points)
     """
     nfft = next_fast_len(len(timeseries))
-    spec = np.fft.fft(timeseries, nfft)
-    freq = np.fft.fftfreq(nfft, d=fft_para.dt)
-
-    ix0 = np.argmin(np.abs(freq - fft_para.freqmin))
-    ix1 = np.argmin(np.abs(freq - fft_para.freqmax))
-
-    if ix1 + n_taper > nfft:
-        ix11 = nfft
-    else:
-        ix11 = ix1 + n_taper
-
-    if ix0 - n_taper < 0:
-        ix00 = 0
-    else:
-        ix00 = ix0 - n_taper
+    spec = fftbackend.rfft(np.asarray(timeseries, dtype=np.float64), nfft)
+    ix0, ix1, ix00, ix11 = whiten_band(fft_para, nfft, n_taper)
 
+    # the band may extend past the Nyquist frequency, but only its non-negative part is returned
+    ixnb = min(ix11, spec.shape[-1])
     spec_out = spec.copy()
     spec_out[0:ix00] = 0.0 + 0.0j
     spec_out[ix11:] = 0.0 + 0.0j
 
     if fft_para.smooth_N <= 1:
-        spec_out[ix00:ix11] = np.exp(1.0j * np.angle(spec_out[ix00:ix11]))
+        spec_out[ix00:ixnb] = np.exp(1.0j * np.angle(spec_out[ix00:ixnb]))
     else:
-        spec_out[ix00:ix11] /= moving_ave(np.abs(spec_out[ix00:ix11]), fft_para.smooth_N)
+        spec_out[ix00:ixnb] /= moving_ave(band_amplitude(spec, ix00, ix11, nfft), fft_para.smooth_N)[: ixnb - ix00]
 
     x = np.linspace(np.pi / 2.0, np.pi, ix0 - ix00)
     spec_out[ix00:ix0] *= np.cos(x) ** 2
 
     x = np.linspace(0.0, np.pi / 2.0, ix11 - ix1)
-    spec_out[ix1:ix11] *= np.cos(x) ** 2
+    spec_out[ix1:ixnb] *= np.cos(x[: ixnb - ix1]) ** 2
 
     return spec_out
 
@@ -1134,9 +1601,50 @@ def whiten_2D(timeseries, fft_para: ConfigParameters, n_taper):
     RETURNS:
     ----------------------
     FFTRawSign: numpy.ndarray contains the FFT of the whitened input trace between the frequency bounds
+        (non-negative frequencies only, nfft // 2 + 1 points)
     """
     nfft = next_fast_len(timeseries.shape[1])
-    spec = np.fft.fftn(timeseries, s=[nfft])
+    spec = fftbackend.rfft(np.asarray(timeseries, dtype=np.float64), nfft, axis=1)
+    ix0, ix1, ix00, ix11 = whiten_band(fft_para, nfft, n_taper)
+
+    # the band may extend past the Nyquist frequency, but only its non-negative part is returned
+    ixnb = min(ix11, spec.shape[-1])
+    if fft_para.smooth_N > 1:
+        # smoothed float32 amplitude of the band, taken before the spectrum is modified in place
+        amp = band_amplitude(spec, ix00, ix11, nfft).astype(np.float32)
+        smoothed = running_mean_2D(amp, fft_para.smooth_N)
+        del amp
+    spec_out = spec
+    spec_out[:, 0:ix00] = 0.0 + 0.0j
+    spec_out[:, ix11:] = 0.0 + 0.0j
+
+    if fft_para.smooth_N <= 1:
+        spec_out[:, ix00:ixnb] = np.exp(1.0j * np.angle(spec_out[:, ix00:ixnb]))
+    else:
+        spec_out[:, ix00:ixnb] /= smoothed[:, : ixnb - ix00]
+
+    x = np.linspace(np.pi / 2.0, np.pi, ix0 - ix00)
+    spec_out[:, ix00:ix0] *= np.cos(x) ** 2
+
+    x = np.linspace(0.0, np.pi / 2.0, ix11 - ix1)
+    spec_out[:, ix1:ixnb] *= np.cos(x[: ixnb - ix1]) ** 2
+
+    return spec_out
+
+
+def whiten_band(fft_para: ConfigParameters, nfft: int, n_taper: int = 100):
+    """
+    Frequency bins of the whitening of a spectrum of nfft points: the spectrum is whitened in [ix0, ix1],
+    tapered down to ix00 and ix11 and zero outside of [ix00, ix11)
+    PARAMETERS:
+    ----------------------
+    fft_para: ConfigParameters class with the sampling space dt and the freqmin and freqmax bounds
+    nfft: length of the full spectrum
+    n_taper: integer, width of the taper in samples
+    RETURNS:
+    ----------------------
+    ix0, ix1, ix00, ix11: bins of the band, ix11 may be larger than nfft // 2 + 1
+    """
     freq = np.fft.fftfreq(nfft, d=fft_para.dt)
 
     ix0 = np.argmin(np.abs(freq - fft_para.freqmin))
@@ -1151,23 +1659,25 @@ def whiten_2D(timeseries, fft_para: ConfigParameters, n_taper):
         ix00 = 0
     else:
         ix00 = ix0 - n_taper
+    return ix0, ix1, ix00, ix11
 
-    spec_out = spec.copy()  # may be inconvenient due to higher memory usage
-    spec_out[:, 0:ix00] = 0.0 + 0.0j
-    spec_out[:, ix11:] = 0.0 + 0.0j
-
-    if fft_para.smooth_N <= 1:
-        spec_out[:, ix00:ix11] = np.exp(1.0j * np.angle(spec_out[:, ix00:ix11]))
-    else:
-        spec_out[:, ix00:ix11] /= moving_ave_2D(np.abs(spec_out[:, ix00:ix11]), fft_para.smooth_N)
-
-    x = np.linspace(np.pi / 2.0, np.pi, ix0 - ix00)
-    spec_out[:, ix00:ix0] *= np.cos(x) ** 2
 
-    x = np.linspace(0.0, np.pi / 2.0, ix11 - ix1)
-    spec_out[:, ix1:ix11] *= np.cos(x) ** 2
-
-    return spec_out
+def band_amplitude(spec, ix0, ix1, nfft):
+    """
+    Amplitude of the bins [ix0, ix1) of a full spectrum, given only its non-negative frequencies.
+    The negative frequencies of a real signal mirror the positive ones: |X[k]| = |X[nfft - k]|
+    PARAMETERS:
+    ----------------------
+    spec: numpy.ndarray with the rfft of the signal along the last axis
+    ix0, ix1: bounds of the band in the full spectrum, ix1 may be larger than nfft // 2 + 1
+    nfft: length of the full spectrum
+    RETURNS:
+    ----------------------
+    amp: numpy.ndarray with the amplitude of the band along the last axis
+    """
+    k = np.arange(ix0, ix1)
+    k = np.where(k < spec.shape[-1], k, nfft - k)
+    return np.abs(spec[..., k])
 
 
 def whiten(data, fft_para: ConfigParameters, n_taper=100):
@@ -1187,21 +1697,14 @@ def whiten(data, fft_para: ConfigParameters, n_taper=100):
     RETURNS:
     ----------------------
     FFTRawSign: numpy.ndarray contains the FFT of the whitened input trace between the frequency bounds
+        (non-negative frequencies only, the rest follows from the Hermitian symmetry)
     """
 
     # Speed up FFT by padding to optimal size for FFTPACK
     if data.ndim == 1:
         FFTRawSign = whiten_1D(data, fft_para, n_taper)
-        # ARR_OUT: Only for consistency with noisepy approach of holding the full
-        # spectrum (not just 0 and positive freq. part)
-        arr_out = np.zeros((FFTRawSign.shape[0] - 1) * 2 + 1, dtype=complex)
-        arr_out[0 : FFTRawSign.shape[0]] = FFTRawSign
-        arr_out[FFTRawSign.shape[0] :] = FFTRawSign[1:].conjugate()[::-1]
-
     elif data.ndim == 2:
         FFTRawSign = whiten_2D(data, fft_para, n_taper)
-        arr_out = np.zeros((FFTRawSign.shape[0], (FFTRawSign.shape[1] - 1) * 2 + 1), dtype=complex)
-        arr_out[:, FFTRawSign.shape[1] :] = FFTRawSign[:, 1:].conjugate()[::-1]
     return FFTRawSign
 
 
@@ -1227,7 +1730,7 @@ def adaptive_filter(arr, g):
     Nfft = next_fast_len(M)
 
     # fft the 2D array
-    spec = scipy.fftpack.fft(arr, axis=1, n=Nfft)[:, :M]
+    spec = fftbackend.fft(arr, Nfft, axis=1)[:, :M]
 
     # make cross-spectrm matrix
     cspec = np.zeros(shape=(N * N, M), dtype=np.complex64)
@@ -1249,7 +1752,7 @@ def adaptive_filter(arr, g):
     p = np.power((S1 - S2) / (S2 * (N - 1)), g)
 
     # make ifft
-    narr = np.real(scipy.fftpack.ifft(np.multiply(p, spec), Nfft, axis=1)[:, :M])
+    narr = np.real(fftbackend.ifft(np.multiply(p, spec), Nfft, axis=1)[:, :M])
     return np.mean(narr, axis=0)
 
 
@@ -1280,7 +1783,7 @@ def pws(arr, sampling_rate, power=2, pws_timegate=5.0):
     if arr.ndim == 1:
         return arr
     N, M = arr.shape
-    analytic = hilbert(arr, axis=1, N=next_fast_len(M))[:, :M]
+    analytic = fftbackend.hilbert(arr, next_fast_len(M), axis=1)[:, :M]
     phase = np.angle(analytic)
     phase_stack = np.mean(np.exp(1j * phase), axis=0)
     phase_stack = np.abs(phase_stack) ** (power)
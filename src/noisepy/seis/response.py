@@ -0,0 +1,148 @@
+import functools
+import logging
+import threading
+from collections import OrderedDict
+from typing import Callable, Hashable, List, Optional
+
+import numpy as np
+import obspy
+from obspy.core.inventory import PolynomialResponseStage
+from obspy.signal.invsim import cosine_sac_taper, cosine_taper, invert_spectrum
+from obspy.signal.util import _npts2nfft
+
+logger = logging.getLogger(__name__)
+
+# remove_response arguments of the pre-processing
+WATER_LEVEL = 60.0
+TAPER_FRACTION = 0.05
+
+
+class ResponseCache:
+    """
+    Thread-safe cache of the evaluated inverse instrument responses, bounded by ``max_bytes``. Once full,
+    new responses are not added: the channels of a run are visited in the same order every timespan, which
+    would make a least recently used eviction miss on every channel.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries: OrderedDict = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, compute: Callable[[], np.ndarray]) -> np.ndarray:
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.hits += 1
+                return value
+            self.misses += 1
+        # evaluated outside of the lock, two threads may compute the same response once
+        value = compute()
+        value.setflags(write=False)
+        with self.lock:
+            if key not in self.entries and self.nbytes + value.nbytes <= self.max_bytes:
+                self.entries[key] = value
+                self.nbytes += value.nbytes
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+
+_shared_cache: Optional[ResponseCache] = None
+_shared_lock = threading.Lock()
+
+
+def shared_response_cache(max_memory: float) -> Optional[ResponseCache]:
+    """
+    The response cache of this process, reused across timespans, with ``max_memory`` GB. None when disabled.
+    """
+    global _shared_cache
+    if max_memory <= 0:
+        return None
+    max_bytes = int(max_memory * 1024**3)
+    with _shared_lock:
+        if _shared_cache is None:
+            _shared_cache = ResponseCache(max_bytes)
+        _shared_cache.max_bytes = max_bytes
+        return _shared_cache
+
+
+def _channel_epoch(inv: obspy.Inventory, tr: obspy.Trace) -> Optional[obspy.core.inventory.Channel]:
+    net, sta, loc, cha = tr.id.split(".")
+    selected = inv.select(network=net, station=sta, location=loc, channel=cha, time=tr.stats.starttime)
+    for network in selected:
+        for station in network:
+            for channel in station:
+                return channel
+    return None
+
+
+@functools.lru_cache(maxsize=8)
+def _time_taper(npts: int) -> np.ndarray:
+    taper = cosine_taper(npts, TAPER_FRACTION, sactaper=True, halfcosine=False)
+    taper.setflags(write=False)
+    return taper
+
+
+def inverse_response(
+    response: obspy.core.inventory.Response, delta: float, nfft: int, pre_filt: List[float], output: str
+) -> np.ndarray:
+    """
+    Frequency domain taper times the inverted response (with the water level), as applied by
+    obspy.core.trace.Trace.remove_response to the spectrum of the data
+    """
+    freq_response, freqs = response.get_evalresp_response(delta, nfft, output=output)
+    invert_spectrum(freq_response, WATER_LEVEL)
+    return cosine_sac_taper(freqs, flimit=pre_filt) * freq_response
+
+
+def remove_response(
+    tr: obspy.Trace,
+    inv: obspy.Inventory,
+    output: str,
+    pre_filt: List[float],
+    cache: Optional[ResponseCache] = None,
+) -> obspy.Trace:
+    """
+    Same as ``tr.remove_response(inv, output=output, pre_filt=pre_filt, water_level=60)`` but the inverse
+    response spectrum is taken from ``cache``, keyed by the channel id and epoch, length, sampling rate and
+    pre-filter, so that it's evaluated once per channel instead of once per timespan.
+    """
+    channel = _channel_epoch(inv, tr) if cache is not None else None
+    response = channel.response if channel is not None else None
+    polynomial = response is not None and (
+        (not response.response_stages and response.instrument_polynomial)
+        or (len(response.response_stages) == 1 and isinstance(response.response_stages[0], PolynomialResponseStage))
+    )
+    if response is None or polynomial:
+        tr.attach_response(inv)
+        return tr.remove_response(output=output, pre_filt=pre_filt, water_level=WATER_LEVEL)
+
+    npts = tr.stats.npts
+    nfft = _npts2nfft(npts)
+    key = (
+        tr.id,
+        str(channel.start_date),
+        str(channel.end_date),
+        npts,
+        tr.stats.sampling_rate,
+        tuple(pre_filt),
+        output,
+        WATER_LEVEL,
+    )
+    inv_spectrum = cache.get(key, lambda: inverse_response(response, tr.stats.delta, nfft, pre_filt, output))
+
+    data = tr.data.astype(np.float64)
+    data -= data.mean()
+    data *= _time_taper(npts)
+    spectrum = np.fft.rfft(data, n=nfft)
+    spectrum *= inv_spectrum
+    spectrum[-1] = abs(spectrum[-1]) + 0.0j
+    tr.data = np.fft.irfft(spectrum)[0:npts]
+    return tr
@@ -0,0 +1,212 @@
+import sys
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from noisepy.seis.io.datatypes import NoiseFFT
+
+from .datatypes import SpectralNorms, band_offset, make_noise_fft
+
+# byte alignment of each array in the shared block
+ALIGNMENT = 64
+# the arrays of SpectralNorms, in the order of its fields
+NORM_ARRAYS = ("source", "receiver", "good")
+
+
+@dataclass
+class SharedArraysHandle:
+    """
+    Picklable description of a ``SharedArrays`` block, i.e. what a worker process needs to attach to it
+
+    Attributes:
+        name: name of the shared memory block
+        layout: key -> (offset, shape, dtype) of each array in the block
+    """
+
+    name: str
+    layout: Dict[str, Tuple[int, Tuple[int, ...], str]]
+
+
+class SharedArrays:
+    """
+    A set of numpy arrays in a single ``multiprocessing.shared_memory`` block. The process that creates it owns
+    the block and must ``close()`` it, worker processes get zero-copy views of the arrays with ``attach()``
+    """
+
+    def __init__(self, specs: Dict[str, Tuple[Tuple[int, ...], np.dtype]]):
+        """
+        Allocates the block for arrays of the given (shape, dtype), to be filled through ``arrays``
+        """
+        layout = {}
+        size = 0
+        for key, (shape, dtype) in specs.items():
+            dtype = np.dtype(dtype)
+            layout[key] = (size, tuple(shape), dtype.str)
+            nbytes = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+            size += -(-nbytes // ALIGNMENT) * ALIGNMENT
+        self._shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        self.handle = SharedArraysHandle(self._shm.name, layout)
+        self.arrays = _views(self._shm, layout)
+
+    @property
+    def nbytes(self) -> int:
+        return self._shm.size
+
+    def close(self):
+        self.arrays.clear()
+        try:
+            self._shm.close()
+        except BufferError:
+            # some views are still referenced, the mapping goes away with them
+            pass
+        self._shm.unlink()
+
+
+def _views(shm: shared_memory.SharedMemory, layout: Dict[str, Tuple[int, Tuple[int, ...], str]]):
+    return {
+        key: np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf, offset=offset)
+        for key, (offset, shape, dtype) in layout.items()
+    }
+
+
+# blocks attached by this (worker) process, keyed by name
+_attached: Dict[str, Tuple[shared_memory.SharedMemory, Dict[str, np.ndarray]]] = {}
+
+
+def attach(handle: SharedArraysHandle) -> Dict[str, np.ndarray]:
+    """
+    Zero-copy views of the arrays of a ``SharedArrays`` block created by another process. The block stays
+    attached until a different one is requested, so consecutive tasks on the same block only attach once.
+    """
+    if handle.name not in _attached:
+        detach()
+        if sys.version_info >= (3, 13):
+            shm = shared_memory.SharedMemory(name=handle.name, track=False)
+        else:
+            # this registers the block again with the resource tracker, which is shared with the creator for
+            # the multiprocessing workers, so it's a no-op and only the creator unlinks it
+            shm = shared_memory.SharedMemory(name=handle.name)
+        _attached[handle.name] = (shm, _views(shm, handle.layout))
+    return _attached[handle.name][1]
+
+
+def detach():
+    for shm, arrays in _attached.values():
+        arrays.clear()
+        try:
+            shm.close()
+        except BufferError:
+            pass
+    _attached.clear()
+
+
+@dataclass
+class SharedFFTs:
+    """
+    Picklable description of the FFTs of a timespan copied into shared memory
+
+    Attributes:
+        handle: the shared memory block
+        shapes: channel index -> (window_count, length, band offset) of its ``NoiseFFT``
+        index: channel index -> position in the stacked spectra, when the spectra were stacked
+    """
+
+    handle: SharedArraysHandle
+    shapes: Dict[int, Tuple[int, int, Optional[int]]]
+    index: Optional[Dict[int, int]] = None
+
+
+def share_ffts(
+    ffts: Dict[int, NoiseFFT],
+    norms: Dict[int, SpectralNorms],
+    stacked: bool = False,
+) -> Tuple[SharedArrays, SharedFFTs]:
+    """
+    Moves the FFTs and spectral normalizations into a shared memory block: as each channel is copied, its
+    ``NoiseFFT`` and ``SpectralNorms`` in the dicts are replaced by views of the block, so that the memory of
+    the originals is released as the copy goes and the FFTs are not held twice. With ``stacked`` (batched
+    engine) the spectra of all the channels, which must have the same shape, are copied into a single
+    (nchan, nwin, nbins) array, as ``stack_spectra`` does.
+    """
+    specs = {}
+    index = None
+    if stacked:
+        first = next(iter(ffts.values()))
+        nwin = first.window_count
+        specs["spectra"] = ((len(ffts), nwin, first.fft.size // nwin), first.fft.dtype)
+        index = {ich: k for k, ich in enumerate(ffts.keys())}
+    for ich, fft in ffts.items():
+        if not stacked:
+            specs[f"{ich}/fft"] = (fft.fft.shape, fft.fft.dtype)
+        specs[f"{ich}/std"] = (fft.std.shape, fft.std.dtype)
+        specs[f"{ich}/fft_time"] = (fft.fft_time.shape, fft.fft_time.dtype)
+    for ich, norm in norms.items():
+        for name in NORM_ARRAYS:
+            arr = getattr(norm, name)
+            if arr is not None:
+                specs[f"{ich}/{name}"] = (arr.shape, arr.dtype)
+    block = SharedArrays(specs)
+    shapes = {ich: (fft.window_count, fft.length, band_offset(fft)) for ich, fft in ffts.items()}
+    shared = SharedFFTs(block.handle, shapes, index)
+
+    arrays = block.arrays
+    for ich in list(ffts.keys()):
+        fft = ffts[ich]
+        if stacked:
+            arrays["spectra"][index[ich]] = fft.fft.reshape(fft.window_count, -1)
+        else:
+            arrays[f"{ich}/fft"][...] = fft.fft
+        arrays[f"{ich}/std"][...] = fft.std
+        arrays[f"{ich}/fft_time"][...] = fft.fft_time
+        del fft
+        ffts[ich] = _shared_fft(shared, arrays, ich)
+    for ich in list(norms.keys()):
+        for name in NORM_ARRAYS:
+            arr = getattr(norms[ich], name)
+            if arr is not None:
+                arrays[f"{ich}/{name}"][...] = arr
+        norm = _shared_norms(arrays, ich)
+        if norm is None:
+            del norms[ich]
+        else:
+            norms[ich] = norm
+    return block, shared
+
+
+def attach_ffts(
+    shared: SharedFFTs,
+) -> Tuple[Dict[int, NoiseFFT], Dict[int, SpectralNorms], Optional[Tuple[np.ndarray, Dict[int, int]]]]:
+    """
+    Counterpart of ``share_ffts`` in the worker processes: the FFTs, spectral normalizations and stacked
+    spectra as views of the shared memory block
+    """
+    arrays = attach(shared.handle)
+    spectra = None
+    if shared.index is not None:
+        spectra = (arrays["spectra"], shared.index)
+    ffts = {}
+    norms = {}
+    for ich in shared.shapes.keys():
+        ffts[ich] = _shared_fft(shared, arrays, ich)
+        norm = _shared_norms(arrays, ich)
+        if norm is not None:
+            norms[ich] = norm
+    return ffts, norms, spectra
+
+
+def _shared_fft(shared: SharedFFTs, arrays: Dict[str, np.ndarray], ich: int) -> NoiseFFT:
+    window_count, length, offset = shared.shapes[ich]
+    if shared.index is not None:
+        fft = arrays["spectra"][shared.index[ich]].reshape(-1)
+    else:
+        fft = arrays[f"{ich}/fft"]
+    return make_noise_fft(fft, arrays[f"{ich}/std"], arrays[f"{ich}/fft_time"], window_count, length, offset)
+
+
+def _shared_norms(arrays: Dict[str, np.ndarray], ich: int) -> Optional[SpectralNorms]:
+    values = [arrays.get(f"{ich}/{name}") for name in NORM_ARRAYS]
+    if all(v is None for v in values):
+        return None
+    return SpectralNorms(*values)
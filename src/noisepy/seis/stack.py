@@ -2,18 +2,22 @@ import logging
 import sys
 from concurrent.futures import ProcessPoolExecutor
 from multiprocessing import get_context
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
 import numpy as np
 import pandas as pd
 from datetimerange import DateTimeRange
 
-from noisepy.seis.io.datatypes import ConfigParameters, Stack, StackMethod, Station
+from noisepy.seis.io.datatypes import Stack, StackMethod, Station
 from noisepy.seis.io.stores import CrossCorrelationDataStore, StackStore
 from noisepy.seis.io.utils import TimeLogger, get_results
 
-from . import noise_module
+from . import fftbackend, noise_module
 from .constants import NO_CCF_DATA_MSG, WILD_CARD
+from .datatypes import ConfigParameters
+from .geometry import StationGeometry
+from .ledger import STEP_STACK, CompletionLedger
+from .metrics import create_metrics
 from .scheduler import Scheduler, SingleNodeScheduler
 
 logger = logging.getLogger(__name__)
@@ -54,6 +58,7 @@ def stack_cross_correlations(
     executor = ProcessPoolExecutor(mp_context=get_context("spawn"))
     tlog = TimeLogger(logger=logger, level=logging.INFO)
     t_tot = tlog.reset()
+    metrics = create_metrics(fft_params)
 
     stations = set(fft_params.stations)
     networks = set(fft_params.net_list)
@@ -79,16 +84,49 @@ def stack_cross_correlations(
 
         return [pairs_filt]
 
-    [pairs_all] = scheduler.initialize(initializer, 1)
+    with metrics.timer("list_pairs"):
+        [pairs_all] = scheduler.initialize(initializer, 1)
 
     # Get the pairs that need to be processed by this node
     pairs_node = [pairs_all[i] for i in scheduler.get_indices(pairs_all)]
-
-    tasks = [executor.submit(stack_store_pair, p[0], p[1], cc_store, stack_store, fft_params) for p in pairs_node]
-    results = get_results(tasks, "Stacking Pairs")
+    ledger = None
+    if fft_params.ledger_path:
+        ledger = CompletionLedger(fft_params.ledger_path)
+        done, pairs_node = ledger.filter_done(STEP_STACK, stack_timespan(fft_params), pairs_node)
+        logger.info(f"Skipping {len(done)} station pairs already stacked")
+        metrics.count("skipped_pairs", len(done))
+
+    # distances and azimuths of all the pairs of this node, computed together. The stations listed by the cc store
+    # usually have no coordinates, the geometry of those pairs is computed from the CCF parameters when stacked
+    located = set(p for p in pairs_node if p[0].valid() and p[1].valid())
+    geometry = StationGeometry()
+    with metrics.timer("geometry"):
+        geometry.compute(located)
+    tlog.log(f"Compute the geometry of {len(located)} station pairs")
+    tasks = [
+        executor.submit(
+            stack_store_pair,
+            p[0],
+            p[1],
+            cc_store,
+            stack_store,
+            fft_params,
+            geometry.subset([p]) if p in located else StationGeometry(),
+            ledger,
+        )
+        for p in pairs_node
+    ]
+    with metrics.timer("stack"):
+        results = get_results(tasks, "Stacking Pairs")
     executor.shutdown()
     scheduler.synchronize()
     tlog.log("step 2 in total", t_tot)
+    metrics.count("pairs", len(pairs_node))
+    metrics.count("failed_pairs", len(results) - sum(map(bool, results)))
+    stack_time = metrics.timers["stack"]
+    if stack_time > 0:
+        metrics.gauge("pairs_per_second", len(pairs_node) / stack_time)
+    metrics.emit("stack")
     if not all(results):
         failed = [p for p, r in zip(pairs_node, results) if not r]
         failed_str = "\n".join(map(str, failed))
@@ -104,33 +142,51 @@ def stack_store_pair(
     cc_store: CrossCorrelationDataStore,
     stack_store: StackStore,
     fft_params: ConfigParameters,
+    geometry: Optional[StationGeometry] = None,
+    ledger: Optional[CompletionLedger] = None,
 ) -> bool:
+    # Force config validation, e.g. of an io ConfigParameters without the execution parameters
+    fft_params = ConfigParameters.model_validate(dict(fft_params), strict=True)
     try:
-        ts = DateTimeRange(fft_params.start_date, fft_params.end_date)
+        # in a worker process
+        fftbackend.configure(fft_params)
+        ts = stack_timespan(fft_params)
+        if ledger is not None and ledger.is_done(STEP_STACK, ts, src_sta, rec_sta):
+            logger.info(f"Stack already done for {src_sta}-{rec_sta}/{ts}")
+            return True
         if stack_store.contains(src_sta, rec_sta, ts):
             logger.info(f"Stack already exists for {src_sta}-{rec_sta}/{ts}")
+            if ledger is not None:
+                ledger.mark_pairs(STEP_STACK, ts, [(src_sta, rec_sta)])
             return True
         logger.info(f"Stacking {src_sta}_{rec_sta}/{ts}")
         timespans = cc_store.get_timespans(src_sta, rec_sta)
-        stacks = stack_pair(src_sta, rec_sta, timespans, cc_store, fft_params)
+        stacks = stack_pair(src_sta, rec_sta, timespans, cc_store, fft_params, geometry)
         if len(stacks) == 0:
             logger.warning(f"No stacks for {src_sta}_{rec_sta}")
             return False
         tlog = TimeLogger(logger=logger, level=logging.INFO)
         stack_store.append(ts, src_sta, rec_sta, stacks)
         tlog.log(f"writing stack pair {(src_sta, rec_sta)}")
+        if ledger is not None:
+            ledger.mark_pairs(STEP_STACK, ts, [(src_sta, rec_sta)])
         return True
     except Exception as e:
         logger.error(f"Error stacking pair {(src_sta, rec_sta)}: {e}")
         return False
 
 
+def stack_timespan(fft_params: ConfigParameters) -> DateTimeRange:
+    return DateTimeRange(fft_params.start_date, fft_params.end_date)
+
+
 def stack_pair(
     src_sta: Station,
     rec_sta: Station,
     timespans: List[DateTimeRange],
     cc_store: CrossCorrelationDataStore,
     fft_params: ConfigParameters,
+    geometry: Optional[StationGeometry] = None,
 ) -> List[Stack]:
     tlog = TimeLogger(logger=logger, level=logging.INFO)
     # check if it is auto-correlation
@@ -282,6 +338,18 @@ def stack_pair(
             return stack_results
         tparameters["station_source"] = src_sta.name
         tparameters["station_receiver"] = rec_sta.name
+        if geometry is not None and not ("azi" in tparameters and "baz" in tparameters):
+            # the azimuths stored with the CCFs are kept, only the missing ones are computed
+            src_loc, rec_loc = src_sta, rec_sta
+            coords = [tparameters.get(k) for k in ["latS", "lonS", "latR", "lonR"]]
+            located = src_sta.valid() and rec_sta.valid()
+            if not located and None not in coords:
+                # no coordinates from the cc store, use the ones the CCFs were computed with
+                src_loc = Station(src_sta.network, src_sta.name, float(coords[0]), float(coords[1]))
+                rec_loc = Station(rec_sta.network, rec_sta.name, float(coords[2]), float(coords[3]))
+                located = True
+            if located:
+                _, tparameters["azi"], tparameters["baz"] = geometry.get(src_loc, rec_loc)
         if fft_params.stack_method != StackMethod.ALL:
             bigstack_rotated = noise_module.rotation(bigstack, tparameters, locs)
 
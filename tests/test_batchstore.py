@@ -0,0 +1,108 @@
+from datetime import datetime, timedelta, timezone
+from unittest.mock import Mock
+
+import numpy as np
+import obspy
+import pytest
+from datetimerange import DateTimeRange
+
+from noisepy.seis.batchstore import BatchedRawDataStore, timespan_batches
+from noisepy.seis.io.datatypes import Channel, ChannelData, ChannelType, Station
+
+START = datetime(2021, 1, 1, tzinfo=timezone.utc)
+
+
+def _hours(*hours: int):
+    return [DateTimeRange(START + timedelta(hours=h), START + timedelta(hours=h + 1)) for h in hours]
+
+
+def test_timespan_batches():
+    timespans = _hours(0, 1, 2, 3, 4, 6, 7)
+    batches = timespan_batches(timespans, 3)
+    # the gap at 5h starts a new batch
+    assert batches == [timespans[:3], timespans[3:5], timespans[5:]]
+    assert timespan_batches(timespans, 1) == [[ts] for ts in timespans]
+
+
+def _raw_store(day_files: bool = False):
+    sta = Station("CI", "BAK")
+    channels = [Channel(ChannelType("BHZ"), sta), Channel(ChannelType("BHN"), sta)]
+
+    def read_data(ts, ch):
+        start = ts.start_datetime
+        if day_files:
+            # the whole file of the day of the timespan
+            start = start.replace(hour=0)
+        npts = 24 * 3600 if day_files else int((ts.end_datetime - ts.start_datetime).total_seconds())
+        header = {"sampling_rate": 1.0, "starttime": obspy.UTCDateTime(start)}
+        data = np.arange(npts, dtype=np.float32) + (start - START).total_seconds()
+        return ChannelData(obspy.Stream([obspy.Trace(data, header=header)]))
+
+    store = Mock()
+    store.get_channels = Mock(return_value=channels)
+    store.get_inventory = Mock(return_value=obspy.Inventory())
+    store.read_data = Mock(side_effect=read_data)
+    return store, sta, channels
+
+
+@pytest.mark.parametrize("day_files", [False, True])
+def test_batched_store(day_files: bool):
+    store, sta, channels = _raw_store(day_files)
+    timespans = _hours(0, 1, 2, 4)
+    batched = BatchedRawDataStore(store, timespan_batches(timespans, 3))
+
+    for i, ts in enumerate(timespans[:3]):
+        assert batched.get_channels(ts) == channels
+        batched.get_inventory(ts, sta)
+        for ch in channels:
+            ch_data = batched.read_data(ts, ch)
+            assert ch_data.stream[0].stats.starttime == obspy.UTCDateTime(ts.start_datetime)
+            # the end belongs to the next timespan
+            assert ch_data.stream[0].stats.endtime == obspy.UTCDateTime(ts.end_datetime) - 1.0
+            assert ch_data.stream[0].stats.npts == 3600
+            assert ch_data.data[0] == 3600 * i
+        batched.done(ts)
+    # the channels and inventories of each timespan
+    assert [c[0][0] for c in store.get_channels.call_args_list] == timespans[:3]
+    assert store.get_inventory.call_count == 3
+    # the day file read for the first hour is sliced for the next ones
+    assert store.read_data.call_count == len(channels) * (1 if day_files else 3)
+    # released after its last timespan
+    assert len(batched.values) == 0
+
+    # alone in its batch, passed through
+    ts = timespans[3]
+    batched.read_data(ts, channels[0])
+    batched.get_channels(ts)
+    assert store.read_data.call_args[0][0] == ts
+    assert store.get_channels.call_args[0][0] == ts
+
+
+def test_batched_store_days():
+    # as SCEDCS3DataStore: the channels and files of each day, listed and read by the exact timespan of the day
+    sta = Station("CI", "BAK")
+    chan = Channel(ChannelType("BHZ"), sta)
+    days = [DateTimeRange(START + timedelta(days=d), START + timedelta(days=d + 1)) for d in range(3)]
+    files = {
+        str(ts): obspy.Trace(
+            np.full(24 * 3600, d, dtype=np.float32),
+            header={"sampling_rate": 1.0, "starttime": obspy.UTCDateTime(ts.start_datetime)},
+        )
+        for d, ts in enumerate(days)
+    }
+    store = Mock()
+    store.get_channels = Mock(side_effect=lambda ts: [chan] if str(ts) in files else [])
+    store.read_data = Mock(
+        side_effect=lambda ts, ch: ChannelData(obspy.Stream([files[str(ts)].copy()]))
+        if str(ts) in files
+        else ChannelData.empty()
+    )
+    batched = BatchedRawDataStore(store, timespan_batches(days, 3))
+
+    for d, ts in enumerate(days):
+        assert batched.get_channels(ts) == [chan]
+        ch_data = batched.read_data(ts, chan)
+        assert ch_data.stream[0].stats.npts == 24 * 3600
+        assert np.all(ch_data.data == d)
+        batched.done(ts)
+    assert [c[0][0] for c in store.read_data.call_args_list] == days
@@ -1,25 +1,42 @@
 import os
-from unittest.mock import Mock
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest.mock import Mock, patch
 
+import numpy as np
 import obspy
 import pytest
 from datetimerange import DateTimeRange
 
+from noisepy.seis import sharedmem
 from noisepy.seis.constants import NO_DATA_MSG
 from noisepy.seis.correlate import (
+    TimespanPrefetcher,
     _filter_channel_data,
     _safe_read_data,
+    cc_timespan,
+    channel_blocks,
+    create_pairs,
     cross_correlate,
+    cross_correlation_shared,
+    estimate_memory,
+    pair_windows,
+    spectral_norms,
 )
+from noisepy.seis.datatypes import CCEngine, CCExecutor, ConfigParameters
 from noisepy.seis.io.datatypes import (
     CCMethod,
     Channel,
     ChannelData,
-    ConfigParameters,
+    ChannelType,
+    NoiseFFT,
     RmResp,
     Station,
 )
 from noisepy.seis.io.s3store import SCEDCS3DataStore
+from noisepy.seis.ledger import LEDGER_FILE
+from noisepy.seis.noise_module import moving_ave, smooth_source_spect
 
 
 def test_read_channels():
@@ -107,3 +124,385 @@ def test_correlation(rm_resp: RmResp, cc_method: CCMethod, substack: bool, subst
     cross_correlate(raw_store, config, cc_store)
     expected_writes = nsta * (nsta + 1) / 2
     assert expected_writes == cc_store.append.call_count
+
+
+def _run_correlation(config: ConfigParameters, read_data: bool = True) -> dict:
+    path = os.path.join(os.path.dirname(__file__), "./data/cc")
+    raw_store = SCEDCS3DataStore(path, MockCatalogMock())
+    if not read_data:
+        raw_store.read_data = Mock(side_effect=AssertionError("data should not be read"))
+    ts = raw_store.get_timespans()
+    channels = raw_store.get_channels(ts[0])
+    for c in channels:
+        c.station.lat = 45
+        c.station.lon = 45
+        c.station.elevation = 45
+    cc_store = Mock()
+    cc_store.contains.return_value = False
+    cross_correlate(raw_store, config, cc_store)
+    return {(str(c[0][1]), str(c[0][2])): c[0][3] for c in cc_store.append.call_args_list}
+
+
+@pytest.mark.parametrize("cc_method", [CCMethod.XCORR, CCMethod.COHERENCY, CCMethod.DECONV])
+@pytest.mark.parametrize("substack_len", [0, 1, 2])
+def test_correlation_batched(cc_method: CCMethod, substack_len: int):
+    config = ConfigParameters(samp_freq=1.0, rm_resp=RmResp.NO, cc_method=cc_method)
+    if substack_len > 0:
+        config.substack = True
+        config.substack_len = substack_len * config.cc_len
+    expected = _run_correlation(config)
+    batched = _run_correlation(config.model_copy(update={"cc_engine": CCEngine.BATCHED, "cc_batch_size": 2}))
+
+    assert expected.keys() == batched.keys()
+    for pair, ccs in expected.items():
+        assert [str(cc) for cc in ccs] == [str(cc) for cc in batched[pair]]
+        for cc, bcc in zip(ccs, batched[pair]):
+            assert cc.parameters == bcc.parameters
+            np.testing.assert_allclose(cc.data, bcc.data, rtol=1e-4, atol=1e-4 * np.abs(cc.data).max())
+
+
+@pytest.mark.parametrize("cc_method", [CCMethod.XCORR, CCMethod.COHERENCY, CCMethod.DECONV])
+@pytest.mark.parametrize("cc_engine", [CCEngine.PAIRWISE, CCEngine.BATCHED])
+def test_correlation_process(cc_method: CCMethod, cc_engine: CCEngine):
+    config = ConfigParameters(samp_freq=1.0, rm_resp=RmResp.NO, cc_method=cc_method, cc_engine=cc_engine)
+    expected = _run_correlation(config)
+    shared = _run_correlation(config.model_copy(update={"cc_executor": CCExecutor.PROCESS, "cc_batch_size": 3}))
+
+    assert expected.keys() == shared.keys()
+    for pair, ccs in expected.items():
+        assert [str(cc) for cc in ccs] == [str(cc) for cc in shared[pair]]
+        for cc, scc in zip(ccs, shared[pair]):
+            assert cc.parameters == scc.parameters
+            np.testing.assert_array_equal(cc.data, scc.data)
+
+
+def test_correlation_shared_pair_error():
+    config = ConfigParameters(samp_freq=1.0, cc_len=16, step=16, substack_len=16, maxlag=4, rm_resp=RmResp.NO)
+    nwin, nfft = 3, 16
+    rng = np.random.default_rng(0)
+    channels = [Channel(ChannelType("BHZ"), Station("CI", f"S{i}", 34.0 + i, -118.0, 0.0)) for i in range(2)]
+    ffts = {}
+    for i in range(len(channels)):
+        spect = rng.standard_normal(nwin * nfft // 2) + 1j * rng.standard_normal(nwin * nfft // 2)
+        ffts[i] = NoiseFFT(spect.astype(np.complex64), np.ones(nwin), np.arange(nwin), nwin, nfft)
+    block, shared = sharedmem.share_ffts(ffts, {})
+    try:
+        # the second station pair has an unknown channel, the others of the task still get correlated
+        results = cross_correlation_shared(shared, config, [[(0, 1)], [(0, 2)], [(1, 1)]], channels, nfft)
+    finally:
+        ffts.clear()
+        block.close()
+        sharedmem.detach()
+    assert [len(r) if r is not None else None for r in results] == [1, None, 1]
+
+
+@pytest.mark.parametrize("cc_method", [CCMethod.XCORR, CCMethod.COHERENCY, CCMethod.DECONV])
+@pytest.mark.parametrize("cc_engine", [CCEngine.PAIRWISE, CCEngine.BATCHED])
+def test_correlation_tiled(tmp_path, cc_method: CCMethod, cc_engine: CCEngine):
+    config = ConfigParameters(samp_freq=1.0, rm_resp=RmResp.NO, cc_method=cc_method, cc_engine=cc_engine)
+    expected = _run_correlation(config)
+    # small enough to have one station per block
+    budget = estimate_memory(config, 1)
+    tiled = _run_correlation(config.model_copy(update={"memory_budget": budget, "spill_dir": str(tmp_path)}))
+
+    assert expected.keys() == tiled.keys()
+    for pair, ccs in expected.items():
+        assert [str(cc) for cc in ccs] == [str(cc) for cc in tiled[pair]]
+        for cc, tcc in zip(ccs, tiled[pair]):
+            assert cc.parameters == tcc.parameters
+            np.testing.assert_array_equal(cc.data, tcc.data)
+    # the spilled blocks are cleaned up
+    assert len(list(tmp_path.iterdir())) == 0
+
+
+def test_correlation_fft_store(tmp_path):
+    config = ConfigParameters(samp_freq=1.0, rm_resp=RmResp.NO, fft_store_path=str(tmp_path))
+    expected = _run_correlation(config)
+    # a different correlation method reuses the stored FFTs without reading the data
+    for cc_method in [CCMethod.XCORR, CCMethod.COHERENCY]:
+        stored = _run_correlation(config.model_copy(update={"cc_method": cc_method}), read_data=False)
+        assert expected.keys() == stored.keys()
+        if cc_method == config.cc_method:
+            for pair, ccs in expected.items():
+                for cc, scc in zip(ccs, stored[pair]):
+                    np.testing.assert_array_equal(cc.data, scc.data)
+
+
+@pytest.mark.parametrize("cc_engine", [CCEngine.PAIRWISE, CCEngine.BATCHED])
+@pytest.mark.parametrize("substack_len", [0, 1, 2])
+def test_correlation_band_limited(cc_engine: CCEngine, substack_len: int):
+    # a band well below the Nyquist frequency, so that most of the whitened spectrum is zero
+    config = ConfigParameters(samp_freq=1.0, rm_resp=RmResp.NO, cc_engine=cc_engine, freqmin=0.05, freqmax=0.2)
+    if substack_len > 0:
+        config.substack = True
+        config.substack_len = substack_len * config.cc_len
+    expected = _run_correlation(config)
+    band = _run_correlation(config.model_copy(update={"band_limited_fft": True}))
+
+    assert expected.keys() == band.keys()
+    for pair, ccs in expected.items():
+        assert [str(cc) for cc in ccs] == [str(cc) for cc in band[pair]]
+        for cc, bcc in zip(ccs, band[pair]):
+            assert cc.parameters == bcc.parameters
+            np.testing.assert_allclose(cc.data, bcc.data, rtol=1e-4, atol=1e-4 * np.abs(cc.data).max())
+
+
+@pytest.mark.parametrize("cc_engine", [CCEngine.PAIRWISE, CCEngine.BATCHED])
+def test_correlation_reject_windows_early(cc_engine: CCEngine):
+    # low enough to reject some of the windows
+    config = ConfigParameters(samp_freq=1.0, rm_resp=RmResp.NO, cc_engine=cc_engine, max_over_std=5)
+    expected = _run_correlation(config)
+    early = _run_correlation(config.model_copy(update={"reject_windows_early": True}))
+
+    assert expected.keys() == early.keys()
+    for pair, ccs in expected.items():
+        assert [str(cc) for cc in ccs] == [str(cc) for cc in early[pair]]
+        for cc, ecc in zip(ccs, early[pair]):
+            assert cc.parameters == ecc.parameters
+            np.testing.assert_allclose(cc.data, ecc.data, rtol=1e-6, atol=1e-6 * np.abs(cc.data).max())
+
+
+@pytest.mark.parametrize("channels_in_flight", [1, 4])
+def test_correlation_streaming(channels_in_flight: int):
+    config = ConfigParameters(samp_freq=1.0, rm_resp=RmResp.NO)
+    expected = _run_correlation(config)
+    streamed = _run_correlation(config.model_copy(update={"channels_in_flight": channels_in_flight}))
+
+    assert expected.keys() == streamed.keys()
+    for pair, ccs in expected.items():
+        assert [str(cc) for cc in ccs] == [str(cc) for cc in streamed[pair]]
+        for cc, scc in zip(ccs, streamed[pair]):
+            assert cc.parameters == scc.parameters
+            np.testing.assert_array_equal(cc.data, scc.data)
+
+
+def _two_day_store() -> SCEDCS3DataStore:
+    path = os.path.join(os.path.dirname(__file__), "./data/cc")
+    raw_store = SCEDCS3DataStore(path, MockCatalogMock())
+    ts = raw_store.get_timespans()[0]
+    # the same day twice to have more than one timespan
+    raw_store.get_timespans = Mock(return_value=[ts, ts])
+    get_channels = raw_store.get_channels
+
+    def channels_with_location(ts):
+        channels = get_channels(ts)
+        for c in channels:
+            c.station.lat = 45
+            c.station.lon = 45
+            c.station.elevation = 45
+        return channels
+
+    raw_store.get_channels = channels_with_location
+    return raw_store
+
+
+def _split_day_store(n: int) -> SCEDCS3DataStore:
+    raw_store = _two_day_store()
+    day = raw_store.get_timespans()[0]
+    start = day.start_datetime
+    hours = 24 // n
+    timespans = [
+        DateTimeRange(start + timedelta(hours=hours * i), start + timedelta(hours=hours * (i + 1))) for i in range(n)
+    ]
+    raw_store.get_timespans = Mock(return_value=timespans)
+    # the store only knows the whole day, the parts of the day (or the day) are served from it
+    get_channels = raw_store.get_channels
+    raw_store.get_channels = Mock(side_effect=lambda ts: get_channels(day))
+    read_data = raw_store.read_data
+
+    def read_timespan(ts, ch):
+        # only the data of the timespan, its end excluded
+        ch_data = read_data(day, ch)
+        if ch_data.data.size == 0:
+            return ch_data
+        end = obspy.UTCDateTime(ts.end_datetime) - ch_data.stream[0].stats.delta
+        st = ch_data.stream.slice(obspy.UTCDateTime(ts.start_datetime), end)
+        return ChannelData(st) if len(st) else ChannelData.empty()
+
+    raw_store.read_data = Mock(side_effect=read_timespan)
+    return raw_store
+
+
+def test_correlation_timespan_batch():
+    config = ConfigParameters(samp_freq=1.0, rm_resp=RmResp.NO, inc_hours=6)
+    results = []
+    read_counts = []
+    for batch in [1, 4]:
+        raw_store = _split_day_store(4)
+        cc_store = Mock()
+        cc_store.contains.return_value = False
+        cross_correlate(raw_store, config.model_copy(update={"timespan_batch": batch}), cc_store)
+        results.append({(str(c[0][0]), str(c[0][1]), str(c[0][2])): c[0][3] for c in cc_store.append.call_args_list})
+        read_counts.append(raw_store.read_data.call_count)
+
+    # 3 pairs in each of the 4 timespans
+    assert results[0].keys() == results[1].keys() and len(results[0]) == 12
+    for key, ccs in results[0].items():
+        assert [str(cc) for cc in ccs] == [str(cc) for cc in results[1][key]]
+        for cc, bcc in zip(ccs, results[1][key]):
+            assert cc.parameters == bcc.parameters
+            np.testing.assert_array_equal(cc.data, bcc.data)
+    # the store returns only the data of each timespan, so nothing is reused
+    assert read_counts == [4 * 2, 4 * 2]
+
+
+def test_correlation_ledger(tmp_path):
+    config = ConfigParameters(samp_freq=1.0, rm_resp=RmResp.NO, ledger_path=str(tmp_path))
+    ts = _two_day_store().get_timespans()[0]
+
+    def run(config: ConfigParameters, channels: bool = True) -> Mock:
+        raw_store = _two_day_store()
+        raw_store.get_timespans = Mock(return_value=[ts])
+        if not channels:
+            # the data is not available yet
+            raw_store.get_channels = Mock(return_value=[])
+        cc_store = Mock()
+        cc_store.contains.return_value = False
+        cross_correlate(raw_store, config, cc_store)
+        return cc_store
+
+    def marked() -> int:
+        with sqlite3.connect(str(tmp_path / LEDGER_FILE)) as conn:
+            return conn.execute("SELECT COUNT(*) FROM timespan_selections").fetchone()[0]
+
+    run(config, channels=False)
+    assert marked() == 0
+    # the data arrived
+    cc_store = run(config)
+    assert cc_store.append.call_count == 3
+    assert marked() == 1
+    # done, not even looked up in the store
+    cc_store = run(config)
+    assert cc_store.append.call_count == 0 and cc_store.contains.call_count == 0
+    # another selection of pairs is not done yet
+    run(config.model_copy(update={"acorr_only": True}))
+    assert marked() == 2
+
+
+def test_cc_timespan_no_data():
+    config = ConfigParameters(samp_freq=1.0, rm_resp=RmResp.NO)
+    raw_store = _two_day_store()
+    raw_store.read_data = Mock(return_value=ChannelData.empty())
+    cc_store = Mock()
+    cc_store.contains.return_value = False
+    executors = []
+
+    def thread_pool(*args, **kwargs):
+        executors.append(ThreadPoolExecutor(*args, **kwargs))
+        return executors[-1]
+
+    with patch("noisepy.seis.correlate.ThreadPoolExecutor", side_effect=thread_pool):
+        failed = cc_timespan(raw_store, config, cc_store, raw_store.get_timespans()[0])
+    assert len(failed) == 3
+    # the executor of the timespan is shut down when it returns early
+    assert len(executors) > 0 and all(executor._shutdown for executor in executors)
+
+
+def test_prefetcher():
+    raw_store = _two_day_store()
+    config = ConfigParameters(samp_freq=1.0, rm_resp=RmResp.NO, prefetch_depth=1)
+    cc_store = Mock()
+    cc_store.contains.return_value = False
+    prefetcher = TimespanPrefetcher(raw_store, config, cc_store, raw_store.get_timespans(), lambda s, r: True)
+    assert prefetcher.get(0) is None
+    work = prefetcher.get(1)
+    assert len(work.missing_pairs) == 3
+    assert len(work.ch_data) == len(work.channels) == 2
+    prefetcher.shutdown()
+    raw_size = sum(tr.data.nbytes for _, cd in work.ch_data for tr in cd.stream) / 1024**3
+
+    # not enough memory to read ahead, or to keep the raw data once read
+    for prefetch_memory in [0.0, raw_size * 0.9]:
+        config = config.model_copy(update={"prefetch_memory": prefetch_memory})
+        prefetcher = TimespanPrefetcher(raw_store, config, cc_store, raw_store.get_timespans(), lambda s, r: True)
+        assert prefetcher.get(0) is None
+        work = prefetcher.get(1)
+        assert len(work.channels) == 2
+        assert work.ch_data is None
+        prefetcher.shutdown()
+
+
+def test_correlation_prefetch():
+    config = ConfigParameters(samp_freq=1.0, rm_resp=RmResp.NO)
+    results = []
+    for depth in [0, 1]:
+        cc_store = Mock()
+        cc_store.contains.return_value = False
+        cross_correlate(_two_day_store(), config.model_copy(update={"prefetch_depth": depth}), cc_store)
+        # the saves are concurrent, so sort them by station pair
+        results.append(sorted(cc_store.append.call_args_list, key=lambda c: str(c[0][1:3])))
+    assert len(results[0]) == len(results[1]) == 6
+    for call, pcall in zip(*results):
+        assert str(call[0][1:3]) == str(pcall[0][1:3])
+        for cc, pcc in zip(call[0][3], pcall[0][3]):
+            np.testing.assert_array_equal(cc.data, pcc.data)
+
+
+def test_channel_blocks():
+    sta1 = Station("CI", "ABC")
+    sta2 = Station("CI", "DEF")
+    channels = [Channel(ChannelType(name), sta) for sta in [sta1, sta2] for name in ["BHE", "BHN", "BHZ"]]
+    assert channel_blocks(channels, 1) == [channels[:3], channels[3:]]
+    assert channel_blocks(channels, 4) == [channels[:3], channels[3:]]
+    assert channel_blocks(channels, 6) == [channels]
+
+
+def test_create_pairs():
+    # stations along the equator, ~111km apart
+    stations = [Station("CI", f"S{i}", lat=0.0, lon=float(i)) for i in range(4)]
+    channels = [Channel(ChannelType(name), sta) for sta in stations for name in ["BHE", "BHN", "BHZ"]]
+    config = ConfigParameters()
+    pairs = create_pairs(lambda s, r: True, channels, config)
+    assert len(pairs) == 4 * 5 / 2
+    assert sum(map(len, pairs.values())) == 12 * 13 / 2
+    assert pairs[(stations[0], stations[1])][0] == (0, 3)
+
+    pairs = create_pairs(lambda s, r: True, channels, config.model_copy(update={"max_distance": 150.0}))
+    assert set((s.name, r.name) for s, r in pairs) == {("S0", "S0"), ("S1", "S1"), ("S2", "S2"), ("S3", "S3")} | {
+        ("S0", "S1"),
+        ("S1", "S2"),
+        ("S2", "S3"),
+    }
+    pairs = create_pairs(lambda s, r: True, channels, config.model_copy(update={"min_distance": 250.0}))
+    assert set((s.name, r.name) for s, r in pairs if s != r) == {("S0", "S3")}
+    pairs = create_pairs(lambda s, r: True, channels, config.model_copy(update={"acorr_only": True}))
+    assert all(s == r for s, r in pairs) and sum(map(len, pairs.values())) == 4 * 6
+
+
+@pytest.mark.parametrize("cc_method", [CCMethod.XCORR, CCMethod.COHERENCY, CCMethod.DECONV])
+def test_spectral_norms(cc_method: CCMethod):
+    config = ConfigParameters(cc_method=cc_method)
+    nwin, nfft = 3, 16
+    rng = np.random.default_rng(0)
+    spect = (rng.standard_normal(nwin * nfft // 2) + 1j * rng.standard_normal(nwin * nfft // 2)).astype(np.complex64)
+    fft = NoiseFFT(spect, np.ones(nwin), np.arange(nwin), nwin, nfft)
+    norms = spectral_norms(config, fft)
+
+    if cc_method == CCMethod.DECONV:
+        np.testing.assert_array_equal(norms.source, smooth_source_spect(config, spect).reshape(nwin, nfft // 2))
+    else:
+        assert norms.source is None
+    if cc_method == CCMethod.COHERENCY:
+        assert norms.receiver.dtype == np.float32
+        expected = moving_ave(np.abs(spect), config.smoothspect_N).reshape(nwin, nfft // 2)
+        np.testing.assert_allclose(norms.receiver, expected, rtol=1e-6)
+    else:
+        assert norms.receiver is None
+    np.testing.assert_array_equal(norms.good, np.ones(nwin, dtype=bool))
+
+
+@pytest.mark.parametrize("reject_windows_early", [False, True])
+def test_pair_windows(reject_windows_early: bool):
+    config = ConfigParameters(reject_windows_early=reject_windows_early)
+    src = NoiseFFT(np.zeros(4), np.ones(4), np.array([0.0, 10.0, 20.0, 30.0]), 4, 2)
+    if reject_windows_early:
+        # the receiver's window at 10 was dropped
+        rec = NoiseFFT(np.zeros(3), np.ones(3), np.array([0.0, 20.0, 30.0]), 3, 2)
+        src_rows, rec_rows = pair_windows(config, src, np.array([1, 1, 0, 1], bool), rec, np.ones(3, bool))
+        np.testing.assert_array_equal(src_rows, [0, 3])
+        np.testing.assert_array_equal(rec_rows, [0, 2])
+    else:
+        rec = NoiseFFT(np.zeros(4), np.ones(4), src.fft_time, 4, 2)
+        src_rows, rec_rows = pair_windows(config, src, np.array([1, 1, 0, 1], bool), rec, np.array([1, 0, 1, 1], bool))
+        np.testing.assert_array_equal(src_rows, [0, 3])
+        np.testing.assert_array_equal(rec_rows, [0, 3])
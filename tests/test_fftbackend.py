@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+import scipy.signal
+
+from noisepy.seis import fftbackend
+from noisepy.seis.datatypes import ConfigParameters, FFTLibrary
+
+
+@pytest.fixture
+def restore_backend():
+    backend = fftbackend.get_backend()
+    yield
+    fftbackend._backend = backend
+
+
+def _check_transforms(backend: fftbackend.ScipyFFT):
+    x = np.random.random((3, 100)).astype(np.float32)
+    for _ in range(2):
+        spec = backend.rfft(x, 128, axis=1)
+        np.testing.assert_allclose(spec, np.fft.rfft(x, 128, axis=1), rtol=1e-4, atol=1e-4)
+        np.testing.assert_allclose(backend.irfft(spec, 128, axis=1)[:, :100], x, atol=1e-5)
+        full = backend.fft(x.T, 128, axis=0)
+        np.testing.assert_allclose(full, np.fft.fft(x.T, 128, axis=0), rtol=1e-4, atol=1e-4)
+        np.testing.assert_allclose(backend.ifft(full, axis=0)[:100].real, x.T, atol=1e-5)
+
+
+def test_scipy_backend(restore_backend):
+    backend = fftbackend.configure(ConfigParameters(fft_workers=2))
+    assert backend is fftbackend.get_backend()
+    assert backend.library == FFTLibrary.SCIPY
+    assert backend.workers == 2
+    _check_transforms(backend)
+    # the same backend when the configuration doesn't change
+    assert fftbackend.configure(ConfigParameters(fft_workers=2)) is backend
+
+
+def test_pyfftw_backend(restore_backend, tmp_path):
+    pytest.importorskip("pyfftw")
+    wisdom = str(tmp_path / "wisdom.pkl")
+    backend = fftbackend.configure(ConfigParameters(fft_library=FFTLibrary.PYFFTW, fft_wisdom_path=wisdom))
+    assert backend.library == FFTLibrary.PYFFTW
+    _check_transforms(backend)
+    backend.save_wisdom()
+    # loaded by the next run
+    fftbackend.PyFFTW(wisdom_path=wisdom)
+
+
+@pytest.mark.parametrize("N", [100, 101])
+def test_hilbert(N: int):
+    x = np.random.random((2, 90))
+    np.testing.assert_allclose(fftbackend.hilbert(x, N, axis=1), scipy.signal.hilbert(x, N, axis=1), atol=1e-10)
@@ -0,0 +1,56 @@
+import numpy as np
+from datetimerange import DateTimeRange
+
+from noisepy.seis.datatypes import BandNoiseFFT, ConfigParameters, band_offset
+from noisepy.seis.fftstore import NumpyFFTStore, fft_params_hash
+from noisepy.seis.io.datatypes import Channel, ChannelType, NoiseFFT, Station
+
+
+def test_fft_params_hash():
+    config = ConfigParameters()
+    # correlation parameters don't change the FFTs
+    assert fft_params_hash(config) == fft_params_hash(config.model_copy(update={"maxlag": 100, "substack": True}))
+    assert fft_params_hash(config) != fft_params_hash(config.model_copy(update={"freqmin": 0.1}))
+    assert fft_params_hash(config) != fft_params_hash(config.model_copy(update={"fft_library": "pyfftw"}))
+    assert fft_params_hash(config) != fft_params_hash(config.model_copy(update={"preprocess_engine": "batched"}))
+    # the margin of the band limited FFTs
+    assert fft_params_hash(config) == fft_params_hash(config.model_copy(update={"smoothspect_N": 5}))
+    band = config.model_copy(update={"band_limited_fft": True})
+    assert fft_params_hash(band) != fft_params_hash(band.model_copy(update={"smoothspect_N": 5}))
+
+
+def test_fft_store(tmp_path):
+    config = ConfigParameters()
+    store = NumpyFFTStore(str(tmp_path), config)
+    ts = DateTimeRange("2021-01-01T00:00:00Z", "2021-01-02T00:00:00Z")
+    chan = Channel(ChannelType("BHZ"), Station("CI", "BAK"))
+    fft = NoiseFFT(np.arange(12, dtype=np.complex64), np.ones(3), np.arange(3.0), 3, 8)
+
+    assert not store.contains(ts, chan)
+    assert store.read(ts, chan) is None
+    store.append(ts, chan, fft)
+    assert store.contains(ts, chan)
+    read = store.read(ts, chan)
+    np.testing.assert_array_equal(read.fft, fft.fft)
+    assert read.fft.dtype == fft.fft.dtype
+    np.testing.assert_array_equal(read.std, fft.std)
+    np.testing.assert_array_equal(read.fft_time, fft.fft_time)
+    assert (read.window_count, read.length) == (3, 8)
+
+    # other pre-processing parameters use a separate cache
+    other = NumpyFFTStore(str(tmp_path), config.model_copy(update={"freq_norm": "no"}))
+    assert not other.contains(ts, chan)
+
+
+def test_fft_store_band(tmp_path):
+    store = NumpyFFTStore(str(tmp_path), ConfigParameters(band_limited_fft=True))
+    ts = DateTimeRange("2021-01-01T00:00:00Z", "2021-01-02T00:00:00Z")
+    chan = Channel(ChannelType("BHZ"), Station("CI", "BAK"))
+    store.append(ts, chan, BandNoiseFFT(np.arange(6, dtype=np.complex64), np.ones(3), np.arange(3.0), 3, 8, 1))
+    read = store.read(ts, chan)
+    assert band_offset(read) == 1
+    assert read.fft.size == 6 and (read.window_count, read.length) == (3, 8)
+
+    # another margin around the band uses a separate cache
+    other = NumpyFFTStore(str(tmp_path), ConfigParameters(band_limited_fft=True, smoothspect_N=5))
+    assert not other.contains(ts, chan)
@@ -0,0 +1,43 @@
+import numpy as np
+import obspy
+
+from noisepy.seis.geometry import StationGeometry, gps2dist_azimuth
+from noisepy.seis.io.datatypes import Station
+
+
+def test_gps2dist_azimuth():
+    rng = np.random.default_rng(0)
+    lat1, lat2 = rng.uniform(-89, 89, (2, 100))
+    lon1, lon2 = rng.uniform(-180, 180, (2, 100))
+    # coincident points
+    lat2[0], lon2[0] = lat1[0], lon1[0]
+    dist, azi, baz = gps2dist_azimuth(lat1, lon1, lat2, lon2)
+    expected = np.array([obspy.geodetics.base.gps2dist_azimuth(*p) for p in zip(lat1, lon1, lat2, lon2)])
+    np.testing.assert_allclose(dist, expected[:, 0], atol=0.1)
+    np.testing.assert_allclose(azi, expected[:, 1], atol=1e-6)
+    np.testing.assert_allclose(baz, expected[:, 2], atol=1e-6)
+
+
+def test_station_geometry():
+    sta1 = Station("CI", "ABC", lat=34.0, lon=-118.0)
+    sta2 = Station("CI", "DEF", lat=35.0, lon=-117.0)
+    geometry = StationGeometry()
+    geometry.compute([(sta1, sta2)])
+    dist, azi, baz = obspy.geodetics.base.gps2dist_azimuth(sta1.lat, sta1.lon, sta2.lat, sta2.lon)
+    np.testing.assert_allclose(geometry.get(sta1, sta2), (dist / 1000, azi, baz), atol=1e-6)
+    np.testing.assert_allclose(geometry.get(sta2, sta1), (dist / 1000, baz, azi), atol=1e-6)
+    assert geometry.subset([(sta2, sta1)]).get(sta2, sta1) == geometry.get(sta2, sta1)
+
+
+def test_station_pairs():
+    rng = np.random.default_rng(1)
+    stations = [Station("CI", f"S{i}", lat=rng.uniform(30, 40), lon=rng.uniform(-125, -115)) for i in range(50)]
+    lat = np.array([s.lat for s in stations])
+    lon = np.array([s.lon for s in stations])
+    ii, jj = np.triu_indices(len(stations))
+    dist = gps2dist_azimuth(lat[ii], lon[ii], lat[jj], lon[jj])[0] / 1000
+    geometry = StationGeometry()
+    assert geometry.station_pairs(stations) == list(zip(ii.tolist(), jj.tolist()))
+    keep = ((dist >= 100) | (ii == jj)) & (dist <= 300)
+    expected = list(zip(ii[keep].tolist(), jj[keep].tolist()))
+    assert geometry.station_pairs(stations, 100, 300) == expected
@@ -0,0 +1,53 @@
+import pickle
+
+from datetimerange import DateTimeRange
+
+from noisepy.seis.io.datatypes import Channel, ChannelType, Station
+from noisepy.seis.ledger import (
+    LEDGER_FILE,
+    STEP_CC,
+    STEP_STACK,
+    CompletionLedger,
+    selection_key,
+)
+
+
+def test_ledger(tmp_path):
+    ledger = CompletionLedger(str(tmp_path))
+    assert ledger.path == str(tmp_path / LEDGER_FILE)
+    ts1 = DateTimeRange("2021-01-01T00:00:00Z", "2021-01-02T00:00:00Z")
+    ts2 = DateTimeRange("2021-01-02T00:00:00Z", "2021-01-03T00:00:00Z")
+    sta1 = Station("CI", "BAK")
+    sta2 = Station("CI", "ARV")
+    sta3 = Station("CI", "SVD")
+
+    ledger.mark_pairs(STEP_CC, ts1, [(sta1, sta2), (sta1, sta1)])
+    assert ledger.is_done(STEP_CC, ts1, sta1, sta2)
+    assert not ledger.is_done(STEP_CC, ts1, sta2, sta1)
+    assert not ledger.is_done(STEP_CC, ts2, sta1, sta2)
+    assert not ledger.is_done(STEP_STACK, ts1, sta1, sta2)
+    assert ledger.done_pairs(STEP_CC, ts1) == {(str(sta1), str(sta2)), (str(sta1), str(sta1))}
+    done, todo = ledger.filter_done(STEP_CC, ts1, [(sta1, sta1), (sta1, sta3), (sta1, sta2)])
+    assert done == [(sta1, sta1), (sta1, sta2)]
+    assert todo == [(sta1, sta3)]
+    # marking twice is fine
+    ledger.mark_pairs(STEP_CC, ts1, [(sta1, sta2)])
+    assert len(ledger.done_pairs(STEP_CC, ts1)) == 2
+
+    channels = [Channel(ChannelType("BHZ"), sta) for sta in [sta1, sta2]]
+    selection = selection_key(channels, [(sta1, sta2), (sta1, sta1)])
+    # independent of the order
+    assert selection == selection_key(channels[::-1], [(sta1, sta1), (sta1, sta2)])
+    assert not ledger.timespan_done(STEP_CC, ts1, selection)
+    ledger.mark_timespan(STEP_CC, ts1, selection)
+    assert ledger.timespan_done(STEP_CC, ts1, selection)
+    assert not ledger.timespan_done(STEP_CC, ts2, selection)
+    # only done for the same channels and pairs
+    assert not ledger.timespan_done(STEP_CC, ts1, selection_key(channels, [(sta1, sta1)]))
+    assert not ledger.timespan_done(STEP_CC, ts1, selection_key(channels[:1], [(sta1, sta2), (sta1, sta1)]))
+
+    # e.g. sent to worker processes or opened by another run
+    other = pickle.loads(pickle.dumps(ledger))
+    assert other.is_done(STEP_CC, ts1, sta1, sta2)
+    other.mark_pairs(STEP_STACK, ts1, [(sta2, sta3)])
+    assert CompletionLedger(ledger.path).is_done(STEP_STACK, ts1, sta2, sta3)
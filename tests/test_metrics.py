@@ -0,0 +1,95 @@
+import json
+
+import numpy as np
+import pytest
+
+from noisepy.seis.datatypes import ConfigParameters, MetricsFormat
+from noisepy.seis.metrics import (
+    JsonLinesSink,
+    Metrics,
+    MetricsSink,
+    PrometheusSink,
+    create_metrics,
+    peak_rss,
+)
+
+
+def test_metrics_jsonl(tmp_path):
+    path = str(tmp_path / "metrics.jsonl")
+    metrics = Metrics(JsonLinesSink(path))
+    metrics.count("pairs", 3)
+    metrics.count("pairs")
+    with metrics.timer("fft"):
+        pass
+    metrics.add_time("fft", 1.0)
+    metrics.high_water("size", 5)
+    metrics.high_water("size", 2)
+    metrics.emit("cross_correlate_timespan", timespan="ts1")
+    # values start over after each record
+    metrics.count("pairs")
+    metrics.emit("cross_correlate_timespan", timespan="ts2")
+
+    with open(path) as f:
+        records = [json.loads(line) for line in f]
+    assert len(records) == 2
+    assert records[0]["stage"] == "cross_correlate_timespan"
+    assert records[0]["labels"] == {"timespan": "ts1"}
+    assert records[0]["counters"] == {"pairs": 4}
+    assert records[0]["timers"]["fft"] >= 1.0
+    assert records[0]["gauges"]["size"] == 5
+    assert records[0]["gauges"]["peak_rss_bytes"] > 0
+    assert records[1]["counters"] == {"pairs": 1}
+    assert "fft" not in records[1]["timers"]
+
+
+def test_metrics_prometheus(tmp_path):
+    path = str(tmp_path / "noisepy.prom")
+    metrics = Metrics(PrometheusSink(path))
+    metrics.count("pairs", 2)
+    metrics.add_time("save", 0.5)
+    metrics.emit("stack")
+    metrics.count("pairs", 3)
+    metrics.emit("stack")
+
+    with open(path) as f:
+        lines = f.read().splitlines()
+    # the latest value of each sample
+    assert 'noisepy_pairs{stage="stack"} 3' in lines
+    assert 'noisepy_pairs{stage="stack"} 2' not in lines
+    assert 'noisepy_save_seconds{stage="stack"} 0.5' in lines
+    assert any(line.startswith('noisepy_elapsed_seconds{stage="stack"}') for line in lines)
+
+
+def test_metrics_prometheus_timespans(tmp_path):
+    path = str(tmp_path / "noisepy.prom")
+    metrics = Metrics(PrometheusSink(path))
+    for i in range(3):
+        metrics.count("pairs", i)
+        metrics.emit("cross_correlate_timespan", timespan=f"ts{i}")
+
+    with open(path) as f:
+        lines = f.read().splitlines()
+    # only the latest timespan, without a series for each one
+    assert [line for line in lines if line.startswith("noisepy_pairs")] == [
+        'noisepy_pairs{stage="cross_correlate_timespan"} 2'
+    ]
+
+
+def test_metrics_sink_abstract():
+    with pytest.raises(TypeError):
+        MetricsSink()
+
+
+def test_peak_rss():
+    data = np.ones(64 * 1024**2, dtype=np.uint8)
+    del data
+    # the high-water mark, including the memory already freed
+    assert peak_rss() >= 64 * 1024**2
+
+
+def test_create_metrics(tmp_path):
+    assert create_metrics(ConfigParameters()).sink is None
+    config = ConfigParameters(metrics_path=str(tmp_path / "m.prom"), metrics_format=MetricsFormat.PROMETHEUS)
+    assert isinstance(create_metrics(config).sink, PrometheusSink)
+    config = ConfigParameters(metrics_path=str(tmp_path / "m.jsonl"))
+    assert isinstance(create_metrics(config).sink, JsonLinesSink)
@@ -1,12 +1,33 @@
 import numpy as np
+import obspy
 import pytest
+import scipy.fft
+from scipy.fftpack import next_fast_len
 
-from noisepy.seis.io.datatypes import CCMethod, ConfigParameters, FreqNorm, TimeNorm
+from noisepy.seis.datatypes import ResampleMethod
+from noisepy.seis.io.datatypes import (
+    CCMethod,
+    ChannelData,
+    ConfigParameters,
+    FreqNorm,
+    RmResp,
+    TimeNorm,
+)
 from noisepy.seis.noise_module import (
+    correlate,
+    correlate_batch,
+    cut_trace_make_stat,
+    decimation_factors,
     demean,
+    demean_detrend_taper,
     detrend,
     mad,
+    moving_ave,
     noise_processing,
+    prefilter_band,
+    preprocess_raw,
+    preprocess_raw_batch,
+    running_mean_2D,
     smooth_source_spect,
     taper,
 )
@@ -26,6 +47,17 @@ def test_taper(data: np.ndarray):
         assert np.isclose(np.linalg.norm(data_taper[:, -1]), 0)
 
 
+@pytest.mark.parametrize("data", [d for d in data + data2 if d.ndim == 2])
+def test_demean_detrend_taper(data: np.ndarray):
+    expected = taper(detrend(demean(data.astype(np.float32))))
+    out = demean_detrend_taper(data.astype(np.float32))
+    assert out.dtype == np.float32
+    np.testing.assert_allclose(out, expected, atol=1e-5)
+    # on a read-only view of windows as in cut_trace_make_stat
+    windows = np.lib.stride_tricks.sliding_window_view(data[0].astype(np.float32), 50)[::10]
+    np.testing.assert_allclose(demean_detrend_taper(windows), taper(detrend(demean(windows.copy()))), atol=1e-5)
+
+
 @pytest.mark.parametrize("mask", [True, False])
 def test_mad(mask: bool):
     data = np.random.random(500)
@@ -68,7 +100,8 @@ def test_noise_processing(time_norm: TimeNorm, freq_norm: FreqNorm):
     config.time_norm = time_norm
     config.freq_norm = freq_norm
     dataS = np.random.random([2, 500])
-    noise_processing(config, dataS)
+    spec = noise_processing(config, dataS)
+    assert spec.shape == (2, 500 // 2 + 1)
 
 
 @pytest.mark.parametrize("cc_method", [CCMethod.COHERENCY, CCMethod.DECONV, CCMethod.XCORR])
@@ -77,3 +110,209 @@ def test_smooth_source_spect(cc_method: CCMethod):
     config.cc_method = cc_method
     fft1 = np.random.random(500)
     smooth_source_spect(config, fft1)
+
+
+@pytest.mark.parametrize("Nfft", [500, 375])
+def test_correlate_hermitian(Nfft: int):
+    # the CCF must match an inverse FFT of the spectrum with its negative frequencies rebuilt by hand
+    config = ConfigParameters(samp_freq=1.0, maxlag=100)
+    Nfft2 = Nfft // 2
+    nwin = 4
+    fft1 = np.random.random((nwin, Nfft2)) + 1j * np.random.random((nwin, Nfft2))
+    fft2 = np.random.random((nwin, Nfft2)) + 1j * np.random.random((nwin, Nfft2))
+    s_corr, _, _ = correlate(fft1.astype(np.complex64), fft2.astype(np.complex64), config, Nfft, np.arange(nwin))
+
+    crap = np.zeros(Nfft, dtype=np.complex64)
+    crap[:Nfft2] = np.mean(fft1.astype(np.complex64) * fft2.astype(np.complex64), axis=0)
+    crap[:Nfft2] -= np.mean(crap[:Nfft2])
+    crap[-Nfft2 + 1 :] = np.flip(np.conj(crap[1:Nfft2]))
+    expected = np.real(np.fft.ifftshift(np.fft.ifft(crap)))
+    t = np.arange(-Nfft2 + 1, Nfft2) * config.dt
+    expected = expected[np.where(np.abs(t) <= config.maxlag)[0]]
+    assert s_corr.dtype == np.float32
+    np.testing.assert_allclose(s_corr[0], expected, atol=1e-5 * np.abs(expected).max())
+
+
+@pytest.mark.parametrize("substack_len", [1, 3])
+@pytest.mark.parametrize("dtype", [np.complex64, np.complex128])
+def test_correlate_substacks(substack_len: int, dtype):
+    # the vectorized sub-stacks must be bit for bit those of a loop over the windows or sub-stacks
+    config = ConfigParameters(samp_freq=1.0, maxlag=50, cc_len=100, step=50, substack=True)
+    config.substack_len = substack_len * config.cc_len
+    Nfft, nwin = 200, 10
+    Nfft2 = Nfft // 2
+    rng = np.random.default_rng(0)
+    fft1 = (rng.standard_normal((nwin, Nfft2)) + 1j * rng.standard_normal((nwin, Nfft2))).astype(dtype)
+    fft2 = (rng.standard_normal((nwin, Nfft2)) + 1j * rng.standard_normal((nwin, Nfft2))).astype(dtype)
+    # with a gap in the windows
+    dataS_t = (1000.0 + 50.0 * np.r_[0:4, 6:12]).astype(np.float32)
+    s_corr, t_corr, n_corr = correlate(fft1, fft2, config, Nfft, dataS_t)
+
+    corr = fft1 * fft2
+    groups = []
+    if substack_len == 1:
+        groups = [([i], dataS_t[i]) for i in range(nwin)]
+    else:
+        tstart = dataS_t[0]
+        for _ in range(int(np.round((dataS_t[-1] - dataS_t[0]) / config.substack_len))):
+            itime = np.where((dataS_t >= tstart) & (dataS_t < tstart + config.substack_len))[0]
+            if len(itime):
+                groups.append((itime, tstart))
+            tstart += config.substack_len
+    expected = np.zeros((len(groups), Nfft), dtype=np.float32)
+    crap = np.zeros(Nfft2, dtype=np.complex64)
+    for i, (itime, _) in enumerate(groups):
+        crap[:] = np.mean(corr[itime, :], axis=0)
+        crap -= np.mean(crap)
+        crap[0] = complex(0, 0)
+        expected[i] = np.fft.ifftshift(scipy.fft.irfft(crap, Nfft))
+    ampmax = np.max(expected, axis=1)
+    tindx = np.where((ampmax < 20 * np.median(ampmax)) & (ampmax > 0))[0]
+    t = np.arange(-Nfft2 + 1, Nfft2) * config.dt
+    ind = np.where(np.abs(t) <= config.maxlag)[0]
+
+    np.testing.assert_array_equal(s_corr, expected[tindx][:, ind])
+    np.testing.assert_array_equal(t_corr, np.array([g[1] for g in groups], dtype=np.float32)[tindx])
+    np.testing.assert_array_equal(n_corr, np.array([len(g[0]) for g in groups])[tindx])
+
+
+def test_correlate_batch_no_windows():
+    config = ConfigParameters(samp_freq=1.0, maxlag=50, cc_len=100, step=50)
+    Nfft, nwin = 200, 4
+    rng = np.random.default_rng(0)
+    shape = (2, nwin, Nfft // 2)
+    fft1 = (rng.standard_normal(shape) + 1j * rng.standard_normal(shape)).astype(np.complex64)
+    fft2 = (rng.standard_normal(shape) + 1j * rng.standard_normal(shape)).astype(np.complex64)
+    # the windows of the second pair all have a zero amplitude and fail the test
+    fft1[1] = 0
+    dataS_t = np.tile(np.arange(nwin, dtype=np.float32) * 50, (2, 1))
+    good = np.ones((2, nwin), dtype=bool)
+    expected = [correlate(fft1[i].copy(), fft2[i], config, Nfft, dataS_t[i]) for i in range(2)]
+    results = correlate_batch(fft1.copy(), fft2, good, config, Nfft, dataS_t)
+
+    np.testing.assert_allclose(results[0][0], expected[0][0], atol=1e-5 * np.abs(expected[0][0]).max())
+    # NaNs as the mean of no window
+    assert np.isnan(expected[1][0]).all()
+    assert np.isnan(results[1][0]).all()
+    assert results[1][0].shape == expected[1][0].shape
+    assert results[1][1:] == expected[1][1:]
+
+
+def test_preprocess_raw_batch():
+    config = ConfigParameters(samp_freq=20.0, freqmin=0.05, freqmax=2.0, rm_resp=RmResp.NO)
+    t0 = obspy.UTCDateTime("2021-01-01T00:00:00")
+    t1 = t0 + 3600
+    rng = np.random.default_rng(0)
+
+    def trace(sps, start, seconds):
+        npts = int(seconds * sps)
+        data = rng.standard_normal(npts).astype(np.float32) + np.linspace(0, 5, npts, dtype=np.float32)
+        return obspy.Trace(data, header={"sampling_rate": sps, "starttime": start, "station": "STA"})
+
+    streams = [obspy.Stream([trace(20.0, t0, 3600)]) for _ in range(3)]
+    streams[1][0].data[100] = np.nan
+    # resampled after filtering
+    streams.append(obspy.Stream([trace(40.0, t0, 3600)]))
+    # gap to be merged: not batched
+    streams.append(obspy.Stream([trace(20.0, t0, 1700), trace(20.0, t0 + 1800, 1800)]))
+    streams.append(obspy.Stream())
+
+    expected = [preprocess_raw(st.copy(), obspy.Inventory(), config, t0, t1) for st in streams]
+    actual = preprocess_raw_batch([st.copy() for st in streams], [obspy.Inventory()] * len(streams), config, t0, t1)
+    assert len(actual) == len(expected)
+    for e, a in zip(expected, actual):
+        assert len(e) == len(a)
+        if len(e) == 0:
+            continue
+        assert a[0].stats.sampling_rate == e[0].stats.sampling_rate
+        assert a[0].stats.starttime == e[0].stats.starttime
+        assert a[0].data.dtype == e[0].data.dtype
+        np.testing.assert_allclose(a[0].data, e[0].data, atol=1e-4 * np.abs(e[0].data).max())
+
+
+def test_decimation_factors():
+    assert decimation_factors(100.0, 20.0, ResampleMethod.POLYPHASE) == (1, 5)
+    assert decimation_factors(50.0, 20.0, ResampleMethod.POLYPHASE) == (2, 5)
+    assert decimation_factors(100.0, 20.0, ResampleMethod.FFT) is None
+    assert decimation_factors(20.0, 20.0, ResampleMethod.POLYPHASE) is None
+    assert decimation_factors(100.003, 20.0, ResampleMethod.POLYPHASE) is None
+
+
+def test_preprocess_raw_polyphase():
+    config = ConfigParameters(samp_freq=20.0, freqmin=0.05, freqmax=2.0, rm_resp=RmResp.NO)
+    t0 = obspy.UTCDateTime("2021-01-01T00:00:00")
+    t1 = t0 + 3600
+    rng = np.random.default_rng(1)
+    header = {"sampling_rate": 100.0, "starttime": t0, "station": "STA"}
+    st = obspy.Stream([obspy.Trace(rng.standard_normal(360000).astype(np.float32), header=header)])
+
+    fft = preprocess_raw(st.copy(), obspy.Inventory(), config, t0, t1)
+    poly = preprocess_raw(st.copy(), obspy.Inventory(), config, t0, t1, resample_method=ResampleMethod.POLYPHASE)
+    assert poly[0].stats.sampling_rate == 20.0
+    assert poly[0].stats.npts == fft[0].stats.npts
+    # same signal in the pass band, away from the tapered ends
+    a = fft[0].data[2000:-2000]
+    b = poly[0].data[2000:-2000]
+    assert np.corrcoef(a, b)[0, 1] > 0.99
+
+    # the same steps with obspy's decimation, anti-aliased with a zero-phase lowpass (its default one is causal)
+    ref = st.copy()
+    ref.detrend("constant")
+    ref.detrend("linear")
+    ref.taper(max_percentage=0.05)
+    ref.filter("lowpass", freq=0.4 * config.samp_freq, zerophase=True)
+    ref.decimate(5, no_filter=True)
+    ref.taper(max_percentage=0.05, max_length=50)
+    pre_filt = prefilter_band(config)
+    ref.filter("bandpass", freqmin=pre_filt[0], freqmax=pre_filt[-1], corners=4, zerophase=True)
+    a = ref[0].data[2000:-2000]
+    b = poly[0].data[2000 : ref[0].stats.npts - 2000]
+    assert np.corrcoef(a, b)[0, 1] > 0.9999
+    np.testing.assert_allclose(b, a, atol=1e-2 * np.abs(a).max())
+
+    batch = preprocess_raw_batch(
+        [st.copy()], [obspy.Inventory()], config, t0, t1, resample_method=ResampleMethod.POLYPHASE
+    )
+    np.testing.assert_allclose(batch[0][0].data, poly[0].data, atol=1e-4 * np.abs(poly[0].data).max())
+
+
+def test_cut_trace_make_stat():
+    config = ConfigParameters(samp_freq=5.0, inc_hours=1, cc_len=600, step=150.0)
+    sps = 5
+    rng = np.random.default_rng(2)
+    data = rng.standard_normal(3600 * sps).astype(np.float32) + np.linspace(0, 3, 3600 * sps, dtype=np.float32)
+    t0 = obspy.UTCDateTime("2021-01-01T00:00:00")
+    ch_data = ChannelData(obspy.Stream([obspy.Trace(data, header={"sampling_rate": 5.0, "starttime": t0})]))
+
+    trace_stdS, dataS_t, dataS = cut_trace_make_stat(config, ch_data)
+
+    # the windows copied one by one
+    nseg = int((3600 - 600) / 150)
+    npts = 600 * sps
+    expected = np.stack([data[i * 150 * sps : i * 150 * sps + npts] for i in range(nseg)])
+    assert dataS.shape == (nseg, npts)
+    assert dataS.dtype == np.float32
+    np.testing.assert_allclose(trace_stdS, np.max(np.abs(expected), axis=1) / np.std(data), rtol=1e-6)
+    np.testing.assert_allclose(dataS_t, (t0.timestamp + 150.0 * np.arange(nseg)).astype(np.float32))
+    np.testing.assert_allclose(dataS, taper(detrend(demean(expected))), atol=1e-5)
+    # the data itself is not modified
+    assert np.array_equal(ch_data.data, data)
+
+
+@pytest.mark.parametrize("N", [1, 4, 5, 20])
+def test_running_mean_2D(N: int):
+    A = np.random.random((3, 200)).astype(np.float32)
+    smoothed = running_mean_2D(A, N)
+    assert smoothed.dtype == np.float32
+    for row in range(A.shape[0]):
+        np.testing.assert_allclose(smoothed[row], moving_ave(A[row], N), rtol=1e-5)
+
+
+def test_noise_processing_rma():
+    config = ConfigParameters(time_norm=TimeNorm.RMA, freq_norm=FreqNorm.NO, smooth_N=10)
+    dataS = np.random.random((2, 1000)).astype(np.float32) - 0.5
+    expected = np.stack([row / moving_ave(np.abs(row), config.smooth_N) for row in dataS])
+    Nfft = next_fast_len(1000)
+    np.testing.assert_allclose(
+        noise_processing(config, dataS), np.fft.rfft(expected, Nfft, axis=1), rtol=1e-3, atol=1e-3
+    )
@@ -0,0 +1,41 @@
+import numpy as np
+import obspy
+
+from noisepy.seis.response import ResponseCache, remove_response, shared_response_cache
+
+
+def test_remove_response_cached():
+    # obspy's example data and inventory
+    inv = obspy.read_inventory()
+    st = obspy.read()
+    pre_filt = [0.045, 0.05, 2.0, 2.2]
+    cache = ResponseCache(1024**3)
+
+    for tr in st:
+        expected = tr.copy()
+        expected.attach_response(inv)
+        expected.remove_response(output="VEL", pre_filt=pre_filt, water_level=60)
+        for _ in range(2):
+            actual = remove_response(tr.copy(), inv, "VEL", pre_filt, cache)
+            np.testing.assert_allclose(actual.data, expected.data, atol=1e-6 * np.abs(expected.data).max())
+
+    assert cache.misses == len(st)
+    assert cache.hits == len(st)
+    assert len(cache.entries) == len(st)
+
+
+def test_response_cache_full():
+    cache = ResponseCache(100)
+    cache.get("a", lambda: np.zeros(10))
+    # over the limit: computed but not kept
+    value = cache.get("b", lambda: np.zeros(10))
+    assert value.shape == (10,)
+    assert list(cache.entries) == ["a"]
+    assert cache.nbytes == 80
+
+
+def test_shared_response_cache():
+    assert shared_response_cache(0) is None
+    cache = shared_response_cache(1.0)
+    assert cache is shared_response_cache(2.0)
+    assert cache.max_bytes == 2 * 1024**3
@@ -2,11 +2,13 @@ from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import MagicMock, patch
 
 import numpy as np
+import obspy
 import pytest
 import utils
 from datetimerange import DateTimeRange
 from utils import date_range
 
+from noisepy.seis.geometry import StationGeometry
 from noisepy.seis.io.datatypes import (
     ChannelType,
     ConfigParameters,
@@ -113,6 +115,39 @@ def test_stack_pair(stackmethod, substack: bool, rotation: bool):
     assert len(stacks) == 0
 
 
+@pytest.mark.parametrize("stored", [True, False])
+def test_stack_pair_rotation_geometry(stored: bool):
+    ts = date_range(1, 1, 2)
+    config = ConfigParameters(start_date=ts.start_datetime, end_date=ts.end_datetime, rotation=True)
+    # as listed by the cc store, without coordinates
+    src, rec = Station("CI", "BAK"), Station("CI", "SVD")
+    coords = {"latS": 35.34, "lonS": -119.1, "latR": 34.1, "lonR": -116.93}
+    _, azi, baz = obspy.geodetics.base.gps2dist_azimuth(coords["latS"], coords["lonS"], coords["latR"], coords["lonR"])
+    params = {"ngood": 4, "time": 1548979200.0, **coords}
+    if stored:
+        params.update({"azi": np.float32(azi), "baz": np.float32(baz)})
+    ch = [ChannelType(n) for n in ["BHE", "BHN", "BHZ"]]
+    cc_store = SerializableMock()
+    cc_store.read.return_value = [CrossCorrelation(s, r, params, np.random.rand(1, 8001)) for s in ch for r in ch]
+
+    angles = []
+
+    def record(bigstack, parameters, locs):
+        angles.append((parameters["azi"], parameters["baz"]))
+        return rotation(bigstack, parameters, locs)
+
+    with patch("noisepy.seis.stack.noise_module.rotation", side_effect=record):
+        stacks = stack_pair(src, rec, [ts, ts], cc_store, config, StationGeometry())
+    assert len(stacks) > 0
+    assert len(angles) == 1
+    if stored:
+        # the float32 values stored with the CCFs are kept
+        assert angles[0] == (params["azi"], params["baz"])
+    else:
+        # computed from the coordinates the CCFs were computed with
+        np.testing.assert_allclose(angles[0], (azi, baz), atol=1e-3)
+
+
 @pytest.mark.parametrize("bigstack", [np.random.rand(9, 8000), np.random.rand(8, 8000)])
 @pytest.mark.parametrize("locs", [{}, {"station": ["CI.BAK", "CI.SVD"], "angle": [0.0, 1.0]}])
 def test_rotation(bigstack: np.ndarray, locs: dict):
@@ -6,7 +6,7 @@ from scipy.fftpack import next_fast_len
 
 from noisepy.seis.correlate import ConfigParameters
 from noisepy.seis.io.datatypes import FreqNorm
-from noisepy.seis.noise_module import moving_ave, whiten
+from noisepy.seis.noise_module import moving_ave, moving_ave_2D, whiten
 
 
 def whiten_original(data, fft_para: ConfigParameters):
@@ -176,6 +176,53 @@ def test_whiten2d(freqNorm: FreqNorm):
     _, _ = whiten2d(freqNorm)
 
 
+def whiten_full_spectrum(data, fft_para: ConfigParameters, n_taper=100):
+    # whitening over the full complex spectrum, as done before only keeping the non-negative frequencies
+    nfft = next_fast_len(data.shape[-1])
+    spec = np.fft.fft(data, nfft)
+    freq = np.fft.fftfreq(nfft, d=fft_para.dt)
+    ix0 = np.argmin(np.abs(freq - fft_para.freqmin))
+    ix1 = np.argmin(np.abs(freq - fft_para.freqmax))
+    ix11 = min(ix1 + n_taper, nfft)
+    ix00 = max(ix0 - n_taper, 0)
+    spec[..., 0:ix00] = 0.0
+    spec[..., ix11:] = 0.0
+    if fft_para.smooth_N <= 1:
+        spec[..., ix00:ix11] = np.exp(1.0j * np.angle(spec[..., ix00:ix11]))
+    else:
+        amp = np.abs(spec[..., ix00:ix11])
+        spec[..., ix00:ix11] /= moving_ave_2D(np.atleast_2d(amp), fft_para.smooth_N).reshape(amp.shape)
+    spec[..., ix00:ix0] *= np.cos(np.linspace(np.pi / 2.0, np.pi, ix0 - ix00)) ** 2
+    spec[..., ix1:ix11] *= np.cos(np.linspace(0.0, np.pi / 2.0, ix11 - ix1)) ** 2
+    return spec
+
+
+# the band reaches past the Nyquist frequency, so the smoothing needs the mirrored negative frequencies
+@pytest.mark.parametrize("shape", [(1001,), (5, 1000)])
+@pytest.mark.parametrize("smooth_N", [1, 20])
+def test_whiten_rfft(shape, smooth_N: int):
+    fft_para = ConfigParameters()
+    fft_para.samp_freq = 1.0
+    fft_para.freqmin = 0.01
+    fft_para.freqmax = 0.45
+    fft_para.smooth_N = smooth_N
+
+    data = np.random.random(shape)
+    white_new = whiten(data, fft_para)
+    white_full = whiten_full_spectrum(data, fft_para)
+    nfft = white_full.shape[-1]
+    assert white_new.shape[-1] == nfft // 2 + 1
+    np.testing.assert_allclose(white_new, white_full[..., : nfft // 2 + 1], atol=1e-12)
+
+
+@pytest.mark.parametrize("N", [2, 7, 30])
+def test_moving_ave_2D(N: int):
+    A = np.random.random((3, 500))
+    smoothed = moving_ave_2D(A, N)
+    for row in range(A.shape[0]):
+        np.testing.assert_allclose(smoothed[row], moving_ave(A[row], N), rtol=1e-10)
+
+
 if __name__ == "__main__":
     white_original, white_new = whiten1d()
     plot_1d(white_original, white_new)